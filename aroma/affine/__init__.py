@@ -37,19 +37,40 @@
 # written agreement between you and SINTEF Digital.
 
 
-from functools import partial
-from itertools import combinations, chain, count
+from functools import partial, reduce
+from itertools import combinations, chain, count, product
+import operator
 import numpy as np
+import scipy.sparse as sparse
 from nutils import function as fn, matrix, _, log
 
 from aroma import util
+import aroma.quadrature as quadrature
 from aroma.affine.integrands import *
 from aroma.affine.polyfit import Interpolator
+from aroma.affine import deim
+
+# Memoized integral evaluations, keyed on the parameters they depend on
+memo = util.MemoCache(2**28)
+
 
 def islift(c):
     return isinstance(c, str) and c == 'lift'
 
 
+def _project(large, proj):
+    # TODO: Improve this
+    if hasattr(large, 'project'):
+        return large.project(proj).obj
+    if large.ndim == 2:
+        pa, pb = proj
+        return pa.dot(large.dot(pb.T))
+    if large.ndim == 1:
+        pa, = proj
+        return pa.dot(large)
+    assert False
+
+
 _mufuncs = {
     '__sin': np.sin,
     '__cos': np.cos,
@@ -193,6 +214,7 @@ class MuFunc:
 class MuCallable(MuFunc):
 
     _ident_ = 'MuCallable'
+    memoize = True
 
     def __init__(self, shape, deps, scale=1):
         self.shape = shape
@@ -236,9 +258,44 @@ class MuCallable(MuFunc):
     def evaluate(self, *args):
         raise NotImplementedError
 
+    def _memo_key(self, case, pval, cont, sym, scale):
+        if not self.memoize or any(c is not None and not islift(c) for c in cont):
+            return None
+        deps = set(self.deps)
+        if scale:
+            deps |= getattr(self.scale, 'deps', set())
+        if any(islift(c) for c in cont):
+            lift = case.integrals['lift']
+            deps |= set(lift.deps) | getattr(lift.scale, 'deps', set())
+        try:
+            token = None if case is None else case.integrals.token
+            values = tuple((dep, pval[dep]) for dep in sorted(deps))
+            key = (token, values, cont, sym, scale)
+            hash(key)
+        except (KeyError, TypeError):
+            return None
+        return key
+
     def __call__(self, case, pval, cont=None, sym=False, scale=True):
         if cont is None:
             cont = (None,) * self.ndim
+        cont = tuple(cont)
+
+        key = self._memo_key(case, pval, cont, sym, scale)
+        if key is not None:
+            retval = memo.get(self, key)
+            if retval is not None:
+                return retval.copy()
+
+        retval = self._call(case, pval, cont, sym, scale)
+        if key is not None and (isinstance(retval, np.ndarray) or sparse.issparse(retval)):
+            memo.put(self, key, retval.copy())
+        return retval
+
+    def lazy(self, case, pval, cont=None, scale=True):
+        return self(case, pval, cont=cont, scale=scale)
+
+    def _call(self, case, pval, cont, sym, scale):
         if any(islift(c) for c in cont):
             index = frozenset(i for i, c in enumerate(cont) if islift(c))
             if index in self.lifts:
@@ -253,7 +310,51 @@ class MuCallable(MuFunc):
             retval = retval + retval.T
         return retval
 
-    def _self_project(self, case, proj, cont, tol=1e-4, nrules=4, **kwargs):
+    def evaluate_entries(self, case, pval, cont, index, mesh=None):
+        return deim.entries(self.evaluate(case, pval, cont), index)
+
+    def reduced_mesh(self, case, cont, index):
+        return None
+
+    def _self_project(self, case, proj, cont, method='poly', **kwargs):
+        if method == 'deim':
+            return self._deim_project(case, proj, cont, **kwargs)
+        return self._poly_project(case, proj, cont, **kwargs)
+
+    def _deim_project(self, case, proj, cont, tol=1e-4, nsnapshots=8, **kwargs):
+        totdeps = set(self.deps)
+        if any(islift(c) for c in cont):
+            totdeps |= set(case.integrals['lift'].deps)
+        totdeps = case.parameters.sequence(totdeps)
+        nlifts = sum((1 if islift(c) else 0) for c in cont)
+
+        snapshots = []
+        points = quadrature.uniform(case.ranges(keep=totdeps), nsnapshots)[:,1:]
+        for point in log.iter('snapshot', points):
+            mu = {k: v for k, v in zip(totdeps, point)}
+            if nlifts > 0:
+                lift = case['lift'](mu, scale=False)
+                mcont = tuple((lift if islift(c) else c) for c in cont)
+            else:
+                mcont = cont
+            snapshots.append(self.evaluate(case, mu, mcont))
+
+        shape = tuple(n for n, c in zip(self.shape, cont) if c is None)
+        flat, data = deim.snapshot_matrix(snapshots)
+        basis, points = deim.deim(data, tol)
+        index = np.unravel_index(flat[points], shape)
+        mesh = self.reduced_mesh(case, cont, index)
+        obj = np.array([_project(deim.unflatten(flat, b, shape), proj) for b in basis.T])
+
+        scale = self.scale
+        if nlifts > 0:
+            scale = scale * case.integrals['lift'].scale ** nlifts
+        liftaxes = [i for i, c in enumerate(cont) if islift(c)]
+        return MuDEIM(
+            obj, self, liftaxes, np.array(index), basis[points], mesh, totdeps, scale=scale
+        )
+
+    def _poly_project(self, case, proj, cont, tol=1e-4, nrules=4, **kwargs):
         totdeps = set(self.deps)
         if any(islift(c) for c in cont):
             totdeps |= set(case.integrals['lift'].deps)
@@ -267,18 +368,7 @@ class MuCallable(MuFunc):
                 mcont = tuple((lift if islift(c) else c) for c in cont)
             else:
                 mcont = cont
-            large = self.evaluate(case, mu, mcont)
-
-            # TODO: Improve this
-            if hasattr(large, 'project'):
-                return large.project(proj).obj
-            if large.ndim == 2:
-                pa, pb = proj
-                return pa.dot(large.dot(pb.T))
-            if large.ndim == 1:
-                pa, = proj
-                return pa.dot(large)
-            assert False
+            return _project(self.evaluate(case, mu, mcont), proj)
 
         ranges = case.ranges(keep=totdeps)
         interp = Interpolator(ranges, wrapper)
@@ -356,6 +446,50 @@ class MuPoly(MuObject):
         return util.contract(retval, cont)
 
 
+class MuDEIM(MuObject):
+
+    _ident_ = 'MuDEIM'
+
+    def __init__(self, obj, source, liftaxes, index, interp, mesh, deps, scale=1):
+        super().__init__(obj, obj.shape[1:], deps, scale=scale)
+        self.source = source
+        self.liftaxes = liftaxes
+        self.index = index
+        self.interp = interp
+        self.mesh = mesh
+
+    def write(self, group):
+        super().write(group)
+        self.source.write(group.require_group('source'))
+        util.to_dataset(np.array(self.liftaxes, dtype=int), group, 'liftaxes')
+        util.to_dataset(self.index, group, 'index')
+        util.to_dataset(self.interp, group, 'interp')
+        if self.mesh is not None:
+            util.to_dataset(self.mesh, group, 'mesh')
+
+    def _read(self, group):
+        super()._read(group)
+        self.source = MuFunc.read(group['source'])
+        self.liftaxes = list(util.from_dataset(group['liftaxes']))
+        self.index = util.from_dataset(group['index'])
+        self.interp = util.from_dataset(group['interp'])
+        self.mesh = util.from_dataset(group['mesh']) if 'mesh' in group else None
+
+    def evaluate(self, case, pval, cont):
+        hifi = getattr(case, 'case', case)
+        scont = [None] * self.source.ndim
+        if self.liftaxes:
+            lift = hifi['lift'](pval, scale=False)
+            for i in self.liftaxes:
+                scont[i] = lift
+        values = self.source.evaluate_entries(
+            hifi, pval, tuple(scont), tuple(self.index), self.mesh
+        )
+        coeffs = np.linalg.solve(self.interp, values)
+        retval = np.tensordot(coeffs, self.obj, axes=1)
+        return util.contract(retval, cont)
+
+
 class MuLambda(MuObject):
 
     _ident_ = 'MuLambda'
@@ -522,8 +656,28 @@ class AffineIntegral(Affine):
     def evaluate(self, case, pval, cont):
         # if self.fallback:
         #     return self.fallback.get(cont, mu=pval, case=case)
-        retval = sum(scale(pval) * value.get(cont) for scale, value in self)
-        retval, = integrands.integrate(retval)
+        retval, = integrands.integrate(self.evaluate_lazy(case, pval, cont))
+        return retval
+
+    def evaluate_lazy(self, case, pval, cont):
+        return sum(scale(pval) * value.get(cont, case=case) for scale, value in self)
+
+    def lazy(self, case, pval, cont=None, scale=True):
+        if cont is None:
+            cont = (None,) * self.ndim
+        cont = tuple(cont)
+
+        key = self._memo_key(case, pval, cont, False, scale)
+        index = frozenset(i for i, c in enumerate(cont) if islift(c))
+        if index in self.lifts or (key is not None and memo.get(self, key) is not None):
+            return self(case, pval, cont=cont, scale=scale)
+
+        if index:
+            lift = case['lift'](pval)
+            cont = tuple((lift if islift(c) else c) for c in cont)
+        retval = self.evaluate_lazy(case, pval, cont)
+        if scale:
+            retval = self.scale(pval) * retval
         return retval
 
     # def __call__(self, pval, lift=None, cont=None, sym=False, case=None):
@@ -632,13 +786,28 @@ class AffineIntegral(Affine):
     #     assert len(ret) == ndim
     #     return tuple(ret)
 
-    def project(self, case, proj):
-        new_values = [itg.project(proj) for itg in log.iter('term', list(self.values))]
-        new = AffineIntegral(zip(self.scales, new_values))
-
-        for axes, rep in log.iter('axes', list(self.lifts.items())):
-            remaining_axes = [i for i in range(self.ndim) if i not in axes]
-            _proj = [proj[i] for i in remaining_axes if proj[i] is not None]
-            new.lifts[axes] = rep.project(_proj)
-
-        return new
+    def _lift_terms(self, case):
+        lift = case.integrals['lift']
+        if isinstance(lift, Affine):
+            return lift.scale, list(lift)
+        return lift.scale, [(mu(1), lift.evaluate(case, {}, (None,)))]
+
+    def _self_project(self, case, proj, cont, **kwargs):
+        liftaxes = [i for i, c in enumerate(cont) if islift(c)]
+        if not liftaxes:
+            new_values = [itg.project(proj) for itg in log.iter('term', list(self.values))]
+            return AffineIntegral(zip(self.scales, new_values), scale=self.scale)
+
+        # Contract every term with every combination of lift terms, so that
+        # the result stays affine in the parameters
+        liftscale, liftterms = self._lift_terms(case)
+        scales, values = [], []
+        for scale, itg in log.iter('term', list(self)):
+            for combination in product(liftterms, repeat=len(liftaxes)):
+                lcont = list(cont)
+                for i, (__, lift) in zip(liftaxes, combination):
+                    lcont[i] = lift
+                value, = integrands.integrate(itg.get(tuple(lcont)))
+                scales.append(reduce(operator.mul, (s for s, __ in combination), scale))
+                values.append(Integrand.make(value).project(proj))
+        return AffineIntegral(zip(scales, values), scale=self.scale * liftscale ** len(liftaxes))
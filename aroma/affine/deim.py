@@ -0,0 +1,99 @@
+# Copyright (C) 2014 SINTEF ICT,
+# Applied Mathematics, Norway.
+#
+# Contact information:
+# E-mail: eivind.fonn@sintef.no
+# SINTEF Digital, Department of Applied Mathematics,
+# P.O. Box 4760 Sluppen,
+# 7045 Trondheim, Norway.
+#
+# This file is part of AROMA.
+#
+# AROMA is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AROMA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with AROMA. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# In accordance with Section 7(b) of the GNU General Public License, a
+# covered work must retain the producer line in every data file that
+# is created or manipulated using AROMA.
+#
+# Other Usage
+# You can be released from the requirements of the license by purchasing
+# a commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities involving the AROMA library without
+# disclosing the source code of your own applications.
+#
+# This file may be used in accordance with the terms contained in a
+# written agreement between you and SINTEF Digital.
+
+
+import numpy as np
+import scipy.sparse as sparse
+from nutils import log
+
+from aroma.affine.integrands import COOTensorIntegrand
+
+
+def flatten(obj):
+    if isinstance(obj, np.ndarray):
+        return np.arange(obj.size), obj.ravel()
+    if sparse.issparse(obj):
+        obj = obj.tocoo()
+        index, data = np.ravel_multi_index((obj.row, obj.col), obj.shape), obj.data
+    else:
+        index, data = np.ravel_multi_index(obj.indices, obj.shape), obj.data
+    index, inverse = np.unique(index, return_inverse=True)
+    return index, np.bincount(inverse, weights=data, minlength=len(index))
+
+
+def unflatten(index, data, shape):
+    if len(shape) == 1:
+        retval = np.zeros(shape)
+        retval[index] = data
+        return retval
+    indices = np.unravel_index(index, shape)
+    if len(shape) == 2:
+        return sparse.csr_matrix((data, indices), shape=shape)
+    return COOTensorIntegrand(shape, *indices, data)
+
+
+def entries(obj, index):
+    target = np.ravel_multi_index(index, obj.shape)
+    flat, data = flatten(obj)
+    pos = np.minimum(np.searchsorted(flat, target), len(flat) - 1)
+    return np.where(flat[pos] == target, data[pos], 0.0)
+
+
+def snapshot_matrix(snapshots):
+    flats = [flatten(snapshot) for snapshot in snapshots]
+    index = np.unique(np.concatenate([flat for flat, __ in flats]))
+    data = np.zeros((len(index), len(flats)))
+    for i, (flat, values) in enumerate(flats):
+        data[np.searchsorted(index, flat), i] = values
+    return index, data
+
+
+def deim(data, tol):
+    """Compute a POD basis of the columns of `data`, truncated at relative
+    singular value `tol`, and select interpolation rows greedily."""
+    basis, sigma, __ = np.linalg.svd(data, full_matrices=False)
+    nbasis = max(1, np.sum(sigma > tol * sigma[0]))
+    basis = basis[:,:nbasis]
+    log.user(f'{nbasis} DEIM modes')
+
+    points = [np.argmax(np.abs(basis[:,0]))]
+    for i in range(1, nbasis):
+        coeffs = np.linalg.solve(basis[points,:i], basis[points,i])
+        residual = basis[:,i] - basis[:,:i].dot(coeffs)
+        points.append(np.argmax(np.abs(residual)))
+    return basis, np.array(points)
@@ -37,6 +37,7 @@
 # written agreement between you and SINTEF Digital.
 
 
+from collections import OrderedDict
 import numpy as np
 from nutils import log, _
 import scipy.sparse as sp
@@ -173,7 +174,7 @@ class NumpyArrayIntegrand(ThinWrapperIntegrand):
             axes.append(i)
         return obj.sum(tuple(axes))
 
-    def get(self, contraction):
+    def get(self, contraction, case=None):
         return self._contract(contraction)
 
     def cache(self, **kwargs):
@@ -202,7 +203,7 @@ class ScipyArrayIntegrand(ThinWrapperIntegrand):
     def accepts(cls, obj):
         return isinstance(obj, sp.spmatrix)
 
-    def get(self, contraction):
+    def get(self, contraction, case=None):
         if all(c is None for c in contraction):
             return self.obj
         ca, cb = contraction
@@ -286,8 +287,8 @@ class COOTensorIntegrand(Integrand):
     def read(group):
         datagrp = group['data']
         retval = COOTensorIntegrand.__new__(COOTensorIntegrand)
-        retval.indices = datagrp['indices-i'][:], datagrp['indices-j'][:], datagrp['indices-k'][:]
-        retval.data = datagrp['data'][:]
+        retval.indices = tuple(util.read_array(datagrp[f'indices-{i}']) for i in 'ijk')
+        retval.data = util.read_array(datagrp['data'])
         retval.shape = tuple(datagrp.attrs['shape'])
 
         retval.assemblers = {}
@@ -303,7 +304,7 @@ class COOTensorIntegrand(Integrand):
         for ass in self.assemblers.values():
             ass.ensure_shareable()
 
-    def get(self, contraction):
+    def get(self, contraction, case=None):
         retval = self._contract(contraction)
         if not isinstance(retval, COOTensorIntegrand):
             return retval
@@ -352,11 +353,24 @@ class COOTensorIntegrand(Integrand):
 
 
 class LazyIntegral:
-    pass
+
+    def batch_key(self):
+        return self.__class__
 
 
 def integrate(*args):
     if all(not isinstance(arg, LazyIntegral) for arg in args):
         return args
-    assert all(arg.__class__ == args[0].__class__ for arg in args[1:])
-    return args[0].__class__.integrate(*args)
+
+    # Integrate all compatible lazy integrals in one batch
+    batches = OrderedDict()
+    for i, arg in enumerate(args):
+        if isinstance(arg, LazyIntegral):
+            batches.setdefault(arg.batch_key(), []).append(i)
+
+    retval = list(args)
+    for indices in batches.values():
+        batch = [args[i] for i in indices]
+        for i, value in zip(indices, batch[0].__class__.integrate(*batch)):
+            retval[i] = value
+    return retval
@@ -37,97 +37,222 @@
 # written agreement between you and SINTEF Digital.
 
 
-from functools import partial
+from functools import partial, lru_cache
+from weakref import WeakKeyDictionary
 import numpy as np
-from nutils import log
+from nutils import log, config
 import scipy.sparse as sparse
+from scipy.special import comb
+import sharedmem
 
 import aroma.quadrature as quadrature
 from aroma.affine import MuCallable
 from aroma import util
 
 
-def simple_loc2(func):
-    def inner(elt, wts, upts, vpts, **kwargs):
-        bfuns = list(elt.support())
-        ids = [bf.id for bf in bfuns]
-        V = np.zeros((len(bfuns), len(bfuns)))
-        I, J = np.meshgrid(ids, ids)
+def bernstein(order, pts):
+    # Values and derivatives of Bernstein polynomials on [0,1], shape (npts, order)
+    degree = order - 1
+    k = np.arange(order)
+    pts = pts[:,np.newaxis]
+    vals = comb(degree, k) * pts**k * (1 - pts)**(degree - k)
+    if degree == 0:
+        return vals, np.zeros_like(vals)
+    lower, __ = bernstein(order - 1, pts[:,0])
+    zero = np.zeros((len(pts), 1))
+    ders = degree * (np.hstack([zero, lower]) - np.hstack([lower, zero]))
+    return vals, ders
 
-        (umin, umax), (vmin, vmax) = elt.span()
-        locwts = wts * (umax - umin) * (vmax - vmin)
-        locupts = upts * (umax - umin) + umin
-        locvpts = vpts * (vmax - vmin) + vmin
 
-        func(bfuns, locwts, locupts, locvpts, V, **kwargs)
-
-        return I, J, V
-    return inner
-
-
-def simple_loc1(func):
-    def inner(elt, wts, upts, vpts, **kwargs):
-        bfuns = list(elt.support())
-        ids = [bf.id for bf in bfuns]
-        V = np.zeros((len(bfuns),))
-
-        (umin, umax), (vmin, vmax) = elt.span()
-        locwts = wts * (umax - umin) * (vmax - vmin)
-        locupts = upts * (umax - umin) + umin
-        locvpts = vpts * (vmax - vmin) + vmin
-
-        func(bfuns, locwts, locupts, locvpts, V, **kwargs)
-
-        return ids, V
+@lru_cache()
+def reference_tables(orders, npts):
+    wts, upts, vpts = quadrature.full([[0.0, 1.0], [0.0, 1.0]], npts).T
+    (uvals, uders), (vvals, vders) = (
+        bernstein(order, pts) for order, pts in zip(orders, (upts, vpts))
+    )
+
+    # Tensor product Bernstein basis, with the first direction running fastest
+    def tensor(a, b):
+        return np.einsum('qi,qj->qji', a, b).reshape(len(wts), -1)
+
+    return wts, upts, vpts, tensor(uvals, vvals), tensor(uders, vvals), tensor(uvals, vders)
+
+
+# Supported functions, Bezier extraction operators and spans of all elements, per mesh
+_elements = WeakKeyDictionary()
+
+# Assembled matrices, which depend on the mesh only, per mesh
+_matrices = WeakKeyDictionary()
+
+
+def mesh_signature(mesh):
+    return len(mesh), len(mesh.elements)
+
+
+def parallel_map(func, items, nprocs):
+    items = list(items)
+    nprocs = min(nprocs, len(items))
+    if nprocs > 1:
+        with sharedmem.MapReduce(np=nprocs) as pool:
+            pool.map(func, items)
+    else:
+        for item in items:
+            func(item)
+
+
+def partition(sizes, nprocs):
+    # Split into contiguous ranges with roughly equal total size
+    offsets = np.append(0, np.cumsum(sizes))
+    bounds = np.searchsorted(offsets, np.linspace(0, offsets[-1], nprocs + 1))
+    bounds[0], bounds[-1] = 0, len(sizes)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def element_data(mesh, nprocs):
+    signature = mesh_signature(mesh)
+    if mesh in _elements and _elements[mesh][0] == signature:
+        return _elements[mesh][1]
+
+    sizes = np.array([elt.w.nBasisFunctions() for elt in mesh.elements])
+    offsets = np.append(0, np.cumsum(sizes))
+    ids = sharedmem.empty((offsets[-1],), dtype=int)
+    ext = sharedmem.empty((offsets[-1], np.prod(mesh.order())), dtype=float)
+    spans = sharedmem.empty((len(sizes), 2, 2), dtype=float)
+
+    def work(rng):
+        for index in range(*rng):
+            elt = mesh.elements[index]
+            start, end = offsets[index], offsets[index+1]
+            ids[start:end] = [bf.id for bf in elt.support()]
+            ext[start:end] = mesh.bezier_extraction(elt)
+            spans[index] = elt.span()
+
+    parallel_map(work, partition(sizes, nprocs), nprocs)
+
+    # Group elements by the number of supported functions, so that each group
+    # can be evaluated as one batch. Elements with the same local knot
+    # configuration share extraction operators, so the basis is evaluated
+    # once per configuration.
+    data = []
+    for size in np.unique(sizes):
+        elts, = np.nonzero(sizes == size)
+        rows = offsets[elts,np.newaxis] + np.arange(size)
+        gext = ext[rows]
+        __, first, inverse = np.unique(
+            np.round(gext.reshape(len(elts), -1), 12),
+            axis=0, return_index=True, return_inverse=True,
+        )
+        data.append((ids[rows], gext[first], inverse, spans[elts]))
+
+    _elements[mesh] = signature, data
+    return data
+
+
+def element_groups(mesh, nprocs, chunksize=4096):
+    for ids, configs, inverse, spans in element_data(mesh, nprocs):
+        step = min(chunksize, -(-len(ids) // nprocs))
+        for i in range(0, len(ids), step):
+            yield ids[i:i+step], configs, inverse[i:i+step], spans[i:i+step]
+
+
+def assemble(mesh, local, power, npts, nprocs=None, **kwargs):
+    nprocs = config.nprocs if nprocs is None else nprocs
+    tables = reference_tables(tuple(mesh.order()), npts)
+    groups = list(element_groups(mesh, nprocs))
+    offsets = np.append(0, np.cumsum([ids.shape[0] * ids.shape[1]**power for ids, *__ in groups]))
+
+    # Each chunk of elements is assembled into its own segment of the COO arrays
+    nnz = offsets[-1]
+    rows = sharedmem.empty((nnz,), dtype=int)
+    data = sharedmem.empty((nnz,), dtype=float)
+    if power == 2:
+        cols = sharedmem.empty((nnz,), dtype=int)
+
+    def work(index):
+        ids, configs, inverse, spans = groups[index]
+        local_data = local(tables, configs, inverse, spans, **kwargs)
+        start, end = offsets[index], offsets[index+1]
+        if power == 2:
+            rows[start:end] = np.broadcast_to(ids[:,:,np.newaxis], local_data.shape).flat
+            cols[start:end] = np.broadcast_to(ids[:,np.newaxis,:], local_data.shape).flat
+        else:
+            rows[start:end] = ids.flat
+        data[start:end] = local_data.flat
+
+    log.user(f'integrating {len(mesh.elements)} elements in {len(groups)} chunks')
+    parallel_map(work, range(len(groups)), nprocs)
+
+    if power == 2:
+        return util.CSRAssembler((len(mesh), len(mesh)), rows, cols)(data)
+    return util.VectorAssembler((len(mesh),), rows)(data)
+
+
+def simple_loc(func):
+    def inner(tables, configs, inverse, spans, **kwargs):
+        wts, upts, vpts, *tables = tables
+        (umin, umax), (vmin, vmax) = spans[:,0].T, spans[:,1].T
+        du, dv = umax - umin, vmax - vmin
+        locwts = np.outer(du * dv, wts)
+        locupts = umin[:,np.newaxis] + np.outer(du, upts)
+        locvpts = vmin[:,np.newaxis] + np.outer(dv, vpts)
+
+        # Basis functions and parametric derivatives at all quadrature points,
+        # with shape (nelems, nfuns, npts)
+        vals, uders, vders = (np.einsum('cib,qb->ciq', configs, table)[inverse] for table in tables)
+        uders /= du[:,np.newaxis,np.newaxis]
+        vders /= dv[:,np.newaxis,np.newaxis]
+
+        return func(vals, uders, vders, locwts, locupts, locvpts, **kwargs)
     return inner
 
 
-@simple_loc2
-def loc_mass(bfuns, locwts, locupts, locvpts, V):
-    for wt, upt, vpt in zip(locwts, locupts, locvpts):
-        lft = np.array([bf(upt, vpt) for bf in bfuns])
-        V += np.outer(lft, lft) * wt
+@simple_loc
+def loc_mass(vals, uders, vders, locwts, locupts, locvpts):
+    return np.einsum('eiq,ejq,eq->eij', vals, vals, locwts)
 
 
-@simple_loc2
-def loc_laplacian(bfuns, locwts, locupts, locvpts, V):
-    for wt, upt, vpt in zip(locwts, locupts, locvpts):
-        for deriv in ((1,0), (0,1)):
-            lft = np.array([bf.derivative(upt, vpt, d=deriv) for bf in bfuns])
-            rgt = np.array([bf.derivative(upt, vpt, d=deriv) for bf in bfuns])
-            V += np.outer(lft, rgt) * wt
+@simple_loc
+def loc_laplacian(vals, uders, vders, locwts, locupts, locvpts):
+    return (
+        np.einsum('eiq,ejq,eq->eij', uders, uders, locwts)
+        + np.einsum('eiq,ejq,eq->eij', vders, vders, locwts)
+    )
 
 
-@simple_loc1
-def loc_source(bfuns, locwts, locupts, locvpts, V, source):
-    for wt, upt, vpt in zip(locwts, locupts, locvpts):
-        lft = np.array([bf(upt, vpt) for bf in bfuns])
-        # TODO: multiply with source term
-        V += lft * wt * source(upt, vpt)
+def evaluate_source(source, upts, vpts):
+    # Source functions are evaluated on whole arrays of points, and point by
+    # point if they only support scalars
+    try:
+        values = np.asarray(source(upts, vpts), dtype=float)
+    except (TypeError, ValueError):
+        values = None
+    if values is None or values.shape != upts.shape:
+        values = np.vectorize(source, otypes=[float])(upts, vpts)
+    return values
 
 
-def integrate2(mesh, local, npts=5, **kwargs):
-    wts, upts, vpts = quadrature.full([[0.0, 1.0], [0.0, 1.0]], npts).T
-    I, J, V = [], [], []
+@simple_loc
+def loc_source(vals, uders, vders, locwts, locupts, locvpts, source):
+    return np.einsum('eiq,eq->ei', vals, locwts * evaluate_source(source, locupts, locvpts))
 
-    for elt in log.iter('integrating', mesh.elements):
-        Il, Jl, Vl = local(elt, wts, upts, vpts, **kwargs)
-        I.extend(Il.flat)
-        J.extend(Jl.flat)
-        V.extend(Vl.flat)
 
-    return sparse.csr_matrix((V, (I, J)), shape=(len(mesh), len(mesh)))
+def integrate2(mesh, local, npts=5, nprocs=None, **kwargs):
+    return assemble(mesh, local, 2, npts, nprocs=nprocs, **kwargs)
 
 
-def integrate1(mesh, local, npts=5, **kwargs):
-    wts, upts, vpts = quadrature.full([[0.0, 1.0], [0.0, 1.0]], npts).T
-    V = np.zeros((len(mesh),))
+def integrate1(mesh, local, npts=5, nprocs=None, **kwargs):
+    return assemble(mesh, local, 1, npts, nprocs=nprocs, **kwargs)
 
-    for elt in log.iter('integrating', mesh.elements):
-        Il, Vl = local(elt, wts, upts, vpts, **kwargs)
-        V[Il] += Vl
 
-    return V
+def memoized2(mesh, local, npts=5, nprocs=None):
+    signature = mesh_signature(mesh)
+    if mesh not in _matrices or _matrices[mesh][0] != signature:
+        _matrices[mesh] = signature, {}
+    cache = _matrices[mesh][1]
+    key = local.__name__, npts
+    if key not in cache:
+        cache[key] = integrate2(mesh, local, npts, nprocs=nprocs)
+    return cache[key].copy()
 
 
 class LRLaplacian(MuCallable):
@@ -139,8 +264,8 @@ class LRLaplacian(MuCallable):
 
     def evaluate(self, case, mu, cont):
         # TODO: It is assumed that the geometry represents all bases
-        mesh = case['geometry'](mu)
-        mx = integrate2(mesh, loc_laplacian, 5)
+        mesh = case['geometry'](mu, scale=False)
+        mx = memoized2(mesh, loc_laplacian, 5)
         mx = util.contract_sparse(mx, cont)
         return mx
 
@@ -154,13 +279,16 @@ class LRMass(MuCallable):
 
     def evaluate(self, case, mu, cont):
         # TODO: It is assumed that the geometry represents all bases
-        mesh = case['geometry'](mu)
-        mx = integrate2(mesh, loc_mass, 5)
+        mesh = case['geometry'](mu, scale=False)
+        mx = memoized2(mesh, loc_mass, 5)
         mx = util.contract_sparse(mx, cont)
         return mx
 
 
 class LRSource(MuCallable):
+    """Integral of a source function against the basis.  The function is
+    called as sourcefunc(mu, u, v) with arrays of parametric points, or with
+    one point at a time if it does not accept arrays."""
 
     _ident_ = 'LRSource'
 
@@ -178,7 +306,7 @@ class LRSource(MuCallable):
 
     def evaluate(self, case, mu, cont):
         # TODO: It is assumed that the geometry represents all bases
-        mesh = case['geometry'](mu)
+        mesh = case['geometry'](mu, scale=False)
         mx = integrate1(mesh, loc_source, 5, source=partial(self.sourcefunc, mu))
         mx = util.contract(mx, cont)
         return mx
@@ -38,10 +38,17 @@
 
 
 from collections import OrderedDict
-from nutils import matrix, function as fn, _
+from itertools import count
+from weakref import WeakKeyDictionary
+import numpy as np
+from nutils import matrix, element, function as fn, _
+from nutils.sample import Sample
+from nutils.points import CoordsWeightsPoints
+import scipy.sparse as sparse
 
 from aroma import util
 from aroma.affine import MuCallable
+from aroma.affine.deim import entries
 from aroma.affine.integrands import Integrand, ThinWrapperIntegrand, LazyIntegral, COOTensorIntegrand, NumpyArrayIntegrand
 
 def unwrap(obj):
@@ -50,7 +57,262 @@ def unwrap(obj):
     return obj
 
 
-class Mass(MuCallable):
+_tables = WeakKeyDictionary()
+
+
+def subsample(sample, elements, weights=None):
+    pts = [sample.points[e] for e in elements]
+    if weights is not None:
+        pts = [CoordsWeightsPoints(p.coords, p.weights * w) for p, w in zip(pts, weights)]
+    offsets = np.cumsum([0] + [p.npoints for p in pts])
+    return Sample(
+        tuple(sample.transforms[e] for e in elements), tuple(pts),
+        tuple(np.arange(a, b) for a, b in zip(offsets[:-1], offsets[1:])),
+    )
+
+
+def sample_table(case, domain=None, ischeme='gauss9'):
+    try:
+        tables = _tables.setdefault(case, {})
+    except TypeError:
+        return None
+    if domain is None:
+        domain = case.integration_domain
+    for key in [key for key in tables if key[1] is not case.domain and key[1] is not domain]:
+        del tables[key]
+    key = ischeme, domain
+    if key not in tables:
+        sample = domain.sample(*element.parse_legacy_ischeme(ischeme))
+        tables[key] = SampleTable(sample, case.geometry())
+    return tables[key]
+
+
+def integration_domain(case, domain):
+    # Integrals over the full domain are evaluated on the reduced domain
+    # of the case, if any; boundary integrals are left alone
+    if case is not None and domain is getattr(case, 'domain', None):
+        return case.integration_domain
+    return domain
+
+
+def tabulate(sample, funcs, ielem):
+    # Returns the local dofs on an element and, for each function, the
+    # dense array of local values with shape (npts, nloc, ...)
+    data = []
+    for func in funcs:
+        func = fn.asarray(func).prepare_eval(ndims=sample.ndims)
+        blocks = [fn.Tuple([val.simplified] + list(ind)) for ind, val in fn.blocks(func)]
+        evaluated = fn.Tuple(blocks).eval(
+            _transforms=sample.transforms[ielem], _points=sample.points[ielem].coords
+        )
+        data.append((func.shape, evaluated))
+
+    dofs = np.unique(np.concatenate([
+        indices[0].ravel() for __, evaluated in data for __, *indices in evaluated
+    ]))
+    values = []
+    for shape, evaluated in data:
+        npts = len(sample.points[ielem].weights)
+        local = np.zeros((npts, len(dofs)) + shape[1:])
+        for val, *indices in evaluated:
+            first = np.searchsorted(dofs, indices[0].ravel())
+            indices = [first] + [ind.ravel() for ind in indices[1:]]
+            np.add.at(local, (slice(None),) + np.ix_(*indices), val)
+        values.append(local)
+    return dofs, values
+
+
+class SampleTable:
+    """Basis values and gradients tabulated on an integration sample, so
+    that parametrized integrals only need to re-evaluate the geometry
+    Jacobian."""
+
+    def __init__(self, sample, refgeom):
+        self.sample = sample
+        self.refgeom = refgeom
+
+        npts = max(len(points.weights) for points in sample.points)
+        self.index = np.zeros((sample.nelems, npts), dtype=int)
+        self.weights = np.zeros((sample.nelems, npts))
+        jac = sample.eval(fn.J(self.refgeom))
+        for ielem, (index, points) in enumerate(zip(sample.index, sample.points)):
+            self.index[ielem,:len(index)] = index
+            self.weights[ielem,:len(index)] = points.weights * jac[index]
+
+        self.bases = {}
+        self.geometries = OrderedDict()
+        self.restrictions = {}
+
+    def restrict(self, elements):
+        key = tuple(elements)
+        if key not in self.restrictions:
+            self.restrictions[key] = SampleTable(subsample(self.sample, elements), self.refgeom)
+        return self.restrictions[key]
+
+    def basis(self, case, name):
+        if name not in self.bases:
+            basis = case.basis(name)
+            sample, nelems, npts = self.sample, *self.weights.shape
+            funcs = [basis, basis.grad(self.refgeom)]
+            tables = [tabulate(sample, funcs, ielem) for ielem in range(nelems)]
+            nloc = max(len(dofs) for dofs, __ in tables)
+            dofs = -np.ones((nelems, nloc), dtype=int)
+            values = np.zeros((nelems, npts, nloc) + basis.shape[1:])
+            grads = np.zeros(values.shape + self.refgeom.shape)
+            for ielem, (edofs, (evalues, egrads)) in enumerate(tables):
+                n, m = len(edofs), len(evalues)
+                dofs[ielem,:n] = edofs
+                values[ielem,:m,:n] = evalues
+                grads[ielem,:m,:n] = egrads
+            self.bases[name] = dofs, values, grads
+        return self.bases[name]
+
+    def geometry(self, case, mu, derivative=False):
+        geom = case.integrals['geometry']
+        try:
+            deps = set(geom.deps) | getattr(geom.scale, 'deps', set())
+            key = tuple((dep, mu[dep]) for dep in sorted(deps))
+            hash(key)
+        except (AttributeError, KeyError, TypeError):
+            key = None
+
+        if key is not None and key in self.geometries:
+            self.geometries.move_to_end(key)
+            data = self.geometries[key]
+        else:
+            jac = case['geometry'](mu).grad(self.refgeom)
+            jac = self.sample.eval(jac)[self.index]
+            data = {'jac': jac, 'inv': np.linalg.inv(jac), 'det': np.linalg.det(jac)}
+            if key is not None:
+                self.geometries[key] = data
+                while len(self.geometries) > 4:
+                    self.geometries.popitem(last=False)
+
+        if derivative and 'djac' not in data:
+            djac = case['geometry'](mu).grad(self.refgeom).grad(self.refgeom)
+            data['djac'] = self.sample.eval(djac)[self.index]
+        return data
+
+    def evaluate(self, case, name, mu, grad=False):
+        trf = case.integrals.get(f'{name}-trf')
+        if trf is not None and not isinstance(trf, (PiolaVectorTransform, PiolaScalarTransform)):
+            return None
+
+        dofs, values, grads = self.basis(case, name)
+        piola = trf is not None
+        geom = self.geometry(case, mu, derivative=piola and grad)
+        jac, inv, det = geom['jac'], geom['inv'], geom['det']
+
+        if not piola:
+            if grad:
+                grads = np.einsum('eql...k,eqkm->eql...m', grads, inv)
+            return dofs, values, grads if grad else None
+
+        # The Piola transforms are J/det(J) and 1/det(J), with J the
+        # Jacobian of the parametrized geometry with respect to the
+        # reference geometry
+        s = 1 / det
+        if values.ndim == 3:
+            pvalues = values * s[...,_]
+            if grad:
+                ds = -s[...,_] * np.einsum('eqba,eqabk->eqk', inv, geom['djac'])
+                pgrads = values[...,_] * ds[:,:,_,:] + grads * s[:,:,_,_]
+        else:
+            fvalues = np.einsum('eqab,eqlb->eqla', jac, values)
+            pvalues = fvalues * s[:,:,_,_]
+            if grad:
+                ds = -s[...,_] * np.einsum('eqba,eqabk->eqk', inv, geom['djac'])
+                pgrads = (
+                    fvalues[...,_] * ds[:,:,_,_,:]
+                    + s[:,:,_,_,_] * (
+                        np.einsum('eqabk,eqlb->eqlak', geom['djac'], values)
+                        + np.einsum('eqab,eqlbk->eqlak', jac, grads)
+                    )
+                )
+        if grad:
+            pgrads = np.einsum('eql...k,eqkm->eql...m', pgrads, inv)
+        return dofs, pvalues, pgrads if grad else None
+
+    def integrate(self, case, mu, shape, operands, cont):
+        # Each operand is a tuple (dofs, values, subscripts) where values
+        # has layout (element, point, dof, ...) and the subscripts label
+        # the trailing axes in an einsum expression
+        weights = self.weights * np.abs(self.geometry(case, mu)['det'])
+        inputs, arrays, outputs, dofs = ['eq'], [weights], 'e', []
+        for letter, (basisdofs, array, subscripts), c in zip('ijk', operands, cont):
+            inputs.append('eq' + letter + subscripts)
+            arrays.append(array)
+            if c is None:
+                outputs += letter
+                dofs.append(basisdofs)
+            else:
+                inputs.append('e' + letter)
+                arrays.append(c[basisdofs] * (basisdofs >= 0))
+        local = np.einsum(','.join(inputs) + '->' + outputs, *arrays, optimize=True)
+
+        if not dofs:
+            return local.sum()
+        dofs = np.broadcast_arrays(*(
+            d[(slice(None),) + (_,)*i + (slice(None),) + (_,)*(len(dofs)-i-1)]
+            for i, d in enumerate(dofs)
+        ))
+        mask = np.all([d >= 0 for d in dofs], axis=0)
+        dofs = [d[mask] for d in dofs]
+        local = local[mask]
+        shape = tuple(n for n, c in zip(shape, cont) if c is None)
+        if len(dofs) == 1:
+            return np.bincount(dofs[0], weights=local, minlength=shape[0])
+        if len(dofs) == 2:
+            return sparse.csr_matrix((local, tuple(dofs)), shape=shape)
+        return COOTensorIntegrand(shape, *dofs, local)
+
+
+class TabulatedIntegral(MuCallable):
+
+    _ident_ = 'TabulatedIntegral'
+    tabulate = True
+
+    def basisnames(self):
+        raise NotImplementedError
+
+    def operands(self, table, case, mu):
+        raise NotImplementedError
+
+    def evaluate_tabulated(self, case, mu, cont, elements=None):
+        if not self.tabulate or not all(c is None or np.ndim(c) == 1 for c in cont):
+            return None
+        if elements is not None:
+            table = sample_table(case, domain=case.domain)
+            table = table and table.restrict(elements)
+        else:
+            table = sample_table(case)
+        if table is None:
+            return None
+        operands = self.operands(table, case, mu)
+        if operands is None:
+            return None
+        return table.integrate(case, mu, self.shape, operands, cont)
+
+    def reduced_mesh(self, case, cont, index):
+        table = self.tabulate and sample_table(case, domain=case.domain)
+        if not table:
+            return None
+        names = [name for name, c in zip(self.basisnames(), cont) if c is None]
+        mask = True
+        for name, target in zip(names, index):
+            dofs = table.basis(case, name)[0]
+            mask = mask & (dofs[:,:,_] == target[_,_,:]).any(1)
+        return np.nonzero(np.any(mask, axis=1))[0]
+
+    def evaluate_entries(self, case, mu, cont, index, mesh=None):
+        if mesh is not None:
+            retval = self.evaluate_tabulated(case, mu, cont, elements=mesh)
+            if retval is not None:
+                return entries(retval, index)
+        return super().evaluate_entries(case, mu, cont, index, mesh)
+
+
+class Mass(TabulatedIntegral):
 
     _ident_ = 'Mass'
 
@@ -66,7 +328,22 @@ class Mass(MuCallable):
         super()._read(group)
         self.basisname = util.from_dataset(group['basisname'])
 
+    def basisnames(self):
+        return (self.basisname, self.basisname)
+
+    def operands(self, table, case, mu):
+        basis = table.evaluate(case, self.basisname, mu)
+        if basis is None:
+            return None
+        dofs, values, __ = basis
+        operand = (dofs, values, 'a' if values.ndim > 3 else '')
+        return [operand, operand]
+
     def evaluate(self, case, mu, cont):
+        retval = self.evaluate_tabulated(case, mu, cont)
+        if retval is not None:
+            return retval
+
         geom = case['geometry'](mu)
         basis = case.basis(self.basisname, mu)
         itg = fn.outer(basis)
@@ -74,10 +351,10 @@ class Mass(MuCallable):
             itg = itg.sum([-1])
         itg = util.contract(itg, cont)
         with matrix.Scipy():
-            return unwrap(case.domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
+            return unwrap(case.integration_domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
 
 
-class Laplacian(MuCallable):
+class Laplacian(TabulatedIntegral):
 
     _ident_ = 'Laplacian'
 
@@ -93,40 +370,84 @@ class Laplacian(MuCallable):
         super()._read(group)
         self.basisname = util.from_dataset(group['basisname'])
 
+    def basisnames(self):
+        return (self.basisname, self.basisname)
+
+    def operands(self, table, case, mu):
+        basis = table.evaluate(case, self.basisname, mu, grad=True)
+        if basis is None:
+            return None
+        dofs, __, grads = basis
+        operand = (dofs, grads, 'ak' if grads.ndim > 4 else 'k')
+        return [operand, operand]
+
     def evaluate(self, case, mu, cont):
+        retval = self.evaluate_tabulated(case, mu, cont)
+        if retval is not None:
+            return retval
+
         geom = case['geometry'](mu)
         vbasis = case.basis(self.basisname, mu)
         itg = fn.outer(vbasis.grad(geom)).sum([-1, -2])
         itg = util.contract(itg, cont)
         with matrix.Scipy():
-            return unwrap(case.domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
+            return unwrap(case.integration_domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
 
 
-class NSDivergence(MuCallable):
+class NSDivergence(TabulatedIntegral):
 
     _ident_ = 'NSDivergence'
 
     def __init__(self, n, *deps, scale=1):
         super().__init__((n, n), deps, scale=scale)
 
+    def basisnames(self):
+        return ('v', 'p')
+
+    def operands(self, table, case, mu):
+        vbasis = table.evaluate(case, 'v', mu, grad=True)
+        pbasis = vbasis and table.evaluate(case, 'p', mu)
+        if pbasis is None:
+            return None
+        (vdofs, __, vgrads), (pdofs, pvalues, __) = vbasis, pbasis
+        return [(vdofs, -vgrads, 'aa'), (pdofs, pvalues, '')]
+
     def evaluate(self, case, mu, cont):
+        retval = self.evaluate_tabulated(case, mu, cont)
+        if retval is not None:
+            return retval
+
         geom = case['geometry'](mu)
         vbasis = case.basis('v', mu)
         pbasis = case.basis('p', mu)
         itg = -fn.outer(vbasis.div(geom), pbasis)
         itg = util.contract(itg, cont)
         with matrix.Scipy():
-            return unwrap(case.domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
+            return unwrap(case.integration_domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
 
 
-class NSConvection(MuCallable):
+class NSConvection(TabulatedIntegral):
 
     _ident_ = 'NSConvection'
 
     def __init__(self, n, *deps, scale=1):
         super().__init__((n, n, n), deps, scale=scale)
 
+    def basisnames(self):
+        return ('v', 'v', 'v')
+
+    def operands(self, table, case, mu):
+        vbasis = table.evaluate(case, 'v', mu, grad=True)
+        if vbasis is None:
+            return None
+        dofs, values, grads = vbasis
+        return [(dofs, values, 'a'), (dofs, values, 'b'), (dofs, grads, 'ab')]
+
     def evaluate(self, case, mu, cont):
+        retval = self.evaluate_tabulated(case, mu, cont)
+        if retval is not None:
+            return retval
+
         geom = case['geometry'](mu)
         vbasis = case.basis('v', mu)
         vgrad = vbasis.grad(geom)
@@ -134,7 +455,7 @@ class NSConvection(MuCallable):
         itg = util.contract(itg, cont)
         backend = matrix.Scipy if itg.ndim < 3 else COOTensorBackend
         with backend():
-            return unwrap(case.domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
+            return unwrap(case.integration_domain.integrate(itg * fn.J(geom), ischeme='gauss9'))
 
 
 class PiolaVectorTransform(MuCallable):
@@ -149,7 +470,7 @@ class PiolaVectorTransform(MuCallable):
         refgeom = case.geometry()
         trfgeom = case.geometry(mu)
         J = trfgeom.grad(refgeom)
-        return trfgeom.grad(refgeom) / fn.determinant(J)
+        return J / fn.determinant(J)
 
 
 class PiolaScalarTransform(MuCallable):
@@ -228,9 +549,10 @@ class NutilsArrayIntegrand(ThinWrapperIntegrand):
             axes.append(i)
         return obj.sum(tuple(axes))
 
-    def get(self, contraction):
+    def get(self, contraction, case=None):
         integrand = self._contract(contraction)
         domain, geom, ischeme = self.prop('domain', 'geometry', 'ischeme')
+        domain = integration_domain(case, domain)
         return LazyNutilsIntegral(integrand, domain, geom, ischeme)
 
     def contract(self, contraction):
@@ -263,6 +585,7 @@ class NutilsDelayedIntegrand(Integrand):
         self._evaluator = 'eval_' + indices
 
         self._kwargs, self._arg_shapes = {}, {}
+        self._templates = {}
         self.update_kwargs({k: v for k, v in kwargs.items() if k not in variables})
 
         if code is not None:
@@ -278,6 +601,7 @@ class NutilsDelayedIntegrand(Integrand):
 
     def add(self, code, **kwargs):
         self.update_kwargs(kwargs)
+        self._templates = {}
         if self._code is None:
             self._code = f'({code})'
             self.shape = self._integrand().shape
@@ -299,6 +623,7 @@ class NutilsDelayedIntegrand(Integrand):
         data = util.from_dataset(group['data'])
         retval.__dict__.update(data)
         retval.ndim = len(retval.shape)
+        retval._templates = {}
         retval.read_props(group)
         return retval
 
@@ -331,9 +656,27 @@ class NutilsDelayedIntegrand(Integrand):
             return self
         return NutilsArrayIntegrand(self._integrand()).cache(force=force, **kwargs)
 
+    def _template(self, contraction):
+        # The integrand with contraction vectors replaced by arguments, so
+        # that the expression is only parsed once per contraction pattern
+        pattern = tuple(c is not None for c in contraction)
+        if pattern not in self._templates:
+            arguments = tuple(
+                fn.Argument(f'contraction{i}', func.shape[:1]) if c else None
+                for i, (c, func) in enumerate(zip(pattern, self._defaults.values()))
+            )
+            self._templates[pattern] = self._integrand(arguments)
+        arguments = {f'contraction{i}': c for i, c in enumerate(contraction) if c is not None}
+        return self._templates[pattern], arguments
+
     def get(self, contraction, mu=None, case=None):
-        itg = self._integrand(contraction, mu=mu, case=case)
-        return NutilsArrayIntegrand(itg).prop(**self._properties).get((None,) * itg.ndim)
+        domain, geom, ischeme = self.prop('domain', 'geometry', 'ischeme')
+        domain = integration_domain(case, domain)
+        if any(isinstance(func, str) for func in self._kwargs.values()):
+            itg = self._integrand(contraction, mu=mu, case=case)
+            return LazyNutilsIntegral(itg, domain, geom, ischeme)
+        itg, arguments = self._template(contraction)
+        return LazyNutilsIntegral(itg, domain, geom, ischeme, arguments)
 
     def contract(self, contraction):
         if all(c is None for c in contraction):
@@ -355,6 +698,24 @@ class NutilsDelayedIntegrand(Integrand):
         return NumpyArrayIntegrand(retval)
 
 
+def merge_arguments(objs, arguments):
+    # Merge the argument values of several functions, renaming arguments
+    # that share a name but not a value
+    merged, retval = {}, []
+    for obj, args in zip(objs, arguments):
+        renames = {}
+        for name, value in args.items():
+            if name in merged and not np.array_equal(merged[name], value):
+                newname = next(f'{name}-{i}' for i in count() if f'{name}-{i}' not in merged)
+                renames[name] = fn.Argument(newname, value.shape)
+                name = newname
+            merged[name] = value
+        if renames:
+            obj = fn.replace_arguments(obj, renames)
+        retval.append(obj)
+    return retval, merged
+
+
 class LazyNutilsIntegral(LazyIntegral):
 
     @staticmethod
@@ -363,24 +724,37 @@ class LazyNutilsIntegral(LazyIntegral):
         assert all(arg._domain is domain for arg in args[1:])
         assert all(arg._geometry is geom for arg in args[1:])
         assert all(arg._ischeme == ischeme for arg in args[1:])
+        objs, arguments = merge_arguments(
+            [arg._obj for arg in args], [arg._arguments for arg in args]
+        )
+        objs = [obj*fn.J(geom) for obj in objs]
         with MaybeScipyBackend():
-            retval = domain.integrate([arg._obj*fn.J(geom) for arg in args], ischeme=ischeme)
+            retval = domain.integrate(objs, ischeme=ischeme, arguments=arguments)
         return [r.core if isinstance(r, matrix.Matrix) else r for r in retval]
 
-    def __init__(self, obj, domain, geometry, ischeme):
+    def __init__(self, obj, domain, geometry, ischeme, arguments=None):
         self._obj = obj
         self._domain = domain
         self._geometry = geometry
         self._ischeme = ischeme
+        self._arguments = arguments or {}
+
+    def batch_key(self):
+        return self.__class__, id(self._domain), id(self._geometry), self._ischeme
+
+    def _new(self, obj, arguments=None):
+        arguments = arguments or self._arguments
+        return LazyNutilsIntegral(obj, self._domain, self._geometry, self._ischeme, arguments)
 
     def __add__(self, other):
         if isinstance(other, util._SCALARS):
-            obj = other
+            return self._new(self._obj + other)
         elif isinstance(other, LazyNutilsIntegral):
-            obj = other._obj
-        else:
-            return NotImplemented
-        return LazyNutilsIntegral(self._obj + obj, self._domain, self._geometry, self._ischeme)
+            (obj, other_obj), arguments = merge_arguments(
+                [self._obj, other._obj], [self._arguments, other._arguments]
+            )
+            return self._new(obj + other_obj, arguments)
+        return NotImplemented
 
     def __radd__(self, other):
         return self + other
@@ -388,7 +762,7 @@ class LazyNutilsIntegral(LazyIntegral):
     def __mul__(self, other):
         if not isinstance(other, util._SCALARS):
             return NotImplemented
-        return LazyNutilsIntegral(self._obj * other, self._domain, self._geometry, self._ischeme)
+        return self._new(self._obj * other)
 
     def __rmul__(self, other):
         return self * other
@@ -41,10 +41,13 @@ from collections import defaultdict, OrderedDict, namedtuple
 from nutils import function as fn, log, plot, matrix, element
 import numpy as np
 import math
+import sharedmem
 from matplotlib.tri import Triangulation
 
 from aroma import util, tri
-from aroma.affine import mu, MuFunc
+from aroma.affine import mu, MuFunc, AffineIntegral, memo
+from aroma.affine.integrands import integrate
+from aroma.affine.integrands.nutils import subsample
 
 
 def pp_table(headers):
@@ -203,6 +206,45 @@ class Bases(OrderedDict):
 
 class Integrals(OrderedDict):
 
+    def __init__(self, *args, **kwargs):
+        self._groups = {}
+        self.token = object()
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self._groups:
+            value = MuFunc.read(self._groups.pop(key))
+            value.verify()
+            super().__setitem__(key, value)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        # A fresh token invalidates memoized evaluations, which may depend
+        # on other integrals such as the lift or the geometry
+        self._groups.pop(key, None)
+        self.token = object()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._groups.pop(key, None)
+        self.token = object()
+        super().__delitem__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def load(self):
+        for key in list(self._groups):
+            self[key]
+
+    def items(self):
+        self.load()
+        return super().items()
+
+    def values(self):
+        self.load()
+        return super().values()
+
     def __str__(self):
         table = pp_table(['Integral', 'lift', 'terms', 'opt', 'shape', 'types'])
         def put(value, axes=''):
@@ -221,8 +263,9 @@ class Integrals(OrderedDict):
         return str(table)
 
     def verify(self):
-        for value in self.values():
-            value.verify()
+        for key, value in super().items():
+            if key not in self._groups:
+                value.verify()
 
     def write(self, group, only=()):
         for name, integral in self.items():
@@ -230,8 +273,13 @@ class Integrals(OrderedDict):
                 integral.write(group.require_group(name))
 
     @staticmethod
-    def read(group):
-        return Integrals({key: MuFunc.read(subgrp) for key, subgrp in group.items()})
+    def read(group, lazy=False):
+        if not lazy:
+            return Integrals({key: MuFunc.read(subgrp) for key, subgrp in group.items()})
+        # Defer reading each integral until it's first accessed
+        retval = Integrals((key, None) for key in group.keys())
+        retval._groups.update(group.items())
+        return retval
 
 
 class Case:
@@ -253,6 +301,15 @@ class Case:
     def __setitem__(self, key, value):
         self.integrals[key] = value
 
+    def assemble(self, mu, *items):
+        # Each item is an integral name or a tuple (name, contraction).
+        # Lazy integrals are integrated together in as few passes as possible.
+        lazy = []
+        for item in items:
+            name, cont = (item, None) if isinstance(item, str) else item
+            lazy.append(self.integrals[name].lazy(self, mu, cont=cont))
+        return list(integrate(*lazy))
+
     def __contains__(self, key):
         return key in self.integrals
 
@@ -338,20 +395,23 @@ class Case:
         if not sparse:
             self.integrals.write(group.require_group('integrals'))
         else:
-            self.integrals.write(group.require_group('integrals'), only=('geometry', 'lift'))
+            # Reduced cases evaluate the geometry and the lift of the high
+            # fidelity case, and DEIM terms also its basis transforms
+            only = ('geometry', 'lift') + tuple(name for name in self if name.endswith('-trf'))
+            self.integrals.write(group.require_group('integrals'), only=only)
 
     @staticmethod
-    def read(group, sparse=False):
+    def read(group, sparse=False, lazy=False):
         cls = util.find_subclass(Case, group['type'][()])
         obj = cls.__new__(cls)
 
         # Lifts behave differently between high- and low-fidelity cases
-        obj._read(group, sparse=sparse)
+        obj._read(group, sparse=sparse, lazy=lazy)
 
         obj.verify()
         return obj
 
-    def _read(self, group, sparse):
+    def _read(self, group, sparse, lazy=False):
         self.name = group['name'][()].decode()
         self._cons = group['constraints'][:]
 
@@ -359,9 +419,11 @@ class Case:
             self.extra_dofs = group['extra_dofs'][()]
 
         self.bases = Bases.read(group['bases'])
-        self.integrals = Integrals.read(group['integrals'])
+        self.integrals = Integrals.read(group['integrals'], lazy=lazy)
 
-    def precompute(self, force=False, **kwargs):
+    def precompute(self, force=False, nprocs=1, **kwargs):
+        if nprocs > 1:
+            self._precompute_parallel(nprocs, force=force, **kwargs)
         new = []
         for name, value in self.integrals.items():
             with log.context(name):
@@ -371,9 +433,44 @@ class Case:
         for name, value in new:
             self.integrals[name] = value
 
+    def _precompute_parallel(self, nprocs, force=False, **kwargs):
+        # Integrate every term that needs it in a separate process, then
+        # substitute the results so that the serial pass has nothing left to do
+        tasks = [
+            (name, i, itg)
+            for name, value in self.integrals.items() if isinstance(value, AffineIntegral)
+            for i, itg in enumerate(value.values)
+            if not itg.optimized and (force or itg.ndim < 3)
+        ]
+        if not tasks:
+            return
+
+        def work(index):
+            __, __, itg = tasks[index]
+            with util.time(display=False) as t:
+                value = itg.cache(force=force, **kwargs)
+            return (index, t.seconds, *util.to_shared_memory(value))
+
+        results = {}
+
+        def collect(index, seconds, payload, blocks):
+            name, i, __ = tasks[index]
+            results[name, i] = util.from_shared_memory(payload, blocks)
+            log.user(f'{len(results)}/{len(tasks)}: {name} term {i} in {seconds:.2e} seconds')
+
+        log.user(f'integrating {len(tasks)} terms on {min(nprocs, len(tasks))} processes')
+        with sharedmem.MapReduce(np=nprocs) as pool:
+            pool.map(work, range(len(tasks)), reduce=collect)
+
+        for name, value in self.integrals.items():
+            if isinstance(value, AffineIntegral):
+                value.values = [results.get((name, i), itg) for i, itg in enumerate(value.values)]
+
     def ensure_shareable(self):
-        for value in self.integrals.values():
-            value.ensure_shareable()
+        # Integrals not yet read are read straight into shared memory
+        with util.shared_reads():
+            for value in self.integrals.values():
+                value.ensure_shareable()
 
     def lift(self, mu):
         return self['lift'](mu)
@@ -392,8 +489,8 @@ class HifiCase(Case):
         self.bases = Bases()
         super().__init__(*args, **kwargs)
 
-    def _read(self, group, sparse):
-        super()._read(group, sparse)
+    def _read(self, group, sparse, lazy=False):
+        super()._read(group, sparse, lazy=lazy)
         self.parameters = Parameters.read(group['parameters'])
 
         self.meta = {}
@@ -416,6 +513,36 @@ class HifiCase(Case):
         return self.bases[name].obj
 
 
+class ReducedDomain:
+
+    def __init__(self, domain, elements, weights=None):
+        self.domain = domain
+        self.elements = np.asarray(elements, dtype=int)
+        if weights is None:
+            weights = np.ones(self.elements.shape)
+        self.weights = np.asarray(weights, dtype=float)
+        self._samples = {}
+
+    def write(self, group):
+        util.to_dataset(self.elements, group, 'elements')
+        util.to_dataset(self.weights, group, 'weights')
+
+    @staticmethod
+    def read(group, domain):
+        elements = util.from_dataset(group['elements'])
+        weights = util.from_dataset(group['weights'])
+        return ReducedDomain(domain, elements, weights)
+
+    def sample(self, *args):
+        if args not in self._samples:
+            self._samples[args] = subsample(self.domain.sample(*args), self.elements, self.weights)
+        return self._samples[args]
+
+    def integrate(self, funcs, ischeme='gauss9', arguments=None):
+        sample = self.sample(*element.parse_legacy_ischeme(ischeme))
+        return sample.integrate(funcs, **(arguments or {}))
+
+
 class NutilsCase(HifiCase):
 
     _ident_ = 'NutilsCase'
@@ -426,6 +553,7 @@ class NutilsCase(HifiCase):
         self.meta['vscheme'] = vscheme
         self.domain = domain
         self.refgeom = refgeom
+        self.reduced_domain = None
 
         # For two-dimensional geometries we pre-compute triangulation and meshlines
         if geometry.shape == (2,):
@@ -442,13 +570,31 @@ class NutilsCase(HifiCase):
         util.to_dataset(self.refgeom, group, 'refgeom')
         if hasattr(self, '_exact_solutions'):
             util.to_dataset(self._exact_solutions, group, 'exact_solutions')
+        if self.reduced_domain is not None:
+            self.reduced_domain.write(group.require_group('reduced_domain'))
 
-    def _read(self, group, sparse):
-        super()._read(group, sparse)
+    def _read(self, group, sparse, lazy=False):
+        super()._read(group, sparse, lazy=lazy)
         self.domain = util.from_dataset(group['domain'])
         self.refgeom = util.from_dataset(group['refgeom'])
         if 'exact_solutions' in group.keys():
             self._exact_solutions = util.from_dataset(group['exact_solutions'])
+        self.reduced_domain = None
+        if 'reduced_domain' in group.keys():
+            self.reduced_domain = ReducedDomain.read(group['reduced_domain'], self.domain)
+
+    def reduce_domain(self, elements, weights=None):
+        if elements is None:
+            self.reduced_domain = None
+        else:
+            self.reduced_domain = ReducedDomain(self.domain, elements, weights)
+        memo.clear()
+
+    @property
+    def integration_domain(self):
+        if self.reduced_domain is not None:
+            return self.reduced_domain
+        return self.domain
 
     def shape(self, field):
         return self.bases[field].obj.shape[1:]
@@ -572,10 +718,10 @@ class LofiCase(Case):
         subgroup = group.require_group('hifi')
         self.case.write(subgroup, sparse=True)
 
-    def _read(self, group, sparse=False):
-        super()._read(group, sparse=sparse)
+    def _read(self, group, sparse=False, lazy=False):
+        super()._read(group, sparse=sparse, lazy=lazy)
         self.projection = group['projection'][:]
-        self.case = Case.read(group['hifi'], sparse=True)
+        self.case = Case.read(group['hifi'], sparse=True, lazy=lazy)
 
     @util.multiple_to_single('field')
     def solution(self, lhs, field, mu=None, *args, **kwargs):
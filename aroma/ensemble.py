@@ -37,7 +37,7 @@
 # written agreement between you and SINTEF Digital.
 
 
-from itertools import repeat, count
+from itertools import repeat, count, islice
 from multiprocessing import Pool
 import numpy as np
 from nutils import log
@@ -62,9 +62,25 @@ class Ensemble(dict):
     def __init__(self, scheme):
         self.scheme = scheme
 
+    def extend(self, scheme):
+        """Append the points of another scheme.  The weights of both are
+        scaled by their share of the total number of points, and solutions
+        already computed are kept."""
+        nold, nnew = len(self.scheme), len(scheme)
+        total = nold + nnew
+        scheme = np.array(scheme, dtype=float)
+        scheme[:,0] *= nnew / total
+        self.scheme = np.vstack([self.scheme, scheme])
+        self.scheme[:nold,0] *= nold / total
+
     def compute(self, name, case, solver, parallel=False, args=None, kwargs=None, time=False):
-        quadrule = [case.parameter(*mu) for mu in self.scheme[:,1:]]
-        args = repeat(()) if args is None else zip(*args)
+        # Only solve for points appended after an existing ensemble was computed
+        start = 0
+        if not time and name in self and len(self[name]) < len(self.scheme):
+            start = len(self[name])
+
+        quadrule = [case.parameter(*mu) for mu in self.scheme[start:,1:]]
+        args = repeat(()) if args is None else islice(zip(*args), start, None)
         kwargs = {} if kwargs is None else kwargs
         log.user(f'generating ensemble of {len(quadrule)} solutions')
         if not parallel:
@@ -87,16 +103,18 @@ class Ensemble(dict):
                 for (wt, *prev), sols in zip(self.scheme, solutions)
                 for (mu, __) in sols
             ])
+        elif start:
+            self[name] = np.vstack([self[name], solutions])
         else:
             self[name] = np.array(solutions)
 
         return meantime
 
     def write(self, group):
-        group['scheme'] = self.scheme
+        util.write_array(group, 'scheme', self.scheme)
         sub = group.require_group('data')
         for key, value in self.items():
-            sub[key] = value
+            util.write_array(sub, key, value)
 
     @staticmethod
     def read(group):
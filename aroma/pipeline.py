@@ -0,0 +1,188 @@
+# Copyright (C) 2014 SINTEF ICT,
+# Applied Mathematics, Norway.
+#
+# Contact information:
+# E-mail: eivind.fonn@sintef.no
+# SINTEF Digital, Department of Applied Mathematics,
+# P.O. Box 4760 Sluppen,
+# 7045 Trondheim, Norway.
+#
+# This file is part of AROMA.
+#
+# AROMA is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AROMA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with AROMA. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# In accordance with Section 7(b) of the GNU General Public License, a
+# covered work must retain the producer line in every data file that
+# is created or manipulated using AROMA.
+#
+# Other Usage
+# You can be released from the requirements of the license by purchasing
+# a commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities involving the AROMA library without
+# disclosing the source code of your own applications.
+#
+# This file may be used in accordance with the terms contained in a
+# written agreement between you and SINTEF Digital.
+
+
+from collections import OrderedDict
+from itertools import product
+import click
+import inspect
+import string
+from nutils import log, config
+import sharedmem
+
+from aroma import util
+
+
+class Stage:
+
+    def __init__(self, pipeline, func, fmt):
+        self.name = func.__name__
+        self.func = func
+        self.fmt = fmt
+
+        # Arguments named after earlier stages receive their results, and
+        # the parameters of those stages become parameters of this one
+        signature = inspect.signature(func)
+        self.requires = [name for name in signature.parameters if name in pipeline.stages]
+        self.parameters = OrderedDict()
+        for name in self.requires:
+            for param in pipeline.stages[name].parameters.values():
+                self.parameters.setdefault(param.name, param)
+        for param in signature.parameters.values():
+            if param.name not in self.requires:
+                self.parameters[param.name] = param.replace(kind=inspect.Parameter.KEYWORD_ONLY)
+
+        # Jobs differing in a parameter missing from the filename would
+        # write to the same file
+        fields = [field for __, field, __, __ in string.Formatter().parse(fmt)]
+        missing = [name for name in self.parameters if name not in fields]
+        if missing:
+            missing = ', '.join(missing)
+            raise ValueError(f"Filename of stage '{self.name}' lacks parameters: {missing}")
+
+        self.pipeline = pipeline
+        self.arguments = list(signature.parameters)
+
+        # The cached function takes all parameters as keyword arguments,
+        # but is hashed and named after the stage function
+        def compute(**kwargs):
+            args = {name: pipeline.stages[name](**kwargs) for name in self.requires}
+            args.update((name, kwargs[name]) for name in self.arguments if name not in args)
+            return func(**args)
+        compute.__signature__ = self.signature = inspect.Signature(self.parameters.values())
+        compute.__wrapped__ = func
+        compute.__name__, compute.__qualname__ = func.__name__, func.__qualname__
+        compute.__module__ = func.__module__
+        self._cached = util.filecache(fmt)(compute)
+
+    def bind(self, **kwargs):
+        kwargs = {name: value for name, value in kwargs.items() if name in self.parameters}
+        binding = self.signature.bind(**kwargs)
+        binding.apply_defaults()
+        return dict(binding.arguments)
+
+    def filename(self, **kwargs):
+        return util.make_filename(self._cached, self.fmt, **self.bind(**kwargs))
+
+    def __call__(self, **kwargs):
+        return self._cached(**self.bind(**kwargs))
+
+
+class Pipeline:
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def stage(self, fmt):
+        def decorator(func):
+            stage = Stage(self, func, fmt)
+            self.stages[stage.name] = stage
+            return stage
+        return decorator
+
+    def get(self, name, **kwargs):
+        return self.stages[name](**kwargs)
+
+    def jobs(self, *targets, **kwargs):
+        # All the stage invocations needed for the targets, with list
+        # parameters expanded, grouped in levels that can run concurrently
+        levels = {}
+
+        def add(name, params):
+            stage = self.stages[name]
+            params = stage.bind(**params)
+            key = (name, tuple(sorted(params.items())))
+            if key not in levels:
+                levels[key] = 1 + max((add(req, params) for req in stage.requires), default=-1)
+            return levels[key]
+
+        for name in targets:
+            stage = self.stages[name]
+            names = [n for n in stage.parameters if isinstance(kwargs.get(n), list)]
+            for values in product(*(kwargs[n] for n in names)):
+                add(name, {**kwargs, **dict(zip(names, values))})
+
+        retval = [[] for __ in range(max(levels.values(), default=-1) + 1)]
+        for (name, params), level in levels.items():
+            retval[level].append((name, dict(params)))
+        return retval
+
+    def run(self, *targets, nprocs=1, **kwargs):
+        def work(job):
+            name, params = job
+            stage = self.stages[name]
+            stage(**params)
+            util.wait_for_write(stage.filename(**params))
+
+        for level, jobs in enumerate(self.jobs(*targets, **kwargs)):
+            log.user(f'level {level}: {len(jobs)} stages')
+            if nprocs > 1 and len(jobs) > 1:
+                with sharedmem.MapReduce(np=nprocs) as pool:
+                    pool.map(work, jobs)
+            else:
+                for job in jobs:
+                    work(job)
+
+    def cli(self):
+        @click.group()
+        def main():
+            pass
+        for stage in self.stages.values():
+            main.command(stage.name)(self._command(stage))
+        return main
+
+    def _command(self, stage):
+        # Options given more than once are swept over
+        def command(**kwargs):
+            for name, value in kwargs.items():
+                if isinstance(value, tuple):
+                    kwargs[name] = list(value) if len(value) > 1 else value[0]
+            self.run(stage.name, nprocs=config.nprocs, **kwargs)
+
+        command = util.common_args(command)
+        for param in reversed(stage.parameters.values()):
+            kwargs = {} if param.annotation is param.empty else {'type': param.annotation}
+            if param.annotation is bool:
+                option = click.option(f'--{param.name}/--no-{param.name}', default=param.default)
+            elif param.default is param.empty:
+                option = click.option(f'--{param.name}', required=True, multiple=True, **kwargs)
+            else:
+                default = (param.default,)
+                option = click.option(f'--{param.name}', default=default, multiple=True, **kwargs)
+            command = option(command)
+        return command
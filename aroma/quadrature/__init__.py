@@ -38,18 +38,29 @@
 
 
 from functools import reduce
-from itertools import product
 import numpy as np
+from scipy.stats import qmc
 from . import quadpy
 
 
-def _combine(points, weights):
-    points = np.array(list(points))
-    weights = np.array(list(weights))[:,np.newaxis]
-    return np.hstack((weights, points))
+def _tensor(points, weights, chunksize=None):
+    shape = tuple(len(pts) for pts in points)
+    if chunksize is None:
+        points = [pts.ravel() for pts in np.meshgrid(*points, indexing='ij')]
+        weights = reduce(np.multiply, np.ix_(*weights)).ravel()
+        return np.column_stack([weights, *points])
+    return _tensor_chunks(points, weights, shape, chunksize)
 
 
-def uniform(intervals, npts):
+def _tensor_chunks(points, weights, shape, chunksize):
+    total = int(np.prod(shape))
+    for start in range(0, total, chunksize):
+        ix = np.unravel_index(np.arange(start, min(start + chunksize, total)), shape)
+        wts = reduce(np.multiply, (wt[i] for wt, i in zip(weights, ix)))
+        yield np.column_stack([wts, *(pts[i] for pts, i in zip(points, ix))])
+
+
+def uniform(intervals, npts, chunksize=None):
     ndims = len(intervals)
     if isinstance(npts, int):
         npts = (npts,) * ndims
@@ -59,13 +70,10 @@ def uniform(intervals, npts):
         points.append(np.linspace(a, b, n))
         weights.append(np.ones((n,)) * (b - a) / n)
 
-    return _combine(
-        product(*points),
-        map(np.product, product(*weights))
-    )
+    return _tensor(points, weights, chunksize)
 
 
-def full(intervals, npts):
+def full(intervals, npts, chunksize=None):
     ndims = len(intervals)
     if isinstance(npts, int):
         npts = (npts,) * ndims
@@ -76,10 +84,17 @@ def full(intervals, npts):
         points.append((pts + 1)/2 * (b - a) + a)
         weights.append(wts/2 * (b - a))
 
-    return _combine(
-        product(*points),
-        map(np.product, product(*weights))
-    )
+    return _tensor(points, weights, chunksize)
+
+
+def _levels(ndims, nlevels):
+    # Multi-indices with sum less than nlevels, in lexicographic order
+    if ndims == 0:
+        yield ()
+        return
+    for first in range(nlevels):
+        for rest in _levels(ndims - 1, nlevels - first):
+            yield (first, *rest)
 
 
 def sparse(intervals, npts):
@@ -104,22 +119,68 @@ def sparse(intervals, npts):
     points = np.array([(points + 1)/2 * (b - a) + a for a, b in intervals])
     weights = [[w/2 * (b - a) for w in weights] for a, b in intervals]
 
-    # Compute total weights
-    total_weights = np.zeros((npts,) * ndims)
-    for levels in product(range(nlevels), repeat=ndims):
-        if sum(levels) >= nlevels:
-            continue
+    # Collect the contributions of each admissible level combination, by
+    # flat index into the full grid, and sum them
+    indices, contribs = [], []
+    for levels in _levels(ndims, nlevels):
         wts = [weights[i][l] for i, l in enumerate(levels)]
         wts = reduce(np.multiply, np.ix_(*wts))  # multi-outer product
-        assign = tuple(slice(None, dim) for dim in wts.shape)
-        total_weights[assign] += wts
-
-    total = list(
-        (tuple(points[i][j] for i, j in enumerate(ix)), total_weights[ix])
-        for ix in product(range(npts), repeat=ndims)
-        if total_weights[ix] != 0.0
-    )
-
-    points = (a for a, _ in total)
-    weights = (b for _, b in total)
-    return _combine(points, weights)
+        grid = np.indices(wts.shape).reshape(ndims, -1)
+        indices.append(np.ravel_multi_index(grid, (npts,) * ndims))
+        contribs.append(wts.ravel())
+    indices, inverse = np.unique(np.concatenate(indices), return_inverse=True)
+    total_weights = np.bincount(inverse, weights=np.concatenate(contribs))
+
+    nonzero = total_weights != 0.0
+    ix = np.unravel_index(indices[nonzero], (npts,) * ndims)
+    return np.hstack([
+        total_weights[nonzero, np.newaxis],
+        np.array([pts[i] for pts, i in zip(points, ix)]).T,
+    ])
+
+
+def _sample(intervals, points):
+    lower, upper = np.array(intervals, dtype=float).T
+    weights = np.full((len(points),), np.prod(upper - lower) / max(len(points), 1))
+    return np.column_stack([weights, lower + points * (upper - lower)])
+
+
+def sobol(intervals, npts, start=0, scramble=True, seed=0):
+    """Points start, ..., start+npts-1 of a Sobol sequence.  Each point has
+    weight equal to the volume divided by npts."""
+    # The sequence is only balanced in blocks of a power of two points, so
+    # draw the smallest such block from the beginning that holds them all
+    sampler = qmc.Sobol(len(intervals), scramble=scramble, seed=seed)
+    points = sampler.random_base2((start + npts - 1).bit_length())
+    return _sample(intervals, points[start:start+npts])
+
+
+def halton(intervals, npts, start=0, scramble=True, seed=0):
+    """Points start, ..., start+npts-1 of a Halton sequence."""
+    sampler = qmc.Halton(len(intervals), scramble=scramble, seed=seed)
+    if start:
+        sampler.fast_forward(start)
+    return _sample(intervals, sampler.random(npts))
+
+
+def _lhs(ndims, npts, scramble, seed):
+    # Nested Latin hypercube: the strata are halved at each level, and the
+    # new points fill the strata left empty by the previous ones, so that
+    # every prefix of length 2**k is a Latin hypercube
+    rng = np.random.default_rng(seed)
+    offset = rng.random if scramble else (lambda shape: np.full(shape, 0.5))
+    points = offset((1, ndims))
+    while len(points) < npts:
+        nstrata = 2 * len(points)
+        strata = np.floor(points * nstrata).astype(int)
+        free = strata ^ 1
+        new = np.column_stack([rng.permutation(col) for col in free.T])
+        points = np.vstack([points, (new + offset(new.shape)) / nstrata])
+    return points[:npts]
+
+
+def lhs(intervals, npts, start=0, scramble=True, seed=0):
+    """Points start, ..., start+npts-1 of a nested Latin hypercube sample.
+    With scramble=False, points lie at the centers of their strata."""
+    points = _lhs(len(intervals), start + npts, scramble, seed)
+    return _sample(intervals, points[start:])
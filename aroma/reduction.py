@@ -38,12 +38,26 @@
 
 
 from collections import OrderedDict, namedtuple
+from itertools import product
 import numpy as np
+import scipy.sparse as sparse
 from scipy.linalg import eigh
+from scipy.sparse.linalg import splu
 import matplotlib.figure        # force module to load
 from nutils import log, export, _, function as fn
 
+from aroma import solvers
+from aroma.affine import Affine, AffineIntegral, MuConstant, integrands
 from aroma.case import LofiCase
+from aroma.ensemble import Ensemble
+
+
+def _truncation_error(eigvals, ndofs):
+    # The relative error of keeping the first ndofs of the descending
+    # eigenvalues, from the discarded ones rather than as one minus the
+    # kept ones, which cancels.  Eigenvalues are clamped at zero.
+    eigvals = np.maximum(eigvals, 0.0)
+    return np.sqrt(np.sum(eigvals[ndofs:]) / np.sum(eigvals))
 
 
 ReducedBasis = namedtuple('ReducedBasis', ['parent', 'ensemble', 'ndofs', 'norm', 'clean'])
@@ -147,7 +161,7 @@ class EigenReducer(Reducer):
 
                 eigvals = eigvals[::-1]
                 eigvecs = eigvecs[:,::-1]
-                self.meta[f'err-{name}'] = np.sqrt(1.0 - np.sum(eigvals[:basis.ndofs]) / np.sum(alleigs))
+                self.meta[f'err-{name}'] = _truncation_error(alleigs, basis.ndofs)
                 self._spectra[name] = alleigs
                 del alleigs
 
@@ -178,7 +192,7 @@ class EigenReducer(Reducer):
                 log.user('Sub-ndofs:', ', '.join(str(n) for n in nums))
 
                 allevs_np = np.array([ev for __, ev in allevs])
-                self.meta[f'err-{name}'] = np.sqrt(1.0 - np.sum(allevs_np[:basis.ndofs]) / np.sum(allevs_np))
+                self.meta[f'err-{name}'] = _truncation_error(allevs_np, basis.ndofs)
                 for i, evals in enumerate(eigvals):
                     self._spectra[f'{name}({i})'] = evals
 
@@ -231,3 +245,253 @@ class EigenReducer(Reducer):
         filename = f'{filename}.csv'
         np.savetxt(filename, data)
         log.user(filename)
+
+
+def _affine_terms(itg):
+    # The (scale, value) pairs of an affine function, or None
+    if isinstance(itg, MuConstant):
+        return [(itg.scale, itg.obj)]
+    if isinstance(itg, Affine):
+        return [(itg.scale * scale, value) for scale, value in itg]
+    return None
+
+
+def _orthonormal_factor(vecs, mx):
+    # A matrix F with F^T F = vecs^T mx vecs, from the coefficients of vecs
+    # in an mx-orthonormal basis of their span, built by Gram-Schmidt with
+    # reorthogonalization.  Norms evaluated as |F c| are accurate down to
+    # rounding, whereas c^T (vecs^T mx vecs) c loses half the digits to
+    # cancellation when the norm is small.
+    basis, factor = np.zeros((vecs.shape[0], 0)), np.zeros((0, vecs.shape[1]))
+    for j, vec in enumerate(vecs.T):
+        vec, coeffs = vec.copy(), np.zeros((basis.shape[1],))
+        for __ in range(2):
+            proj = basis.T @ (mx @ vec)
+            vec -= basis @ proj
+            coeffs += proj
+        factor[:,j] = coeffs
+        norm = np.sqrt(max(vec @ (mx @ vec), 0.0))
+        if norm > 1e-12 * np.sqrt(max(vecs[:,j] @ (mx @ vecs[:,j]), 0.0)):
+            basis = np.column_stack([basis, vec / norm])
+            factor = np.vstack([factor, np.zeros((1, vecs.shape[1]))])
+            factor[-1,j] = norm
+    return factor
+
+
+class ResidualEstimator:
+    """Estimates the error of reduced solutions by the dual norm of the
+    high fidelity residual, divided by a lower bound of the stability
+    constant of the high fidelity problem.
+
+    If the residual function lists its affine terms, the dual norm is
+    evaluated from the coefficients of the terms contracted with the
+    reduced basis in an orthonormal basis of their Riesz representers,
+    which are computed once per basis.  Otherwise the high fidelity
+    residual is assembled at every point.
+
+    The stability constant is the smallest singular value of the linear
+    part of the residual (see solvers.stability), and its lower bound is
+    the minimum over the parameter values mus, computed once.  These should
+    be the points where errors are estimated.  For Navier-Stokes flow this
+    is a heuristic.  Without residual terms or mus, or if the constant is
+    zero, the dual norm is not scaled."""
+
+    def __init__(self, case, residual, norms, mus=()):
+        self.case = case
+        self.residual = residual
+
+        # The dual norm is taken with respect to the sum of the given norms,
+        # restricted to the free dofs they cover
+        mu = case.parameter()
+        mx = sparse.csr_matrix(sum(sparse.csr_matrix(case[name](mu)) for name in norms))
+        self.free = np.isnan(case.constraints) & (mx.diagonal() != 0)
+        self._norm = mx[self.free][:,self.free].tocsc()
+        self._factor = splu(self._norm)
+
+        self.terms = self._terms(getattr(residual, 'terms', None))
+        self.stability = self._stability(getattr(residual, 'terms', None), mus)
+        self.projection = None
+
+    def _terms(self, terms):
+        # The residual terms as (sign, integral terms, contraction), or
+        # None if some integral or the lift is not affine
+        if terms is None:
+            return None
+        lift = _affine_terms(self.case.integrals['lift'])
+        retval = []
+        for sign, name, cont in terms:
+            if name not in self.case:
+                continue
+            itg = self.case.integrals[name]
+            if not isinstance(itg, AffineIntegral) or ('lift' in cont and lift is None):
+                return None
+            retval.append((sign, _affine_terms(itg), cont))
+        return retval
+
+    def _stability(self, terms, mus):
+        # Offline: the minimum of the stability constant over mus
+        if terms is None or not len(mus):
+            return None
+        values, v0 = [], None
+        for mu in log.iter('parameter', list(mus)):
+            value, v0 = solvers.stability(self.case, mu, terms, self._norm, self.free, v0=v0)
+            values.append(value)
+        if min(values) <= 0.0:
+            log.warning('the residual is singular, so the error estimate is not scaled')
+            return None
+        return min(values)
+
+    def project(self, projection):
+        # Offline: each combination of integral and lift terms contributes
+        # columns multiplied by a scale and the coefficients of the reduced
+        # solution in the 'lhs' slots
+        self.projection = projection
+        if self.terms is None:
+            return
+        lift = _affine_terms(self.case.integrals['lift'])
+        nred = len(projection)
+        blocks, self._scales = [], []
+        for sign, itgterms, cont in self.terms:
+            liftslots = [i for i, c in enumerate(cont) if c == 'lift']
+            lhsslots = [i for i, c in enumerate(cont) if c == 'lhs']
+            test = cont.index(None)
+            for (scale, value), *lifts in product(itgterms, *([lift] * len(liftslots))):
+                for (lscale, __) in lifts:
+                    scale = scale * lscale
+                columns = []
+                for combo in product(range(nred), repeat=max(len(lhsslots) - 1, 0)):
+                    vecs = dict(zip(liftslots, (lvalue for __, lvalue in lifts)))
+                    vecs.update(zip(lhsslots, (projection[i] for i in combo)))
+                    subcont = tuple(vecs.get(i) for i in range(len(cont)))
+                    obj, = integrands.integrate(value.get(subcont))
+                    if not lhsslots:
+                        columns.append(np.asarray(obj).reshape(-1, 1))
+                        continue
+                    if test > lhsslots[-1]:
+                        obj = obj.T
+                    columns.append(np.asarray(obj @ projection.T))
+                blocks.append(np.hstack(columns)[self.free])
+                self._scales.append((sign * scale, len(lhsslots)))
+
+        residuals = np.hstack(blocks)
+        self._riesz = _orthonormal_factor(self._factor.solve(residuals), self._norm)
+
+    def coefficients(self, mu, lhs):
+        coeffs = []
+        for scale, nlhs in self._scales:
+            coeff = np.array([scale(mu)])
+            for __ in range(nlhs):
+                coeff = np.kron(coeff, lhs)
+            coeffs.append(coeff)
+        return np.concatenate(coeffs)
+
+    def dual_norm(self, mu, lhs):
+        if self.terms is None:
+            residual = self.residual(self.case, mu, self.projection.T.dot(lhs))[self.free]
+            return np.sqrt(max(residual @ self._factor.solve(residual), 0.0))
+        return np.linalg.norm(self._riesz @ self.coefficients(mu, lhs))
+
+    def __call__(self, mus, lhss):
+        # Online: lhss are the coefficients of the reduced solutions
+        errors = np.array([self.dual_norm(mu, lhs) for mu, lhs in zip(mus, lhss)])
+        if self.stability is not None:
+            errors /= self.stability
+        return errors
+
+
+class GreedyReducer(EigenReducer):
+
+    def __init__(self, case, scheme, solver, residual, tol=1e-4, nsnapshots=20,
+                 batchsize=32, initial=0, name='solutions'):
+        self.ensemble = Ensemble(np.zeros((0, scheme.shape[1])))
+        super().__init__(case, self.ensemble)
+        self.scheme = scheme
+        self.solver = solver
+        self.residual = residual
+        self.tol = tol
+        self.nsnapshots = nsnapshots
+        self.batchsize = batchsize
+        self.initial = initial
+        self.name = name
+        self.selected = []
+        self.errors = []
+        self._derived = []
+        self._requested = OrderedDict()
+
+    def add_ensemble(self, name, solver, *args):
+        """Compute a further ensemble at each selected point, passing the
+        named ensembles at that point as arguments to the solver."""
+        self._derived.append((name, solver, args))
+
+    def add_basis(self, name, parent, ensemble, ndofs, norm, clean=True):
+        self._requested[name] = ReducedBasis(parent, ensemble, ndofs, norm, clean)
+
+    def _add_snapshot(self, index):
+        case, ensemble = self.case, self.ensemble
+        self.selected.append(index)
+        ensemble.extend(self.scheme[index:index+1])
+        ensemble.compute(self.name, case, self.solver)
+        for name, solver, args in self._derived:
+            ensemble.compute(name, case, solver, args=[ensemble[arg] for arg in args])
+
+        # The projections are recomputed from the extended ensemble, with as
+        # many modes as there are snapshots, up to the number requested
+        nsnaps = len(self.selected)
+        self._ensembles = {
+            key: ens * ensemble.scheme[:,0,np.newaxis]
+            for key, ens in ensemble.items()
+        }
+        self._bases = OrderedDict(
+            (name, basis._replace(ndofs=min(basis.ndofs, nsnaps * (
+                1 if isinstance(basis.ensemble, str) else len(basis.ensemble)
+            ))))
+            for name, basis in self._requested.items()
+        )
+        if hasattr(self, '_projections'):
+            del self._projections
+
+    def estimator(self):
+        norms = set()
+        for basis in self._requested.values():
+            bnorms = (basis.norm,) if isinstance(basis.norm, str) else basis.norm
+            norms |= {f'{basis.parent}-{norm}' for norm in bnorms}
+        mus = [self.case.parameter(*mu) for mu in self.scheme[:,1:]]
+        return ResidualEstimator(self.case, self.residual, sorted(norms), mus)
+
+    def estimate(self, rcase, estimator=None):
+        if estimator is None:
+            estimator = self.estimator()
+        estimator.project(rcase.projection)
+        case, errors = self.case, []
+        starts = range(0, len(self.scheme), self.batchsize)
+        for start in log.iter('batch', starts, length=len(starts)):
+            mus = [case.parameter(*mu) for mu in self.scheme[start:start+self.batchsize,1:]]
+            lhss, batch = [], np.full((len(mus),), np.inf)
+            for mu in mus:
+                try:
+                    lhss.append(self.solver(rcase, mu))
+                except solvers.IterationCountError:
+                    lhss.append(None)
+
+            # Points where the reduced solver fails are considered worst
+            solved = [i for i, lhs in enumerate(lhss) if lhs is not None]
+            if solved:
+                batch[solved] = estimator([mus[i] for i in solved], [lhss[i] for i in solved])
+            errors.extend(batch)
+        return np.array(errors)
+
+    def __call__(self, overrides={}, **kwargs):
+        estimator = self.estimator()
+        index = self.initial
+        while True:
+            with log.context(f'snapshot {len(self.selected) + 1}'):
+                self._add_snapshot(index)
+                rcase = super().__call__(overrides, **kwargs)
+                errors = self.estimate(rcase, estimator)
+
+            errors[self.selected] = 0.0
+            index = int(np.argmax(errors))
+            self.errors.append(errors[index])
+            log.user(f'max error estimate: {errors[index]:.2e}')
+            if errors[index] < self.tol or len(self.selected) >= self.nsnapshots:
+                return rcase
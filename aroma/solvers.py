@@ -37,12 +37,24 @@
 # written agreement between you and SINTEF Digital.
 
 
+from collections import OrderedDict
 from itertools import count
+import inspect
+from weakref import WeakKeyDictionary
 import numpy as np
 import scipy as sp
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse.linalg import splu, spilu, gmres, minres, LinearOperator
 from nutils import function as fn, log, matrix
 
+try:
+    import pyamg
+    has_pyamg = True
+except ImportError:
+    has_pyamg = False
+
 from aroma.affine import integrate
+from aroma.case import HifiCase
 
 
 class IterationCountError(Exception):
@@ -70,6 +82,350 @@ def solve(mx, rhs, cons, solver='spsolve', **kwargs):
         return mx.solve(rhs, constrain=cons, solver=solver, **kwargs)
 
 
+class Factorization:
+
+    def __init__(self, mx, cons, solver='spsolve', **kwargs):
+        free = np.isnan(cons)
+        self.free = free
+        self.cons = np.where(free, 0.0, cons)
+
+        if isinstance(mx, np.matrix):
+            mx = np.array(mx)
+        if solver != 'spsolve' and not isinstance(mx, np.ndarray):
+            # Other solvers are only available through solve, which handles
+            # the constraints itself
+            self._offset = 0.0
+            self._solve = lambda rhs: self._dispatch(mx, rhs, solver, kwargs)
+        elif isinstance(mx, np.ndarray):
+            self._offset = mx[np.ix_(free, ~free)] @ self.cons[~free]
+            lu = lu_factor(mx[np.ix_(free, free)])
+            self._solve = lambda rhs: lu_solve(lu, rhs)
+        else:
+            mx = sp.sparse.csr_matrix(mx)[free]
+            self._offset = mx[:,~free] @ self.cons[~free]
+            self._solve = splu(mx[:,free].tocsc()).solve
+
+    def _dispatch(self, mx, rhs, solver, kwargs):
+        full = np.zeros(self.free.shape)
+        full[self.free] = rhs
+        cons = np.where(self.free, np.nan, self.cons)
+        return solve(mx, full, cons, solver=solver, **kwargs)[self.free]
+
+    def solve_free(self, rhs):
+        return self._solve(rhs - self._offset)
+
+    def __call__(self, rhs):
+        lhs = self.cons.copy()
+        lhs[self.free] = self.solve_free(rhs[self.free])
+        return lhs
+
+
+class LaggedJacobian:
+
+    def __init__(self, lag=1, stall=0.5, broyden=False):
+        self.lag = lag
+        self.stall = stall
+        self.broyden = broyden
+        self.stats = {'iterations': 0, 'factorizations': 0, 'steps': 0}
+        self._factorization = None
+        self._key = None
+
+    @property
+    def needs_factorization(self):
+        if self._factorization is None:
+            return True
+        return bool(self.lag) and self._age >= self.lag
+
+    def factorize(self, mx, cons, **kwargs):
+        self._factorization = Factorization(mx, cons, **kwargs)
+        self._age = 0
+        self._history = []
+        self._prev = None
+        self.stats['factorizations'] += 1
+
+    def new_step(self, key=None):
+        # The residual function changes between time steps, so secant pairs may not straddle them.
+        # The key identifies the parts of the Jacobian that are not lagged, such as the time step.
+        if key != self._key:
+            self._factorization = None
+            self._key = key
+        self._prev = None
+        self._prev_norm = None
+        self.stats['steps'] += 1
+
+    def _apply(self, rhs):
+        lhs = self._factorization.solve_free(rhs)
+        for u, y in self._history:
+            lhs += u * (y @ rhs)
+        return lhs
+
+    def solve(self, rhs):
+        fac = self._factorization
+        rhs = rhs[fac.free]
+
+        # Broyden's second method: rank-one update of the approximate inverse
+        # such that it maps the latest residual difference onto the latest step
+        if self.broyden and self._prev is not None:
+            prev_rhs, prev_step = self._prev
+            y = prev_rhs - rhs
+            yy = y @ y
+            if yy > 0.0:
+                self._history.append(((prev_step - self._apply(y)) / yy, y))
+
+        step = self._apply(rhs)
+        self._prev = (rhs, step)
+        self._age += 1
+        self.stats['iterations'] += 1
+
+        lhs = fac.cons.copy()
+        lhs[fac.free] = step
+        return lhs
+
+    def report(self, norm):
+        rate = None if self._prev_norm is None else norm / self._prev_norm
+        if rate is not None and self.stall is not None and rate > self.stall:
+            self._factorization = None
+        self._prev_norm = norm
+        return rate
+
+
+def _factorize_block(mx, precon, drop_tol=1e-4, fill_factor=10):
+    mx = mx.tocsc()
+    if precon == 'amg':
+        if not has_pyamg:
+            raise ImportError('AMG preconditioning requires pyamg')
+        return pyamg.smoothed_aggregation_solver(mx.tocsr()).aspreconditioner()
+    if precon == 'ilu':
+        return spilu(mx, drop_tol=drop_tol, fill_factor=fill_factor).solve
+    assert precon == 'lu'
+    return splu(mx).solve
+
+
+class SaddlePointSolver:
+
+    def __init__(self, case, mu, solver='gmres', precon=None, block='laplacian', tol=1e-10,
+                 atol=0.0, maxiter=1000, restart=50, **kwargs):
+        assert solver in ('gmres', 'minres')
+        assert block in ('laplacian', 'system')
+        if precon is None:
+            precon = 'amg' if has_pyamg else ('lu' if solver == 'minres' else 'ilu')
+
+        # MINRES needs a symmetric system and a symmetric preconditioner
+        if solver == 'minres' and precon == 'ilu':
+            raise ValueError('MINRES requires a symmetric preconditioner (amg or lu)')
+        if solver == 'minres' and block == 'system':
+            raise ValueError('MINRES cannot be used with the nonsymmetric system block')
+
+        self.solver = solver
+        self.precon = precon
+        self.block = block
+        self.tol = tol
+        self.atol = atol
+        self.maxiter = maxiter
+        self.restart = restart
+        self.kwargs = kwargs
+
+        # Extra dofs which belong to no basis (e.g. stabilization terms) are few,
+        # so they are left unpreconditioned
+        self.pmask = np.zeros((case.ndofs,), dtype=bool)
+        self.pmask[case.bases['p'].indices] = True
+        self.vmask = np.zeros((case.ndofs,), dtype=bool)
+        for basis in case.bases.values():
+            if basis.name != 'p':
+                self.vmask[basis.indices] = True
+        self.case, self.mu = case, mu
+        self._free = None
+
+    def _setup(self, free):
+        # Preconditioner blocks depend only on the constraints, so they are reused between calls
+        if self._free is not None and np.array_equal(free, self._free):
+            return
+        self._free = free
+        case, mu = self.case, self.mu
+        pmask, vmask = self.pmask[free], self.vmask[free]
+        self._vmask, self._pmask = vmask, pmask
+
+        # The Schur complement of a viscous saddle point problem scales with the inverse
+        # viscosity, estimated by comparing the laplacian against the H1 seminorm
+        vmass = sp.sparse.csr_matrix(case['v-h1s'](mu))[free][:,free][vmask][:,vmask]
+        lapl = sp.sparse.csr_matrix(case['laplacian'](mu))[free][:,free][vmask][:,vmask]
+        diag = vmass.diagonal()
+        nonzero = diag != 0.0
+        self.viscosity = np.mean(lapl.diagonal()[nonzero] / diag[nonzero])
+
+        pmass = sp.sparse.csr_matrix(case['p-l2'](mu))[free][:,free][pmask][:,pmask]
+        self._pmass = splu(pmass.tocsc()).solve
+        if self.block == 'laplacian':
+            self._vblock = _factorize_block(self.viscosity * vmass, self.precon, **self.kwargs)
+
+    def __call__(self, mx, rhs, cons):
+        if isinstance(mx, (np.ndarray, np.matrix)):
+            return solve(mx, rhs, cons)
+
+        free = np.isnan(cons)
+        self._setup(free)
+        vmask, pmask, nu = self._vmask, self._pmask, self.viscosity
+
+        lhs = np.where(free, 0.0, cons)
+        mx = sp.sparse.csr_matrix(mx)[free]
+        rhs = rhs[free] - mx[:,~free] @ lhs[~free]
+        mx = mx[:,free]
+
+        if self.block == 'laplacian':
+            vblock = self._vblock
+        else:
+            vblock = _factorize_block(mx[vmask][:,vmask], self.precon, **self.kwargs)
+
+        if self.solver == 'minres':
+
+            def precon(r):
+                z = r.copy()
+                z[vmask] = vblock(r[vmask])
+                z[pmask] = nu * self._pmass(r[pmask])
+                return z
+        else:
+            bt = mx[vmask][:,pmask]
+
+            def precon(r):
+                z = r.copy()
+                z[pmask] = -nu * self._pmass(r[pmask])
+                z[vmask] = vblock(r[vmask] - bt @ z[pmask])
+                return z
+        precon = LinearOperator(mx.shape, matvec=precon, dtype=mx.dtype)
+
+        niters = 0
+
+        def callback(*args):
+            nonlocal niters
+            niters += 1
+
+        kwargs = {_TOLKEY: self.tol, 'maxiter': self.maxiter, 'M': precon, 'callback': callback}
+        if self.solver == 'gmres':
+            kwargs['restart'] = self.restart
+            kwargs['atol'] = self.atol
+            if 'callback_type' in _GMRES_ARGS:
+                kwargs['callback_type'] = 'pr_norm'
+            sol, info = gmres(mx, rhs, **kwargs)
+        else:
+            if 'atol' in _MINRES_ARGS:
+                kwargs['atol'] = self.atol
+            sol, info = minres(mx, rhs, **kwargs)
+
+        # A negative status signals illegal input or a breakdown
+        if info < 0:
+            raise matrix.MatrixError(f'{self.solver} failed with status {info}')
+        if info > 0:
+            log.warning(f'{self.solver} did not converge in {niters} iterations')
+        else:
+            log.user(f'{self.solver} converged in {niters} iterations')
+
+        lhs[free] = sol
+        return lhs
+
+
+# Factorizations of pressure blocks, shared between calls on the same case
+_block_cache = WeakKeyDictionary()
+
+
+class BlockSolver:
+
+    def __init__(self, case, mu, divtol=1e-8, cachesize=16):
+        self.case = case
+        self.divtol = divtol
+        self.P = case.bases['p'].indices if 'p' in case.bases else np.arange(0)
+        self.U = np.setdiff1d(np.arange(case.ndofs), self.P)
+        self.V = case.bases['v'].indices if 'v' in case.bases else self.U
+        self.S = case.bases['s'].indices if 's' in case.bases else None
+
+        itg = case.integrals['divergence'] if 'divergence' in case else None
+        if itg is None:
+            self.key = None
+        else:
+            deps = set(itg.deps) | set(getattr(itg.scale, 'deps', ()))
+            self.key = tuple(float(mu[dep]) for dep in sorted(deps))
+        self.cache = _block_cache.setdefault(case, OrderedDict())
+        self.cachesize = cachesize
+
+    def _pressure_factor(self, bsp):
+        if self.key is None:
+            return lu_factor(bsp)
+        if self.key in self.cache:
+            block, factor = self.cache[self.key]
+            if np.array_equal(block, bsp):
+                self.cache.move_to_end(self.key)
+                return factor
+        factor = lu_factor(bsp)
+        self.cache[self.key] = (bsp, factor)
+        if len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+        return factor
+
+    def segregated(self, mx):
+        # Divergence-free velocity modes decouple from the pressure, which can
+        # then be recovered from the supremizer equations alone.  The
+        # supremizer/pressure factorization is used for both off-diagonal
+        # blocks, so they must be transposes of each other.
+        V, S, P = self.V, self.S, self.P
+        if S is None or len(S) != len(P) or len(P) == 0:
+            return False
+        ref = np.linalg.norm(mx[np.ix_(S, P)])
+        if np.linalg.norm(mx[np.ix_(P, S)] - mx[np.ix_(S, P)].T) > self.divtol * ref:
+            return False
+        return all(
+            np.linalg.norm(mx[np.ix_(rows, cols)]) <= self.divtol * ref
+            for rows, cols in [(V, P), (P, V), (P, P)]
+        )
+
+    def __call__(self, mx, rhs, cons):
+        if not isinstance(mx, (np.ndarray, np.matrix)) or not np.isnan(cons).all():
+            return solve(mx, rhs, cons)
+        mx = np.asarray(mx)
+        lhs = np.zeros_like(rhs)
+        U, V, S, P = self.U, self.V, self.S, self.P
+
+        if len(P) == 0:
+            lhs[U] = np.linalg.solve(mx[np.ix_(U, U)], rhs[U])
+
+        elif self.segregated(mx):
+            # Block triangular: supremizers from the continuity equation,
+            # velocities from the momentum equation and finally the pressure
+            # from the supremizer equation
+            factor = self._pressure_factor(mx[np.ix_(S, P)])
+            lhs[S] = lu_solve(factor, rhs[P], trans=1)
+            lhs[V] = np.linalg.solve(mx[np.ix_(V, V)], rhs[V] - mx[np.ix_(V, S)] @ lhs[S])
+            srhs = rhs[S] - mx[np.ix_(S, V)] @ lhs[V] - mx[np.ix_(S, S)] @ lhs[S]
+            lhs[P] = lu_solve(factor, srhs)
+
+        else:
+            # Pressure Schur complement, well conditioned when the velocity
+            # space is enriched with supremizers
+            factor = lu_factor(mx[np.ix_(U, U)])
+            bmx, btmx = mx[np.ix_(U, P)], mx[np.ix_(P, U)]
+            kb = lu_solve(factor, bmx)
+            kf = lu_solve(factor, rhs[U])
+            schur = mx[np.ix_(P, P)] - btmx @ kb
+            lhs[P] = np.linalg.solve(schur, rhs[P] - btmx @ kf)
+            lhs[U] = kf - kb @ lhs[P]
+
+        return lhs
+
+
+_GMRES_ARGS = inspect.signature(gmres).parameters
+_MINRES_ARGS = inspect.signature(minres).parameters
+_TOLKEY = 'rtol' if 'rtol' in _GMRES_ARGS else 'tol'
+
+
+def linear_solver(case, mu, solver='spsolve', **kwargs):
+    if solver in ('gmres', 'minres'):
+        return SaddlePointSolver(case, mu, solver=solver, **kwargs)
+    if solver == 'block':
+        return BlockSolver(case, mu, **kwargs)
+
+    def wrapper(mx, rhs, cons):
+        return solve(mx, rhs, cons, solver=solver, **kwargs)
+    return wrapper
+
+
 def _stokes_matrix(case, mu, div=True, **kwargs):
     matrix = case['laplacian'](mu)
     if div:
@@ -80,7 +436,8 @@ def _stokes_matrix(case, mu, div=True, **kwargs):
 
 
 def _stokes_rhs(case, mu, **kwargs):
-    rhs = - case['divergence'](mu, cont=('lift', None)) - case['laplacian'](mu, cont=(None, 'lift'))
+    div, lap = case.assemble(mu, ('divergence', ('lift', None)), ('laplacian', (None, 'lift')))
+    rhs = - div - lap
     if 'forcing' in case:
         rhs += case['forcing'](mu)
     if 'stab-lhs' in case:
@@ -94,22 +451,59 @@ def _stokes_assemble(case, mu, **kwargs):
     return _stokes_matrix(case, mu, **kwargs), _stokes_rhs(case, mu, **kwargs)
 
 
-def stokes(case, mu):
+def stokes(case, mu, **kwargs):
     assert 'divergence' in case
     assert 'laplacian' in case
 
     matrix, rhs = _stokes_assemble(case, mu)
-    lhs = solve(matrix, rhs, case.constraints)
+    lhs = linear_solver(case, mu, **kwargs)(matrix, rhs, case.constraints)
 
     return lhs
 
 
+def _residual(case, mu, lhs, terms):
+    terms = [(sign, name, cont) for sign, name, cont in terms if name in case]
+    values = case.assemble(mu, *(
+        (name, tuple(lhs if c == 'lhs' else c for c in cont))
+        for __, name, cont in terms
+    ))
+    return sum(sign * value for (sign, __, __), value in zip(terms, values))
+
+
+def stokes_residual(case, mu, lhs):
+    return _residual(case, mu, lhs, stokes_residual.terms)
+
+
+# The residual as a sum of signed integrals, with 'lhs' standing for the
+# solution, so that its affine structure is available to error estimators
+stokes_residual.terms = (
+    (1, 'forcing', (None,)),
+    (1, 'stab-rhs', (None,)),
+    (-1, 'divergence', ('lift', None)),
+    (-1, 'laplacian', (None, 'lift')),
+    (-1, 'stab-lhs', (None, 'lift')),
+    (-1, 'laplacian', (None, 'lhs')),
+    (-1, 'divergence', (None, 'lhs')),
+    (-1, 'divergence', ('lhs', None)),
+    (-1, 'stab-lhs', (None, 'lhs')),
+    (-1, 'stab-lhs', ('lhs', None)),
+)
+
+
 def navierstokes_conv(case, mu, lhs):
-    c = case['convection']
-    rh = c(mu, cont=(None, lhs, lhs))
-    lh = c(mu, cont=(None, lhs, None)) + c(mu, cont=(None, None, lhs))
-    rh, lh = integrate(rh, lh)
-    return rh, lh
+    rh, lha, lhb = case.assemble(
+        mu, ('convection', (None, lhs, lhs)),
+        ('convection', (None, lhs, None)), ('convection', (None, None, lhs)),
+    )
+    return rh, lha + lhb
+
+
+def _navierstokes_lift(case, mu):
+    lha, lhb, rh = case.assemble(
+        mu, ('convection', (None, 'lift', None)),
+        ('convection', (None, None, 'lift')), ('convection', (None, 'lift', 'lift')),
+    )
+    return lha + lhb, rh
 
 
 def navierstokes(case, mu, newton_tol=1e-10, maxit=10, **kwargs):
@@ -118,12 +512,14 @@ def navierstokes(case, mu, newton_tol=1e-10, maxit=10, **kwargs):
     assert 'convection' in case
     assert 'v-h1s' in case
 
+    linsolve = linear_solver(case, mu, **kwargs)
     stokes_mat, stokes_rhs = _stokes_assemble(case, mu)
-    lhs = solve(stokes_mat, stokes_rhs, case.constraints)
+    lhs = linsolve(stokes_mat, stokes_rhs, case.constraints)
 
     lift = case['lift'](mu)
-    stokes_mat += case['convection'](mu, cont=(None, 'lift', None)) + case['convection'](mu, cont=(None, None, 'lift'))
-    stokes_rhs -= case['convection'](mu, cont=(None, 'lift', 'lift'))
+    lh, rh = _navierstokes_lift(case, mu)
+    stokes_mat += lh
+    stokes_rhs -= rh
 
     vmass = case['v-h1s'](mu)
 
@@ -132,7 +528,7 @@ def navierstokes(case, mu, newton_tol=1e-10, maxit=10, **kwargs):
         rhs = stokes_rhs - stokes_mat @ lhs - rh
         ns_mat = stokes_mat + lh
 
-        update = solve(ns_mat, rhs, case.constraints, **kwargs)
+        update = linsolve(ns_mat, rhs, case.constraints)
         lhs += update
 
         update_norm = np.sqrt(update @ vmass @ update)
@@ -146,55 +542,129 @@ def navierstokes(case, mu, newton_tol=1e-10, maxit=10, **kwargs):
     return lhs
 
 
-def navierstokes_timestep(case, mu, dt, cursol, newton_tol=1e-10, maxit=10, tsolver='be', **kwargs):
-    assert tsolver in ('be', 'cn')
+def navierstokes_residual(case, mu, lhs):
+    return _residual(case, mu, lhs, navierstokes_residual.terms)
+
+
+navierstokes_residual.terms = stokes_residual.terms + (
+    (-1, 'convection', (None, 'lift', 'lift')),
+    (-1, 'convection', (None, 'lift', 'lhs')),
+    (-1, 'convection', (None, 'lhs', 'lift')),
+    (-1, 'convection', (None, 'lhs', 'lhs')),
+)
+
+
+# Backward differentiation coefficients, from the new solution backwards in time
+_BDF = {
+    1: (1.0, -1.0),
+    2: (3/2, -2.0, 1/2),
+    3: (11/6, -3.0, 3/2, -1/3),
+}
+
+_BDF_ORDER = {'be': 1, 'cn': 1, 'bdf2': 2, 'bdf3': 3}
+
+
+def bdf_coeffs(order, dts=()):
+    if order == 2 and dts:
+        # Variable step size, with dts the sizes of the new and the previous step
+        w = dts[0] / dts[1]
+        return ((1 + 2*w) / (1 + w), -(1 + w), w**2 / (1 + w))
+    return _BDF[order]
+
 
-    stokes_mat, stokes_rhs = _stokes_assemble(case, mu, div=(tsolver == 'be'))
-    stokes_mat += case['convection'](mu, lift=1) + case['convection'](mu, lift=2)
-    stokes_rhs -= case['convection'](mu, lift=(1,2))
+def _navierstokes_assemble(case, mu, **kwargs):
+    stokes_mat, stokes_rhs = _stokes_assemble(case, mu, **kwargs)
+    lh, rh = _navierstokes_lift(case, mu)
+    stokes_mat += lh
+    stokes_rhs -= rh
+    return stokes_mat, stokes_rhs
+
+
+def navierstokes_timestep(case, mu, dt, cursol, newton_tol=1e-10, maxit=10, tsolver='be',
+                          jacobian=None, prevsols=(), prevmu=None, coeffs=None, **kwargs):
+    assert tsolver in _BDF_ORDER
+
+    stokes_mat, stokes_rhs = _navierstokes_assemble(case, mu, div=(tsolver != 'cn'))
 
     if tsolver == 'cn':
-        # TODO: The computations here should be computed with the previous timestep's mu
-        # this technically assumes that the problem has no explicit time dependency
+        # The explicit half of the step is evaluated at the previous timestep's mu,
+        # which matters only if the problem has an explicit time dependency
         stokes_mat /= 2
-        stokes_rhs -= stokes_mat @ cursol
-        rh_cn = case['convection'](mu, cont=(None, cursol, cursol))
-        rh_cn, = integrate(rh_cn)
+        stokes_rhs /= 2
+        if prevmu is None:
+            prev_mat, prev_rhs = stokes_mat, stokes_rhs
+        else:
+            prev_mat, prev_rhs = _navierstokes_assemble(case, prevmu, div=False)
+            prev_mat /= 2
+            prev_rhs /= 2
+        stokes_rhs = stokes_rhs + prev_rhs - prev_mat @ cursol
+        convmu = mu if prevmu is None else prevmu
+        rh_cn, = case.assemble(convmu, ('convection', (None, cursol, cursol)))
         stokes_rhs -= rh_cn / 2
 
-    sys_mat = stokes_mat + case['v-l2'](mu) / dt
+    if coeffs is None:
+        order = min(_BDF_ORDER[tsolver], len(prevsols) + 1)
+        coeffs = bdf_coeffs(order)
+    assert len(coeffs) <= len(prevsols) + 2
+    a0, a1, *ak = coeffs
+
+    vmass_l2 = case['v-l2'](mu)
+    sys_mat = stokes_mat + vmass_l2 * (a0 / dt)
     if tsolver == 'cn':
         divmx = case['divergence'](mu, sym=True)
         sys_mat += divmx
 
+    # Time derivative contribution of the initial guess (the current solution) and the history
+    history = (a0 + a1) * cursol
+    for a, sol in zip(ak, prevsols):
+        history = history + a * sol
+    stokes_rhs -= vmass_l2 @ history / dt
+
     vmass_h1 = case['v-h1s'](mu)
     pmass_l2 = case['v-h1s'](mu)
-    vmass_l2 = case['v-l2'](mu)
 
     if 'mass-lift-dt' in case:
         stokes_rhs -= case['mass-lift-dt'](mu)
 
+    if jacobian is not None:
+        jacobian.new_step((tsolver, dt, tuple(coeffs)))
+
     lhs = np.copy(cursol)
     for it in count(1):
-        rh, lh = navierstokes_conv(case, mu, lhs)
+        refactor = jacobian is None or jacobian.needs_factorization
+        if refactor:
+            rh, lh = navierstokes_conv(case, mu, lhs)
+        else:
+            rh, = case.assemble(mu, ('convection', (None, lhs, lhs)))
 
         if tsolver == 'cn':
             rh /= 2
-            lh /= 2
+            if refactor:
+                lh /= 2
 
         rhs = stokes_rhs - stokes_mat @ lhs - rh
-        ns_mat = sys_mat + lh
 
         if tsolver == 'cn':
             rhs -= divmx @ lhs
 
-        update = solve(ns_mat, rhs, case.constraints, **kwargs)
+        if jacobian is None:
+            update = solve(sys_mat + lh, rhs, case.constraints, **kwargs)
+        else:
+            if refactor:
+                jacobian.factorize(sys_mat + lh, case.constraints, **kwargs)
+            update = jacobian.solve(rhs)
         lhs += update
-        stokes_rhs -= vmass_l2 @ update / dt
+        stokes_rhs -= vmass_l2 @ update * (a0 / dt)
 
         update_norm = np.sqrt(update @ vmass_h1 @ update)
         update_norm += np.sqrt(update @ pmass_l2 @ update)
-        log.user('update: {:.2e}'.format(update_norm))
+        if jacobian is None:
+            log.user('update: {:.2e}'.format(update_norm))
+        else:
+            rate = jacobian.report(update_norm)
+            rate = '--' if rate is None else '{:.2e}'.format(rate)
+            flag = ' (refactored)' if refactor else ''
+            log.user('update: {:.2e}, rate: {}{}'.format(update_norm, rate, flag))
         if update_norm < newton_tol:
             break
 
@@ -204,102 +674,156 @@ def navierstokes_timestep(case, mu, dt, cursol, newton_tol=1e-10, maxit=10, tsol
     return lhs
 
 
-def navierstokes_time(case, mu, dt=1e-2, nsteps=100, timename='time', initsol=None, **kwargs):
+def _lagged_jacobian(kwargs, lag=1, stall=0.5, broyden=False):
+    # A lagged Jacobian persists across time steps, since for small dt it hardly changes
+    if lag != 1 or broyden:
+        kwargs['jacobian'] = LaggedJacobian(lag=lag, stall=stall, broyden=broyden)
+    return kwargs
+
+
+def _log_jacobian(kwargs):
+    if 'jacobian' in kwargs:
+        stats = kwargs['jacobian'].stats
+        log.user(
+            '{steps} steps, {iterations} iterations, '
+            '{factorizations} factorizations'.format(**stats)
+        )
+
+
+def _initial_solution(case, mu, initsol):
+    if initsol is not None:
+        return initsol
+    stokes_mat, stokes_rhs = _stokes_assemble(case, mu)
+    return solve(stokes_mat, stokes_rhs, case.constraints)
+
+
+def navierstokes_time(case, mu, dt=1e-2, nsteps=100, timename='time', initsol=None, tsolver='be',
+                      lag=1, stall=0.5, broyden=False, **kwargs):
     assert 'divergence' in case
     assert 'laplacian' in case
     assert 'convection' in case
     assert 'v-h1s' in case
     assert 'v-l2' in case
 
-    if initsol is None:
-        stokes_mat, stokes_rhs = _stokes_assemble(case, mu)
-        lhs = solve(stokes_mat, stokes_rhs, case.constraints)
-    else:
-        lhs = initsol
-    vmass_h1 = case['v-h1s'](mu)
+    lhs = _initial_solution(case, mu, initsol)
+    kwargs = _lagged_jacobian(kwargs, lag, stall, broyden)
+
+    # Multistep methods start with lower order until enough history is available
+    history = []
+    nhistory = _BDF_ORDER[tsolver] - 1
+
+    # Reassembling at the previous step is only necessary with explicit time dependency
+    timedep = any(timename in getattr(itg, 'deps', ()) for itg in case.integrals.values())
 
     yield (mu, lhs)
     for istep in range(1, nsteps+1):
-        mu = dict(**mu)
+        prevmu, mu = mu, dict(**mu)
         mu[timename] += dt
+        prevmu = prevmu if timedep else None
         with log.context(f'Step {istep} (t = {mu[timename]:.2f})'):
-            lhs = navierstokes_timestep(case, mu, dt, lhs, **kwargs)
+            newlhs = navierstokes_timestep(
+                case, mu, dt, lhs, tsolver=tsolver, prevsols=history, prevmu=prevmu, **kwargs
+            )
+        history = [lhs, *history][:nhistory]
+        lhs = newlhs
         yield(mu, lhs)
 
+    _log_jacobian(kwargs)
 
-def blocksolve_velocity(vv, rhs, V):
-    lhs = np.zeros_like(rhs)
-    lhs[V] = matrix.NumpyMatrix(vv).solve(rhs[V])
-    return lhs
-
-
-def blocksolve_pressure(sp, rhs, S, P):
-    lhs = np.zeros_like(rhs)
-    lhs[P] = matrix.NumpyMatrix(sp).solve(rhs[S])
-    return lhs
-
-
-def navierstokes_block(case, mu, newton_tol=1e-10, maxit=10):
-    for itg in ['laplacian-vv', 'laplacian-sv', 'divergence-sp',
-                'convection-vvv', 'convection-svv']:
-        assert itg in case
-
-    nn = case.ndofs // 3
-    V = np.arange(nn)
-    S = np.arange(nn,2*nn)
-    P = np.arange(2*nn,3*nn)
 
-    # Assumption: divergence of lift is zero
-    stokes_rhs = np.zeros((case.ndofs,))
-    stokes_rhs[V] -= case['laplacian-vv'](mu, cont=(None, 'lift'))
-    stokes_rhs[S] -= case['laplacian-sv'](mu, cont=(None, 'lift'))
-
-    mvv = case['laplacian-vv'](mu)
-    msv = case['laplacian-sv'](mu)
-    msp = case['divergence-sp'](mu)
-    lhs = blocksolve_velocity(mvv, stokes_rhs, V)
-
-    mvv += (case['convection-vvv'](mu, cont=(None, 'lift', None)) +
-            case['convection-vvv'](mu, cont=(None, None, 'lift')))
-    msv += (case['convection-svv'](mu, cont=(None, 'lift', None)) +
-            case['convection-svv'](mu, cont=(None, None, 'lift')))
-
-    stokes_rhs[V] -= case['convection-vvv'](mu, cont=(None, 'lift', 'lift'))
-    stokes_rhs[S] -= case['convection-svv'](mu, cont=(None, 'lift', 'lift'))
-
-    vmass = case['v-h1s'](mu)
-
-    for it in count(1):
-        cc = case['convection-vvv']
-        nvv = mvv + cc(mu, cont=(None, lhs[V], None)) + cc(mu, cont=(None, None, lhs[V]))
-
-        rhs = stokes_rhs.copy()
-        rhs[V] -= mvv @ lhs[V]
-        rhs[V] -= case['convection-vvv'](mu, cont=(None, lhs[V], lhs[V]))
+def navierstokes_adaptive(case, mu, dt=1e-2, tmax=None, tol=1e-3, dtmin=1e-6, dtmax=None,
+                          safety=0.9, timename='time', initsol=None, lag=1, stall=0.5,
+                          broyden=False, **kwargs):
+    assert 'divergence' in case
+    assert 'laplacian' in case
+    assert 'convection' in case
+    assert 'v-h1s' in case
+    assert 'v-l2' in case
 
-        update = blocksolve_velocity(nvv, rhs, V)
-        lhs += update
+    if tmax is None:
+        tmax = case.parameters[timename].maximum
+    if dtmax is None:
+        dtmax = tmax - mu[timename]
 
-        update_norm = np.sqrt(update @ vmass @ update)
-        log.user('update: {:.2e}'.format(update_norm))
-        if update_norm < newton_tol:
-            break
+    lhs = _initial_solution(case, mu, initsol)
+    kwargs = _lagged_jacobian(kwargs, lag, stall, broyden)
+    vmass_h1 = case['v-h1s'](mu)
 
-        if it > maxit:
-            raise IterationCountError
+    def norm(vec):
+        return np.sqrt(vec @ vmass_h1 @ vec)
 
-    rhs = stokes_rhs.copy()
-    rhs[S] -= msv @ lhs[V]
-    rhs[S] -= msp @ lhs[P]
-    rhs[S] -= case['convection-svv'](mu, cont=(None, lhs[V], lhs[V]))
-    update = blocksolve_pressure(msp, rhs, S, P)
-    lhs += update
+    # Variable step BDF2 with error estimated by Milne's device, comparing
+    # against the quadratic extrapolation of the three latest solutions
+    times, sols = [mu[timename]], [lhs]
+    nsteps, nrejected = 0, 0
 
-    return lhs
+    yield (mu, lhs)
+    while tmax - times[0] > 1e-12 * max(1.0, abs(tmax)):
+        dt = min(dt, tmax - times[0])
+        newmu = dict(**mu)
+        newmu[timename] = times[0] + dt
+
+        if len(sols) == 1:
+            coeffs = bdf_coeffs(1)
+        else:
+            coeffs = bdf_coeffs(2, (dt, times[0] - times[1]))
+
+        with log.context(f'Step {nsteps+1} (t = {newmu[timename]:.2e}, dt = {dt:.2e})'):
+            try:
+                newlhs = navierstokes_timestep(
+                    case, newmu, dt, sols[0], tsolver='bdf2', prevsols=sols[1:2],
+                    coeffs=coeffs, **kwargs
+                )
+            except IterationCountError:
+                if dt <= dtmin:
+                    raise
+                log.user('nonlinear solver failed, reducing step size')
+                dt = max(dtmin, dt / 2)
+                nrejected += 1
+                continue
+
+            factor = None
+            if len(sols) == 3:
+                h, h1, h2 = dt, times[0] - times[1], times[1] - times[2]
+                t = newmu[timename]
+                (t0, t1, t2), (u0, u1, u2) = times, sols
+                predictor = (
+                    u0 * (t - t1) * (t - t2) / ((t0 - t1) * (t0 - t2))
+                    + u1 * (t - t0) * (t - t2) / ((t1 - t0) * (t1 - t2))
+                    + u2 * (t - t0) * (t - t1) / ((t2 - t0) * (t2 - t1))
+                )
+                w = h / h1
+                ratio = h * (1 + w) / (1 + 2*w)
+                ratio /= ratio + h + h1 + h2
+                lifted = newlhs + case['lift'](newmu)
+                error = ratio * norm(newlhs - predictor) / max(norm(lifted), np.finfo(float).tiny)
+                factor = min(2.0, max(0.2, safety * (tol / max(error, 1e-14)) ** (1/3)))
+                log.user(f'error estimate: {error:.2e}')
+
+                if error > tol and dt > dtmin:
+                    dt = max(dtmin, dt * factor)
+                    nrejected += 1
+                    continue
+
+        times = [newmu[timename], *times][:3]
+        sols = [newlhs, *sols][:3]
+        mu = newmu
+        nsteps += 1
+        yield (mu, newlhs)
+
+        if factor is not None:
+            dt = min(dtmax, max(dtmin, dt * factor))
+
+    log.user(f'{nsteps} steps accepted, {nrejected} rejected')
+    _log_jacobian(kwargs)
+
+
+def navierstokes_block(case, mu, newton_tol=1e-10, maxit=10, **kwargs):
+    return navierstokes(case, mu, newton_tol=newton_tol, maxit=maxit, solver='block', **kwargs)
 
 
 def supremizer(case, mu, rhs):
-    conses = case.constraints
+    conses = case.constraints.copy()
     mask = np.ones(conses.shape, dtype=np.bool)
     mask[case.bases['v'].indices] = False
     conses[mask] = 0.0
@@ -309,19 +833,148 @@ def supremizer(case, mu, rhs):
     return solve(mx, rhs, conses)
 
 
-def infsup(case, mu):
+def _infsup_blocks(case, mu):
     if 's' in case.bases:
         vinds = np.concatenate([case.bases['v'].indices, case.bases['s'].indices])
     else:
         vinds = np.concatenate([case.bases['v'].indices])
+    vinds = vinds[np.isnan(case.constraints[vinds])]
     pinds = case.bases['p'].indices
 
-    vmass = case['v-h1s'](mu)[np.ix_(vinds, vinds)]
-    pmass = case['p-l2'](mu)[np.ix_(pinds, pinds)]
-    bmx = case['divergence'](mu)[np.ix_(vinds, pinds)]
-
-    left = bmx.T @ np.linalg.inv(vmass) @ bmx
-    return np.sqrt(sp.linalg.eigvalsh(left, pmass)[0])
+    vmass = case['v-h1s'](mu)
+    if isinstance(vmass, np.ndarray):
+        pmass = case['p-l2'](mu)[np.ix_(pinds, pinds)]
+        bmx = case['divergence'](mu)[np.ix_(vinds, pinds)]
+        return vmass[np.ix_(vinds, vinds)], pmass, bmx
+
+    vmass = sp.sparse.csr_matrix(vmass)[vinds][:,vinds]
+    pmass = sp.sparse.csr_matrix(case['p-l2'](mu))[pinds][:,pinds]
+    bmx = sp.sparse.csr_matrix(case['divergence'](mu))[vinds][:,pinds]
+    return vmass, pmass, bmx
+
+
+def _constant_pressure(case, bmx):
+    # In enclosed flows the divergence does not see a constant pressure.  This
+    # is only known for high fidelity cases, where the coefficients of a
+    # constant are all ones.
+    if not isinstance(case, HifiCase):
+        return False
+    ones = np.ones((bmx.shape[1],))
+    return np.abs(bmx @ ones).max() <= 1e-10 * abs(bmx).max()
+
+
+def _smallest_singular(op, inner, mass, kernel=None, v0=None, tol=0):
+    # The smallest singular value of op as a map from the space with inner
+    # product mass to the dual of the space with inner product inner, that
+    # is the square root of the smallest eigenvalue of op^T inner^-1 op with
+    # respect to mass, and the corresponding vector.  A known kernel vector
+    # is excluded.
+    if isinstance(inner, np.ndarray):
+        index = 0 if kernel is None else 1
+        left = op.T @ sp.linalg.cho_solve(sp.linalg.cho_factor(inner), op)
+        eigvals, eigvecs = sp.linalg.eigh(left, mass, eigvals=(index, index))
+        return np.sqrt(max(eigvals[0], 0.0)), eigvecs[:,0]
+
+    # The left hand side is applied through a factorization of the inner
+    # product, and inverted through the saddle point system.  A small shift
+    # by the mass keeps this nonsingular if op has a kernel, and a known
+    # kernel vector is removed by a multiplier.
+    nrange, ndomain = op.shape
+    ifactor = splu(inner.tocsc())
+
+    def left(x):
+        return op.T @ ifactor.solve(op @ x)
+
+    # The Rayleigh quotient of a generic vector gives the scale of the
+    # eigenvalues
+    x = np.cos(np.arange(ndomain))
+    shift = 1e-8 * (x @ left(x)) / (x @ mass @ x)
+    if kernel is not None:
+        mean = sp.sparse.csr_matrix(mass @ kernel)
+        saddle = sp.sparse.bmat([
+            [inner, op, None], [op.T, -shift * mass, mean.T], [None, mean, None]
+        ])
+    else:
+        saddle = sp.sparse.bmat([[inner, op], [op.T, -shift * mass]])
+    sfactor = splu(saddle.tocsc())
+    nextra = saddle.shape[0] - nrange - ndomain
+
+    def left_inv(x):
+        rhs = np.concatenate([np.zeros((nrange,)), x, np.zeros((nextra,))])
+        return -sfactor.solve(rhs)[nrange:nrange+ndomain]
+
+    eigvals, eigvecs = sp.sparse.linalg.eigsh(
+        LinearOperator((ndomain, ndomain), matvec=left, dtype=float),
+        k=1, M=sp.sparse.csc_matrix(mass), sigma=-shift, v0=v0, tol=tol, which='LM',
+        OPinv=LinearOperator((ndomain, ndomain), matvec=left_inv, dtype=float),
+    )
+    return np.sqrt(max(eigvals[0], 0.0)), eigvecs[:,0]
+
+
+def _infsup(case, mu, v0=None, tol=0):
+    # With a constant pressure mode the inf-sup constant is taken over the
+    # pressures orthogonal to constants.  Any other pressure that the
+    # divergence does not see makes it zero.
+    vmass, pmass, bmx = _infsup_blocks(case, mu)
+    kernel = np.ones((bmx.shape[1],)) if _constant_pressure(case, bmx) else None
+    return _smallest_singular(bmx, vmass, pmass, kernel, v0=v0, tol=tol)
+
+
+def _linear_part(case, mu, terms):
+    # The matrix of the part of a residual, given by its terms, that is
+    # linear in the solution
+    retval = 0
+    for sign, name, cont in terms:
+        if name not in case or cont.count('lhs') != 1:
+            continue
+        mx = case[name](mu, cont=tuple(None if c == 'lhs' else c for c in cont))
+        if cont.index(None) > cont.index('lhs'):
+            mx = mx.T
+        retval = retval - sign * sp.sparse.csr_matrix(mx)
+    return retval
+
+
+def stability(case, mu, terms, norm, free, v0=None, tol=0):
+    # The smallest singular value of the linear part of a residual, on the
+    # free dofs and with respect to the given norm there.  For Stokes flow
+    # this is the constant that turns the dual norm of the residual into a
+    # bound of the error.  For Navier-Stokes flow only the convection with
+    # the lift is linear, so the result is a heuristic.  A constant pressure
+    # mode is excluded as in _infsup.
+    op = _linear_part(case, mu, terms)[free][:,free]
+    kernel = None
+    if isinstance(case, HifiCase) and 'p' in case.bases:
+        ones = np.zeros((len(free),))
+        ones[case.bases['p'].indices] = 1.0
+        ones = ones[free]
+        if np.abs(op @ ones).max() <= 1e-10 * abs(op).max():
+            kernel = ones
+    return _smallest_singular(op, norm, norm, kernel, v0=v0, tol=tol)
+
+
+def _infsup_key(case, mu):
+    # The parameter values that the inf-sup blocks depend on
+    deps = set()
+    for name in ('v-h1s', 'p-l2', 'divergence'):
+        itg = case.integrals[name]
+        deps |= set(itg.deps) | set(getattr(itg.scale, 'deps', ()))
+    return tuple(float(mu[dep]) for dep in sorted(deps))
+
+
+def infsup(case, mu, **kwargs):
+    value, __ = _infsup(case, mu, **kwargs)
+    return value
+
+
+def infsup_batch(case, mus, **kwargs):
+    # Parameters that leave the blocks unchanged share one computation
+    values, v0, computed = [], None, {}
+    for mu in log.iter('parameter', list(mus)):
+        key = _infsup_key(case, mu)
+        if key not in computed:
+            computed[key], v0 = _infsup(case, mu, v0=v0, **kwargs)
+        values.append(computed[key])
+    return np.array(values)
 
 
 def elasticity(case, mu):
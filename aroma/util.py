@@ -37,23 +37,33 @@
 # written agreement between you and SINTEF Digital.
 
 
+from collections import OrderedDict
+import atexit
 import click
+from contextlib import contextmanager
+import fcntl
 import inspect
 import functools
+import hashlib
+import json
 import time as timemod
-from multiprocessing import current_process, cpu_count
+from multiprocessing import current_process, cpu_count, resource_tracker, shared_memory
 import numpy as np
 from numpy import newaxis as _
+import pickle
 import h5py
 import pyfive
+import os
 from os.path import exists
 import dill
 import random
 import scipy.sparse as sp
 import scipy.sparse._sparsetools as sptools
-import sharedmem
 import string
+import tempfile
+import threading
 import warnings
+import weakref
 from io import BytesIO
 
 try:
@@ -137,7 +147,148 @@ class FileBacked(metaclass=FileBackedMeta):
         return obj
 
 
+# Options for writing large arrays, set per thread by write_file
+_write_options = threading.local()
+
+# Background threads still writing to files, the exceptions they raised
+# and the functions to call when they are done, by filename
+_pending_writes = {}
+
+
+def write_array(group, name, obj):
+    opts = getattr(_write_options, 'current', None)
+    if opts is None or obj.ndim == 0 or obj.size < opts['threshold']:
+        group[name] = obj
+        return group[name]
+    dataset = group.create_dataset(
+        name, shape=obj.shape, dtype=obj.dtype, chunks=True,
+        shuffle=True, compression='gzip', compression_opts=opts['level'],
+    )
+    if opts['pending'] is None:
+        dataset[...] = obj
+    else:
+        # Not copied, to keep peak memory down
+        opts['pending'].append((dataset, obj))
+    return dataset
+
+
+def write_file(obj, filename, background=False, level=1, threshold=2**16, done=None):
+    # Large arrays are compressed, and if background is true, their data
+    # is written by a separate thread after this function returns.  The
+    # file is only moved into place when complete.  Arrays in obj are
+    # written as they are, so they must not be modified in place until
+    # wait_for_write returns.  Exceptions raised in the background are
+    # raised again by wait_for_write, which also calls done in the
+    # waiting thread.
+    wait_for_write(filename)
+    tmpname = f'{filename}.tmp'
+    f = h5py.File(tmpname, 'w')
+    pending = [] if background else None
+    _write_options.current = {'level': level, 'threshold': threshold, 'pending': pending}
+    try:
+        obj.write(f)
+    except BaseException:
+        f.close()
+        os.remove(tmpname)
+        raise
+    finally:
+        del _write_options.current
+
+    def finish():
+        try:
+            for dataset, data in pending or ():
+                dataset[...] = data
+            f.close()
+            os.replace(tmpname, filename)
+        except BaseException:
+            f.close()
+            if exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    if not background:
+        finish()
+        if done is not None:
+            done()
+        return
+
+    errors = []
+
+    def run():
+        try:
+            finish()
+        except BaseException as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    _pending_writes[filename] = thread, errors, done
+
+
+def wait_for_write(filename):
+    thread, errors, done = _pending_writes.pop(filename, (None, (), None))
+    if thread is not None:
+        thread.join()
+    if errors:
+        raise errors[0]
+    if done is not None:
+        done()
+
+
+@atexit.register
+def wait_for_writes():
+    # Report failed background writes that nobody waited for
+    for filename in list(_pending_writes):
+        try:
+            wait_for_write(filename)
+        except Exception as error:
+            log.warning(f'writing {filename} failed: {error!r}')
+
+
+def open_file(filename):
+    # Open a file for lazy reading through a handle of our own.  It stays
+    # open for as long as anything read from the file is alive, so that
+    # replacing or removing the file does not affect those objects.
+    return pyfive.File(open(filename, 'rb'))
+
+
+# Objects read from the shared object tables, by file and content hash
+_shared_objects = weakref.WeakValueDictionary()
+
+
+def to_shared_dataset(obj, group, name):
+    # Pickled objects are stored once per file, keyed by content.  Functions
+    # that cannot be found by name, such as those in modules shadowed by a
+    # class of the same name, only carry the globals they refer to.
+    data = dill.dumps(obj, recurse=True)
+    key = hashlib.sha1(data).hexdigest()
+    table = group.file.require_group('_objects')
+    if key not in table:
+        table[key] = np.frombuffer(data, dtype=np.uint8)
+    group[name] = np.string_(key)
+    group[name].attrs['type'] = np.string_('SharedObject')
+    return group[name]
+
+
+def from_shared_dataset(group):
+    # Objects are only shared between datasets in the same file
+    key = (os.path.abspath(group.file.filename), group[()].decode())
+    try:
+        return _shared_objects[key]
+    except KeyError:
+        pass
+    obj = dill.loads(group.file['_objects'][key[1]][:].tobytes())
+    try:
+        _shared_objects[key] = obj
+    except TypeError:
+        pass
+    return obj
+
+
 def to_dataset(obj, group, name):
+    from aroma.affine import mu
+    from aroma.affine.polyfit import PolyAffine
+
     if isinstance(obj, FileBacked):
         subgroup = group.require_group(name)
         subgroup.attrs['type'] = np.string_('FileBacked')
@@ -146,31 +297,65 @@ def to_dataset(obj, group, name):
 
     if isinstance(obj, (sp.csr_matrix, sp.csc_matrix)):
         subgroup = group.require_group(name)
-        subgroup['data'] = obj.data
-        subgroup['indices'] = obj.indices
-        subgroup['indptr'] = obj.indptr
+        write_array(subgroup, 'data', obj.data)
+        write_array(subgroup, 'indices', obj.indices)
+        write_array(subgroup, 'indptr', obj.indptr)
         subgroup.attrs['shape'] = obj.shape
         subgroup.attrs['type'] = np.string_('CSRMatrix' if isinstance(obj, sp.csr_matrix) else 'CSCMatrix')
         return subgroup
 
     if isinstance(obj, sp.coo_matrix):
         subgroup = group.require_group(name)
-        subgroup['data'] = obj.data
-        subgroup['row'] = obj.row
-        subgroup['col'] = obj.col
+        write_array(subgroup, 'data', obj.data)
+        write_array(subgroup, 'row', obj.row)
+        write_array(subgroup, 'col', obj.col)
         subgroup.attrs['shape'] = obj.shape
         subgroup.attrs['type'] = np.string_('COOMatrix')
+        return subgroup
 
     if isinstance(obj, np.ndarray):
-        group[name] = obj
-        group[name].attrs['type'] = np.string_('Array')
-        return group[name]
+        dataset = write_array(group, name, obj)
+        dataset.attrs['type'] = np.string_('Array')
+        return dataset
 
     if isinstance(obj, str):
         group[name] = np.string_(obj)
         group[name].attrs['type'] = np.string_('String')
         return group[name]
 
+    if isinstance(obj, _SCALARS):
+        group[name] = obj
+        group[name].attrs['type'] = np.string_('Scalar')
+        return group[name]
+
+    if isinstance(obj, tuple) and all(isinstance(v, _SCALARS) for v in obj):
+        group[name] = np.array(obj)
+        group[name].attrs['type'] = np.string_('Tuple')
+        return group[name]
+
+    if isinstance(obj, dict) and all(isinstance(k, str) for k in obj):
+        subgroup = group.require_group(name)
+        for i, value in enumerate(obj.values()):
+            to_dataset(value, subgroup, str(i))
+        subgroup['keys'] = np.array([np.string_(k) for k in obj], dtype='S')
+        type_ = 'OrderedDict' if isinstance(obj, OrderedDict) else 'Dict'
+        subgroup.attrs['type'] = np.string_(type_)
+        return subgroup
+
+    if isinstance(obj, mu) and mu_is_encodable(obj):
+        group[name] = np.string_(json.dumps(mu_to_tree(obj)))
+        group[name].attrs['type'] = np.string_('Mu')
+        return group[name]
+
+    if isinstance(obj, PolyAffine) and all(isinstance(v, np.ndarray) for v in obj.coeffs.values()):
+        subgroup = group.require_group(name)
+        subgroup['ranges'] = np.array(obj.ranges, dtype=float)
+        indices = np.array(list(obj.coeffs), dtype=int)
+        subgroup['indices'] = indices.reshape(len(obj.coeffs), len(obj.ranges))
+        subgroup['coeffs'] = np.array(list(obj.coeffs.values()))
+        subgroup.attrs['type'] = np.string_('PolyAffine')
+        return subgroup
+
     if has_lrspline and isinstance(obj, lr.LRSplineSurface):
         with BytesIO() as b:
             obj.write(b)
@@ -179,29 +364,98 @@ def to_dataset(obj, group, name):
         group[name].attrs['type'] = np.string_('LRSplineSurface')
         return group[name]
 
-    else:
-        group[name] = np.string_(dill.dumps(obj))
-        group[name].attrs['type'] = np.string_('PickledObject')
-        return group[name]
+    return to_shared_dataset(obj, group, name)
+
+
+def mu_is_encodable(obj):
+    from aroma.affine import mu
+    if isinstance(obj.oper, str):
+        return all(isinstance(op, mu) and mu_is_encodable(op) for op in obj.operands)
+    return isinstance(obj.oper, (float, int)) and np.isfinite(obj.oper) and not obj.operands
+
+
+def mu_to_tree(obj):
+    # Parameter names and constants are leaves, other expressions are
+    # lists of the operator followed by the operands
+    if not obj.operands:
+        return obj.oper
+    return [obj.oper, *(mu_to_tree(op) for op in obj.operands)]
+
+
+def mu_from_tree(tree):
+    from aroma.affine import mu, _mufuncs
+    if not isinstance(tree, list):
+        if not isinstance(tree, (str, float, int)):
+            raise ValueError(f'Invalid mu expression: {tree!r}')
+        return mu(tree)
+    oper, *operands = tree
+    valid = isinstance(oper, str) and (oper in {'+', '-', '*', '/', '**'} or oper in _mufuncs)
+    if not valid:
+        raise ValueError(f'Invalid mu operator: {oper!r}')
+    return mu(oper, *(mu_from_tree(op) for op in operands))
+
+
+def read_array(dataset):
+    # Map contiguous uncompressed datasets directly from the file.
+    # Pyfive already does this on its own.
+    if isinstance(dataset, h5py.Dataset) and dataset.chunks is None and dataset.shape:
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(
+                dataset.file.filename, mode='c', dtype=dataset.dtype,
+                offset=offset, shape=dataset.shape,
+            )
+
+    # Other datasets are read straight into shared memory if requested
+    arena = getattr(_read_options, 'arena', None)
+    if arena is not None and dataset.chunks is not None and dataset.shape:
+        retval = arena.empty(dataset.shape, dataset.dtype)
+        if isinstance(dataset, h5py.Dataset):
+            dataset.read_direct(retval)
+        else:
+            retval[...] = dataset[:]
+        return retval
+    return dataset[:]
 
 
 def from_dataset(group):
-    type_ = group.attrs['type'].decode()
+    type_ = group.attrs['type']
+    if isinstance(type_, bytes):
+        type_ = type_.decode()
     if type_ == 'FileBacked':
         return FileBacked.read(group)
     if type_ == 'PickledObject':
         return dill.loads(group[()])
+    if type_ == 'SharedObject':
+        return from_shared_dataset(group)
     if has_lrspline and type_ == 'LRSplineSurface':
         return lr.LRSplineSurface(group[()])
     if type_ == 'Array':
-        return group[:]
+        return read_array(group)
     if type_ == 'String':
         return group[()].decode()
+    if type_ == 'Scalar':
+        return group[()].item()
+    if type_ == 'Tuple':
+        return tuple(group[()].tolist())
+    if type_ in {'Dict', 'OrderedDict'}:
+        keys = [k.decode() for k in group['keys'][()]]
+        values = [from_dataset(group[str(i)]) for i in range(len(keys))]
+        return (OrderedDict if type_ == 'OrderedDict' else dict)(zip(keys, values))
+    if type_ == 'Mu':
+        return mu_from_tree(json.loads(group[()].decode()))
+    if type_ == 'PolyAffine':
+        from aroma.affine.polyfit import PolyAffine
+        ranges = [tuple(r) for r in group['ranges'][()].tolist()]
+        indices = [tuple(i) for i in group['indices'][()].tolist()]
+        return PolyAffine(ranges, dict(zip(indices, group['coeffs'][()])))
     if type_ in {'CSRMatrix', 'CSCMatrix'}:
         cls = sp.csr_matrix if type_ == 'CSRMatrix' else sp.csc_matrix
-        return cls((group['data'][:], group['indices'][:], group['indptr'][:]), shape=group.attrs['shape'])
+        data, indices, indptr = (read_array(group[key]) for key in ('data', 'indices', 'indptr'))
+        return cls((data, indices, indptr), shape=group.attrs['shape'])
     if type_ == 'COOMatrix':
-        return sp.coo_matrix((group['data'][:], (group['row'][:], group['col'][:])), shape=group.attrs['shape'])
+        data, row, col = (read_array(group[key]) for key in ('data', 'row', 'col'))
+        return sp.coo_matrix((data, (row, col)), shape=group.attrs['shape'])
 
     raise NotImplementedError(f'Unknown type: {type_}')
 
@@ -215,7 +469,8 @@ def subclasses(cls, root=False):
 
 
 def find_subclass(cls, name, root=False, attr='__name__'):
-    name = name.decode('utf-8')
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
     for sub in subclasses(cls, root=root):
         if hasattr(sub, attr) and getattr(sub, attr) == name:
             return sub
@@ -246,30 +501,237 @@ def common_args(func):
     return retval
 
 
+# Functions decorated with filecache, by qualified name
+_cached_functions = {}
+
+# Upstream cache entries used by the filecache computations in progress
+_cache_stack = threading.local()
+
+# Limits enforced on each cache directory after writing
+cache_limits = {'maxsize': None, 'maxage': None}
+
+_manifest_lock = threading.RLock()
+
+
+def getsource(obj):
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return obj.__qualname__
+
+
+def code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+
+def references(obj):
+    # The objects that a function refers to by name, or that the bases
+    # and methods of a class refer to
+    if inspect.isclass(obj):
+        retval = list(obj.__bases__)
+        for value in vars(obj).values():
+            if isinstance(value, (staticmethod, classmethod)):
+                value = value.__func__
+            if isinstance(value, property):
+                funcs = [value.fget, value.fset, value.fdel]
+            else:
+                funcs = [value]
+            for func in funcs:
+                if inspect.isfunction(func):
+                    retval.extend(references(func))
+        return retval
+
+    func = inspect.unwrap(obj)
+    names = code_names(func.__code__)
+    retval = []
+    for cell in func.__closure__ or ():
+        try:
+            retval.append(cell.cell_contents)
+        except ValueError:
+            # Empty cell
+            pass
+    for name in sorted(names):
+        value = func.__globals__.get(name)
+        if inspect.ismodule(value):
+            retval.extend(getattr(value, attr, None) for attr in sorted(names))
+        else:
+            retval.append(value)
+    return retval
+
+
+@functools.lru_cache()
+def source_hash(func):
+    # Hash the source of a function, and of all the aroma functions and
+    # classes it refers to, directly or through other aroma code, such as
+    # the case class it instantiates and the base classes of that
+    import nutils
+    func = inspect.unwrap(func)
+    sources = [getsource(func), nutils.version, np.__version__]
+    seen, queue = {func}, [func]
+    while queue:
+        for obj in references(queue.pop(0)):
+            if not (inspect.isfunction(obj) or inspect.isclass(obj)) or obj in seen:
+                continue
+            seen.add(obj)
+            if (obj.__module__ or '').startswith('aroma'):
+                sources.append(getsource(obj))
+                queue.append(obj)
+    return hashlib.sha1('\0'.join(sources).encode()).hexdigest()
+
+
+def manifest_path(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), '.filecache.json')
+
+
+def read_manifest(filename):
+    path = manifest_path(filename)
+    with _manifest_lock:
+        if not exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+
+def update_manifest(filename, func):
+    path = manifest_path(filename)
+    with _manifest_lock, open(f'{path}.lock', 'w') as lock:
+        # Other processes may write to the same manifest
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = read_manifest(filename)
+        func(entries)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(f'{path}.tmp', path)
+
+
+def entry_key(path, seen=()):
+    # Current key of a cache entry, or None if its code or any of its
+    # dependencies are unknown
+    entry = read_manifest(path).get(path)
+    if entry is None or entry['function'] not in _cached_functions or path in seen:
+        return None
+    deps = [entry_key(dep, seen + (path,)) for dep in entry['deps']]
+    if any(dep is None for dep in deps):
+        return None
+    return cache_key(_cached_functions[entry['function']], entry['arguments'], deps)
+
+
+def cache_key(func, arguments, deps):
+    data = '\0'.join([source_hash(func), arguments, *deps])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def encode_arguments(value):
+    # A JSON-compatible description of function arguments that is stable
+    # between runs, unlike repr of objects without a custom __repr__
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [encode_arguments(v) for v in value]
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {k: encode_arguments(v) for k, v in value.items()}
+    return hashlib.sha1(dill.dumps(value)).hexdigest()
+
+
+def evict_cache(directory='.', maxsize=None, maxage=None):
+    # Remove the least recently used entries until the limits are satisfied
+    filename = os.path.join(directory, '.filecache.json')
+
+    def evict(entries):
+        now = timemod.time()
+        order = sorted(entries, key=lambda path: entries[path]['accessed'])
+        total = sum(entry['size'] for entry in entries.values())
+        for path in order:
+            entry = entries[path]
+            expired = maxage is not None and now - entry['accessed'] > maxage
+            if not expired and (maxsize is None or total <= maxsize):
+                continue
+            # Cases read lazily from the file keep their own handle to it
+            log.user(f'evicting {path}')
+            if exists(path):
+                os.remove(path)
+            total -= entry['size']
+            del entries[path]
+    update_manifest(filename, evict)
+
+
 def filecache(fmt):
     def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        _cached_functions[name] = func
+        signature = inspect.signature(func)
+
         @functools.wraps(func)
         def inner(*args, **kwargs):
             from aroma.case import Case
             from aroma.ensemble import Ensemble
             filename = make_filename(func, fmt, *args, **kwargs)
+            path = os.path.abspath(filename)
+            binding = signature.bind(*args, **kwargs)
+            binding.apply_defaults()
+            arguments = json.dumps(encode_arguments(binding.arguments), sort_keys=True)
 
-            # If file exists, load from it
+            # If file exists and is up to date, load from it
             with log.context(func.__name__):
-                if exists(filename):
+                wait_for_write(filename)
+                entry = read_manifest(path).get(path)
+                valid = (
+                    exists(filename) and entry is not None
+                    and entry['arguments'] == arguments and entry['key'] == entry_key(path)
+                )
+                if valid:
                     log.user(f'reading from {filename}')
-                    reader = Case if filename.endswith('case') else Ensemble
-                    # with h5py.File(filename, 'r') as f:
+
+                    def touch(entries):
+                        entries[path]['accessed'] = timemod.time()
+                    update_manifest(path, touch)
+                    getattr(_cache_stack, 'deps', [[]])[-1].append(path)
+                    # Cases keep the file open and read integrals on demand
+                    if filename.endswith('case'):
+                        return Case.read(open_file(filename), lazy=True)
                     with pyfive.File(filename) as f:
-                        return reader.read(f)
-                log.user(f'{filename} not found')
+                        return Ensemble.read(f)
+                log.user(f'{filename} {"out of date" if exists(filename) else "not found"}')
+
+            # Otherwise, call the wrapped function, recording which other
+            # cache entries it uses, and save
+            if not hasattr(_cache_stack, 'deps'):
+                _cache_stack.deps = [[]]
+            _cache_stack.deps.append([])
+            try:
+                obj = func(*args, **kwargs)
+            finally:
+                deps = _cache_stack.deps.pop()
+            _cache_stack.deps[-1].append(path)
+
+            key = cache_key(func, arguments, [entry_key(dep) or '' for dep in deps])
+
+            def record(entries):
+                now = timemod.time()
+                entries[path] = {
+                    'function': name, 'arguments': arguments, 'deps': deps, 'key': key,
+                    'size': 0, 'created': now, 'accessed': now,
+                }
+            update_manifest(path, record)
+
+            # Called by wait_for_write, so that errors reach the caller
+            def done():
+                def set_size(entries):
+                    if path in entries:
+                        entries[path]['size'] = os.path.getsize(path)
+                update_manifest(path, set_size)
+                if any(v is not None for v in cache_limits.values()):
+                    evict_cache(os.path.dirname(path), **cache_limits)
 
-            # If it doesn't exist, call the wrapped function, and save
-            obj = func(*args, **kwargs)
             with log.context(func.__name__):
                 log.user(f'writing to {filename}')
-                with h5py.File(filename, 'w') as f:
-                    obj.write(f)
+                write_file(obj, filename, background=True, done=done)
             return obj
 
         return inner
@@ -303,7 +765,7 @@ def multiple_to_single(argname):
 class time:
 
     def __init__(self, context=None, display=True):
-        self._display = True
+        self._display = display
         self._context = context
         self._time = 0.0
 
@@ -376,10 +838,153 @@ def assembler(shape, *args):
     return backend(shape, *args)
 
 
+class SharedArray(np.ndarray):
+    # An array occupying a whole arena segment, which pickles by reference
+    # so that other processes attach to the segment instead of copying
+
+    def __array_finalize__(self, obj):
+        self._segment = getattr(obj, '_segment', None)
+        self._identity = getattr(obj, '_identity', None)
+        self._address = getattr(obj, '_address', None)
+
+    def __reduce__(self):
+        whole = (
+            self._segment is not None and self.flags.c_contiguous
+            and self.__array_interface__['data'][0] == self._address
+        )
+        if not whole:
+            return np.asarray(self).copy().__reduce__()
+        return attach_array, (self._segment, self._identity, self.shape, self.dtype.str)
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+
+def segment_identity(f, path):
+    # The name, inode and size of an open segment file, which tell a
+    # reused /proc/<pid>/fd entry apart from the segment it referred to
+    link = f'/proc/self/fd/{f.fileno()}'
+    name = os.readlink(link) if os.path.islink(link) else path
+    stat = os.fstat(f.fileno())
+    return name, stat.st_ino, stat.st_size
+
+
+def attach_array(segment, identity, shape, dtype):
+    with open(segment, 'rb') as f:
+        if segment_identity(f, segment) != tuple(identity):
+            raise OSError(f'{segment} no longer refers to the shared segment')
+        arr = np.memmap(f, mode='c', dtype=np.dtype(dtype), shape=shape)
+    return as_shared(arr, segment, identity)
+
+
+def as_shared(arr, segment, identity):
+    retval = arr.view(SharedArray)
+    retval._segment = segment
+    retval._identity = identity
+    retval._address = retval.__array_interface__['data'][0]
+    return retval
+
+
+class Arena:
+    # Allocates arrays in memory-mapped files, by default in /dev/shm.  Each
+    # file is unlinked as soon as it is created, and other processes map it
+    # through /proc/<pid>/fd of the creating process, so nothing is left
+    # behind however the process ends.  The file is closed, and its memory
+    # freed, once the array and its views are released everywhere.  Since
+    # file descriptors are reused, arrays pickle the name, inode and size
+    # of their file along with its path, and attaching checks all three.
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.directory = directory
+
+    def empty(self, shape, dtype):
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype=dtype)
+        fd, path = tempfile.mkstemp(prefix='aroma-', dir=self.directory)
+        f = os.fdopen(fd, 'r+b')
+        f.truncate(int(np.prod(shape)) * dtype.itemsize)
+        arr = np.memmap(f, mode='r+', dtype=dtype, shape=shape)
+
+        # Without /proc the file is only removed once the array is released
+        if os.path.isdir('/proc/self/fd'):
+            os.remove(path)
+            segment = f'/proc/{os.getpid()}/fd/{fd}'
+            weakref.finalize(arr, f.close)
+        else:
+            segment = path
+            weakref.finalize(arr, _remove_segment, f, path)
+        return as_shared(arr, segment, segment_identity(f, path))
+
+    def share(self, arr):
+        # Other arrays, including those mapped from a case file, would be
+        # copied when pickled
+        if isinstance(arr, SharedArray):
+            return arr
+        retval = self.empty(arr.shape, arr.dtype)
+        retval[...] = arr
+        return retval
+
+
+def _remove_segment(f, path):
+    f.close()
+    if exists(path):
+        os.remove(path)
+
+
+_arena = None
+
+# Arena to read chunked datasets into, set per thread by shared_reads
+_read_options = threading.local()
+
+
+def arena():
+    global _arena
+    if _arena is None:
+        _arena = Arena()
+    return _arena
+
+
+@contextmanager
+def shared_reads():
+    _read_options.arena = arena()
+    try:
+        yield
+    finally:
+        del _read_options.arena
+
+
 def shared_array(arr):
-    ret = sharedmem.empty_like(arr)
-    ret[:] = arr
-    return ret
+    return arena().share(arr)
+
+
+def to_shared_memory(obj):
+    # Pickle obj with its array buffers placed out-of-band in shared
+    # memory blocks, for sending large results from worker processes
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    blocks = []
+    for buf in buffers:
+        raw = buf.raw()
+        shm = shared_memory.SharedMemory(create=True, size=max(raw.nbytes, 1))
+        shm.buf[:raw.nbytes] = raw
+        # Ownership passes to the receiving process
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        blocks.append((shm.name, raw.nbytes))
+        shm.close()
+    return payload, blocks
+
+
+def from_shared_memory(payload, blocks):
+    buffers = []
+    for name, nbytes in blocks:
+        shm = shared_memory.SharedMemory(name=name)
+        buffers.append(bytearray(shm.buf[:nbytes]))
+        shm.close()
+        shm.unlink()
+    return pickle.loads(payload, buffers=buffers)
 
 
 class CSRAssembler:
@@ -415,10 +1020,9 @@ class CSRAssembler:
     @staticmethod
     def read(group):
         retval = CSRAssembler.__new__(CSRAssembler)
-        retval.row = group['row'][:]
-        retval.col = group['col'][:]
-        retval.order = group['order'][:]
-        retval.inds = group['inds'][:]
+        retval.row, retval.col, retval.order, retval.inds = (
+            read_array(group[key]) for key in ('row', 'col', 'order', 'inds')
+        )
         retval.shape = tuple(group.attrs['shape'])
         return retval
 
@@ -465,9 +1069,8 @@ class VectorAssembler:
     @staticmethod
     def read(group):
         retval = VectorAssembler.__new__(VectorAssembler)
-        retval.row = group['row'][:]
-        retval.order = group['order'][:]
-        retval.inds = group['inds'][:]
+        keys = ('row', 'order', 'inds')
+        retval.row, retval.order, retval.inds = (read_array(group[key]) for key in keys)
         retval.shape = tuple(group.attrs['shape'])
         return retval
 
@@ -481,6 +1084,49 @@ class VectorAssembler:
         self.row, self.order, self.inds = map(shared_array, (self.row, self.order, self.inds))
 
 
+def nbytes(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    return sum(
+        getattr(obj, attr).nbytes
+        for attr in ('data', 'indices', 'indptr', 'row', 'col')
+        if isinstance(getattr(obj, attr, None), np.ndarray)
+    )
+
+
+class MemoCache:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, owner, key):
+        key = (id(owner), key)
+        entry = self.entries.get(key)
+        if entry is None or entry[0]() is not owner:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, owner, key, value):
+        size = nbytes(value)
+        if size > self.budget:
+            return
+        key = (id(owner), key)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        self.entries[key] = (weakref.ref(owner), value, size)
+        self.nbytes += size
+        while self.nbytes > self.budget:
+            __, (__, __, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
 def contract(obj, contraction):
     axes = []
     for i, cont in enumerate(contraction):
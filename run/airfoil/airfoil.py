@@ -43,11 +43,6 @@ def get_reduced(piola: bool = False, sups: bool = True, nred: int = 10, fast: in
         reducer.add_basis('s', parent='v', ensemble='supremizers', ndofs=nred, norm='h1s')
     reducer.add_basis('p', parent='p', ensemble='solutions', ndofs=nred, norm='l2')
 
-    if sups and piola:
-        reducer.override('convection', 'vvv', 'svv', soft=True)
-        reducer.override('laplacian', 'vv', 'sv', soft=True)
-        reducer.override('divergence', 'sp', soft=True)
-
     reducer.plot_spectra(util.make_filename(get_reduced, 'airfoil-spectrum-{piola}', piola=piola))
     return reducer(tol=1e-6, nrules=4)
 
@@ -109,11 +104,7 @@ def rsolve(angle, velocity, piola, sups, nred, index):
     angle = -angle / 180 * np.pi
     mu = case.parameter(angle=angle, velocity=velocity)
     with util.time():
-        try:
-            lhs = solvers.navierstokes_block(case, mu)
-        except AssertionError:
-            log.user('solving non-block')
-            lhs = solvers.navierstokes(case, mu)
+        lhs = solvers.navierstokes_block(case, mu)
     visualization.vtk(case, mu, lhs)
     # visualization.velocity(case, mu, lhs, name='red', axes=False, colorbar=True)
     # visualization.pressure(case, mu, lhs, name='red', axes=False, colorbar=True)
@@ -210,9 +201,6 @@ def _results(fast: bool = False, piola: bool = False, sups: bool = False, block:
 
     ensemble = get_ensemble(fast=fast, piola=piola, num=15)
 
-    if not piola:
-        block = False
-
     res = []
     for nr in nred:
         rcase = get_reduced(piola=piola, sups=sups, nred=nr)
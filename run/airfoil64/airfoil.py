@@ -110,17 +110,6 @@ def get_reduced(piola: bool = False, nred: int = 10, imported: bool = False, fas
 
     projcase = reduction.make_reduced(case, rb_sol, rb_sup, meta=meta)
 
-    if piola:
-        with log.context('block project'):
-            with log.context('convection'):
-                projcase['convection-vvv'] = case['convection'].project(rb_sol['v'])
-                projcase['convection-svv'] = case['convection'].project((rb_sup['v'], rb_sol['v'], rb_sol['v']))
-            with log.context('laplacian'):
-                projcase['laplacian-vv'] = case['laplacian'].project(rb_sol['v'])
-                projcase['laplacian-sv'] = case['laplacian'].project((rb_sup['v'], rb_sol['v']))
-            with log.context('divergence'):
-                projcase['divergence-sp'] = case['divergence'].project((rb_sup['v'], rb_sol['p']))
-
     return projcase
 
 
@@ -176,10 +165,7 @@ def rsolve(angle, velocity, piola, imported, nred, index):
     angle = -angle / 180 * np.pi
     mu = case.parameter(angle=angle, velocity=velocity)
     with util.time():
-        try:
-            lhs = solvers.navierstokes_block(case, mu)
-        except AssertionError:
-            lhs = solvers.navierstokes(case, mu)
+        lhs = solvers.navierstokes_block(case, mu)
     solvers.plots(
         case, mu, lhs, colorbar=True, figsize=(10,10), fields=['v', 'p'],
         plot_name='red', index=index, axes=False
@@ -294,9 +280,6 @@ def _results(fast: bool = False, piola: bool = False, block: bool = False, impor
     # scheme = list(quadrature.full([(-25*np.pi/180, 25*np.pi/180), (2, 20)], 2))
     # ttime, tsol = ens.make_ensemble(tcase, solvers.navierstokes, scheme, parallel=True, return_time=True)
 
-    if not piola:
-        block = False
-
     res = []
     for nr in nred:
         rcase = get_reduced(piola=piola, imported=imported, nred=nr)
@@ -67,15 +67,18 @@ def disp(fast, piola):
 @click.option('--fast/--no-fast', default=False)
 @click.option('--piola/--no-piola', default=False)
 @click.option('--initsol', type=click.File('rb'), default=None)
+@click.option('--lag', default=1)
+@click.option('--broyden/--no-broyden', default=False)
 @util.common_args
-def solve(velocity, viscosity, nsteps, timestep, fast, piola, initsol):
+def solve(velocity, viscosity, nsteps, timestep, fast, piola, initsol, lag, broyden):
     case = get_case(fast, piola)
     mu = case.parameter(velocity=velocity, viscosity=viscosity)
 
     with util.time():
         kwargs = {'initsol': np.load(initsol)} if initsol else {}
         timestepper = solvers.navierstokes_time(
-            case, mu, maxit=10, nsteps=nsteps, dt=timestep, solver='mkl', tsolver='cn', **kwargs,
+            case, mu, maxit=10, nsteps=nsteps, dt=timestep, solver='mkl', tsolver='cn',
+            lag=lag, broyden=broyden, **kwargs,
         )
         solutions = []
         for (mu, lhs) in timestepper:
@@ -10,6 +10,10 @@ from aroma.case import NutilsCase
 from aroma.affine import MuLambda, MuConstant
 import aroma.affine.integrands.nutils as ntl
 from aroma import solvers, util, visualization, ensemble as ens, quadrature, reduction
+from aroma.pipeline import Pipeline
+
+
+pipeline = Pipeline()
 
 
 def decorate_params(func):
@@ -26,16 +30,6 @@ def decorate_case(func):
     return func
 
 
-def decorate_ensemble(func):
-    func = click.option('--num', default=15)(func)
-    return func
-
-
-def decorate_nred(func):
-    func = click.option('--nred', default=10)(func)
-    return func
-
-
 def geometry(mu, L, H, refgeom):
     x, y = refgeom
     hx = fn.piecewise(x, (0,), 0, x)
@@ -47,8 +41,8 @@ def geometry(mu, L, H, refgeom):
     )
 
 
-@util.filecache('backstep-{refine}-{degree}.case')
-def get_case(refine: int, degree: int):
+@pipeline.stage('backstep-{refine}-{degree}.case')
+def case(refine: int = 1, degree: int = 2):
     nel_up = int(10 * refine)
     nel_length = int(100 * refine)
 
@@ -111,9 +105,8 @@ def get_case(refine: int, degree: int):
     return case
 
 
-@util.filecache('backstep-{refine}-{degree}-{num}.ens')
-def get_ensemble(refine: int, degree: int, num: int):
-    case = get_case(refine, degree)
+@pipeline.stage('backstep-{refine}-{degree}-{num}.ens')
+def ensemble(case, num: int = 15):
     scheme = quadrature.sparse(case.ranges(), num)
     ensemble = ens.Ensemble(scheme)
     ensemble.compute('solutions', case, solvers.navierstokes)
@@ -121,11 +114,8 @@ def get_ensemble(refine: int, degree: int, num: int):
     return ensemble
 
 
-@util.filecache('backstep-{refine}-{degree}-{nred}.rcase')
-def get_reduced(refine: int, degree: int, nred: int, num=None):
-    case = get_case(refine, degree)
-    ensemble = get_ensemble(refine, degree, num)
-
+@pipeline.stage('backstep-{refine}-{degree}-{num}-{nred}.rcase')
+def reduce(case, ensemble, nred: int = 10):
     case.integrals['divergence'].liftable = (0, 1)
 
     reducer = reduction.EigenReducer(case, ensemble)
@@ -140,16 +130,34 @@ def get_reduced(refine: int, degree: int, nred: int, num=None):
     })
 
 
-@click.group()
-def main():
-    pass
+@pipeline.stage('backstep-{refine}-{degree}-{nred}-{ntrain}.gcase')
+def greedy(case, nred: int = 10, ntrain: int = 256):
+    case.integrals['divergence'].liftable = (0, 1)
+
+    scheme = quadrature.sobol(case.ranges(), ntrain)
+    reducer = reduction.GreedyReducer(
+        case, scheme, solvers.navierstokes, solvers.navierstokes_residual, nsnapshots=nred,
+    )
+    reducer.add_ensemble('supremizers', solvers.supremizer, 'solutions')
+    reducer.add_basis('v', parent='v', ensemble='solutions', ndofs=nred, norm='h1s')
+    reducer.add_basis('s', parent='v', ensemble='supremizers', ndofs=nred, norm='h1s')
+    reducer.add_basis('p', parent='p', ensemble='solutions', ndofs=nred, norm='l2')
+
+    return reducer(tol=1e-6, nrules=3, overrides={
+        'laplacian': {'tol': 1e-4, 'nrules': 4},
+        'v-h1s': {'tol': 1e-4, 'nrules': 4},
+    })
+
+
+# Generates the case, ensemble, reduce and greedy commands
+main = pipeline.cli()
 
 
 @main.command()
 @decorate_case
 @util.common_args
 def disp(**kwargs):
-    print(get_case(**kwargs))
+    print(pipeline.get('case', **kwargs))
 
 
 @main.command()
@@ -157,7 +165,7 @@ def disp(**kwargs):
 @decorate_params
 @util.common_args
 def solve(refine, degree, **kwargs):
-    case = get_case(refine=refine, degree=degree)
+    case = pipeline.get('case', refine=refine, degree=degree)
     mu = case.parameter(**kwargs)
     with util.time():
         lhs = solvers.navierstokes(case, mu)
@@ -168,10 +176,11 @@ def solve(refine, degree, **kwargs):
 @main.command()
 @decorate_case
 @decorate_params
-@decorate_nred
+@click.option('--nred', default=10)
+@click.option('--greedy/--no-greedy', default=False)
 @util.common_args
-def rsolve(refine, degree, nred, **kwargs):
-    case = get_reduced(refine=refine, degree=degree, nred=nred)
+def rsolve(refine, degree, nred, greedy, **kwargs):
+    case = pipeline.get('greedy' if greedy else 'reduce', refine=refine, degree=degree, nred=nred)
     mu = case.parameter(**kwargs)
     with util.time():
         lhs = solvers.navierstokes(case, mu)
@@ -179,22 +188,5 @@ def rsolve(refine, degree, nred, **kwargs):
     visualization.pressure(case, mu, lhs, figsize=(15,3), name='red')
 
 
-@main.command()
-@decorate_case
-@decorate_ensemble
-@util.common_args
-def ensemble(**kwargs):
-    get_ensemble(**kwargs)
-
-
-@main.command()
-@decorate_case
-@decorate_ensemble
-@decorate_nred
-@util.common_args
-def reduce(**kwargs):
-    get_reduced(**kwargs)
-
-
 if __name__ == '__main__':
     main()
@@ -18,7 +18,7 @@ setup(
         'pyfive',
         'nutils>=4,<5',
         'numpy',
-        'scipy',
+        'scipy>=1.7',
         'sharedmem',
         'beautifultable',
         'matplotlib',
@@ -28,5 +28,6 @@ setup(
     ],
     extras_require={
         'LRSplines': ['lrsplines'],
+        'AMG': ['pyamg'],
     }
 )
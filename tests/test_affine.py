@@ -1,8 +1,13 @@
 import numpy as np
 from nutils import mesh, function as fn, _
 import pytest
+import tempfile
+import h5py
+import os
 
-from aroma.affine import mu, COOTensorIntegrand, Affine, AffineIntegral
+from aroma import util
+from aroma.case import Case
+from aroma.affine import mu, memo, COOTensorIntegrand, Affine, AffineIntegral
 import aroma.affine.integrands.nutils
 
 
@@ -46,3 +51,81 @@ def test_nutils_tensor():
     b = domain.integrate(itg * fn.J(geom), ischeme='gauss9')
 
     np.testing.assert_almost_equal(a, b)
+
+
+def test_memoize():
+    eye = np.array([[1, 0], [0, 1]])
+    ones = np.ones((2,2))
+    obj = Affine(mu('a'), eye, mu('b'), ones)
+
+    nentries = len(memo.entries)
+    first = obj(None, {'a': 1.0, 'b': 2.0, 'c': 0.0})
+    first[:] = 0.0
+    np.testing.assert_almost_equal(obj(None, {'a': 1.0, 'b': 2.0, 'c': 1.0}), eye + 2*ones)
+    assert len(memo.entries) == nentries + 1
+    np.testing.assert_almost_equal(obj(None, {'a': 2.0, 'b': 2.0}), 2*eye + 2*ones)
+    assert len(memo.entries) == nentries + 2
+
+    # Reassigning an integral invalidates memoized lift contractions
+    case = Case('test')
+    case['lift'] = Affine(1, np.array([1.0, 0.0]))
+    case['mass'] = AffineIntegral(mu('a'), eye, mu('b'), ones)
+    np.testing.assert_almost_equal(case['mass']({'a': 1.0, 'b': 2.0}, cont=(None, 'lift')), [3, 2])
+    case['lift'] = Affine(1, np.array([0.0, 1.0]))
+    np.testing.assert_almost_equal(case['mass']({'a': 1.0, 'b': 2.0}, cont=(None, 'lift')), [2, 3])
+
+    cache = util.MemoCache(2 * eye.nbytes)
+    for i in range(3):
+        cache.put(obj, i, eye)
+    assert cache.get(obj, 0) is None
+    assert cache.get(obj, 2) is eye
+    assert cache.nbytes == 2 * eye.nbytes
+
+
+def test_datasets():
+    from argparse import Namespace
+    from collections import OrderedDict
+    from aroma.affine.polyfit import PolyAffine
+
+    m = mu('a') * 2.0 + mu('b').sin()
+    poly = PolyAffine([(0.0, 1.0), (1.0, 2.0)], {(0, 0): np.ones(3), (1, 2): np.arange(3.0)})
+    data = OrderedDict([('z', 1), ('a', 'x'), ('t', (1, 2))])
+    domain, geom = mesh.rectilinear([[0, 1, 2]])
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test.hdf5')
+    with h5py.File(filename, 'w') as f:
+        util.to_dataset(m, f, 'mu')
+        util.to_dataset(poly, f, 'poly')
+        util.to_dataset(data, f, 'data')
+        util.to_dataset(domain, f, 'domain1')
+        util.to_dataset(domain, f, 'domain2')
+        assert len(f['_objects']) == 1
+
+    with h5py.File(filename, 'r') as f:
+        p = {'a': 1.0, 'b': 0.5}
+        np.testing.assert_almost_equal(util.from_dataset(f['mu'])(p), m(p))
+        np.testing.assert_almost_equal(util.from_dataset(f['poly'])([0.3, 1.4]), poly([0.3, 1.4]))
+        assert util.from_dataset(f['data']) == data
+        assert util.from_dataset(f['domain1']) is util.from_dataset(f['domain2'])
+
+    # Mutable objects are not shared between files
+    obj = Namespace(value=1)
+    filenames = [os.path.join(tempfile.mkdtemp(), 'test.hdf5') for __ in range(2)]
+    for name in filenames:
+        with h5py.File(name, 'w') as f:
+            util.to_dataset(obj, f, 'obj')
+    with h5py.File(filenames[0], 'r') as f, h5py.File(filenames[1], 'r') as g:
+        first = util.from_dataset(f['obj'])
+        assert util.from_dataset(f['obj']) is first
+        assert util.from_dataset(g['obj']) is not first
+    for name in filenames:
+        os.remove(name)
+
+    # Mu expressions are decoded without evaluating code
+    with h5py.File(filename, 'w') as f:
+        f['mu'] = np.string_('["__import__", "os"]')
+        f['mu'].attrs['type'] = np.string_('Mu')
+    with h5py.File(filename, 'r') as f:
+        with pytest.raises(ValueError):
+            util.from_dataset(f['mu'])
+    os.remove(filename)
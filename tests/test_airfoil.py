@@ -1,12 +1,16 @@
 import numpy as np
 import pytest
+import tempfile
+import os
 from nutils import mesh, function as fn, log, _, plot
 
-from aroma import affine
+from aroma import affine, util
+from aroma.affine.integrands import nutils as ntl
+from aroma.case import Case, LofiCase
 import aroma.cases as cases
 
 
-def mk_case(override):
+def mk_case(override, piola=True):
     pspace = np.linspace(0, 2*np.pi, 4)
     rspace = np.linspace(0, 1, 3)
     domain, refgeom = mesh.rectilinear([rspace, pspace], periodic=(1,))
@@ -15,10 +19,11 @@ def mk_case(override):
         (1 + 10 * r) * fn.cos(ang),
         (1 + 10 * r) * fn.sin(ang),
     ))
-    case = cases.airfoil(mesh=(domain, refgeom, geom), lift=False, amax=10, rmax=10, piola=True)
+    case = cases.airfoil(mesh=(domain, refgeom, geom), lift=False, amax=10, rmax=10, piola=piola)
     case.precompute(force=override)
     return case
 
+flatcase = mk_case(False, piola=False)
 cases = {True: mk_case(True), False: mk_case(False)}
 
 @pytest.fixture(params=[True, False])
@@ -128,3 +133,106 @@ def test_convection(mu, case):
 
     test_conv, = affine.integrate(case['convection'](mu, cont=(a,b,c)))
     np.testing.assert_almost_equal(phys_conv, test_conv)
+
+
+@pytest.mark.parametrize('piola', [True, False])
+def test_tabulated(mu, piola, monkeypatch):
+    case = cases[False] if piola else flatcase
+    a, b = [np.random.rand(case.ndofs) for __ in range(2)]
+
+    conts = {
+        'p-l2': [(None, None), (a, None)],
+        'v-h1s': [(None, None), (None, b)],
+        'divergence': [(None, None), (a, b)],
+        'convection': [(None, None, None), (a, None, b), (a, b, None)],
+    }
+
+    for name, conts in conts.items():
+        itg = case.integrals[name]
+        for cont in conts:
+            monkeypatch.setattr(type(itg), 'tabulate', True)
+            test = itg.evaluate(case, mu, cont)
+            monkeypatch.setattr(type(itg), 'tabulate', False)
+            ref = itg.evaluate(case, mu, cont)
+            if hasattr(ref, 'toarray'):
+                test, ref = test.toarray(), ref.toarray()
+            np.testing.assert_almost_equal(test, ref)
+
+
+def test_deim(mu):
+    case = flatcase
+    proj = np.linalg.qr(np.random.rand(case.ndofs, 4))[0].T
+    itg = case.integrals['convection']
+    red = itg.project(case, (proj,)*3, method='deim', tol=1e-10, nsnapshots=5)
+    assert isinstance(red, affine.MuDEIM)
+
+    index = tuple(red.index)
+    full = itg.evaluate_entries(case, mu, (None,)*3, index)
+    np.testing.assert_almost_equal(itg.evaluate_entries(case, mu, (None,)*3, index, red.mesh), full)
+
+    ref = affine._project(itg.evaluate(case, mu, (None,)*3), (proj,)*3)
+    np.testing.assert_almost_equal(red.evaluate(case, mu, (None,)*3), ref)
+
+    lift = case['lift'](mu, scale=False)
+    ref = affine._project(itg.evaluate(case, mu, (None, lift, None)), (proj,)*2)
+    np.testing.assert_almost_equal(red.lifts[frozenset({1})].evaluate(case, mu, (None, None)), ref)
+
+
+def test_deim_write(mu):
+    # Online DEIM evaluation of a Piola case reads the transforms from the
+    # stored high fidelity case
+    case = cases[False]
+    vinds, pinds = case.bases['v'].indices, case.bases['p'].indices
+    vproj = np.zeros((3, case.ndofs))
+    vproj[:, vinds] = np.linalg.qr(np.random.rand(len(vinds), 3))[0].T
+    pproj = np.zeros((2, case.ndofs))
+    pproj[:, pinds] = np.linalg.qr(np.random.rand(len(pinds), 2))[0].T
+    proj = np.vstack([vproj, pproj])
+    rcase = LofiCase(case, proj)
+    rcase.bases.add('v', None, length=3)
+    rcase.bases.add('p', None, length=2)
+    for name in ['geometry', 'lift', 'v-trf', 'p-trf']:
+        rcase[name] = case.integrals[name]
+    itg = case.integrals['convection']
+    rcase['convection'] = itg.project(case, (proj,)*3, method='deim', tol=1e-10, nsnapshots=5)
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test.rcase')
+    util.write_file(rcase, filename)
+    ncase = Case.read(util.open_file(filename))
+    os.remove(filename)
+
+    ref = affine._project(itg.evaluate(case, mu, (None,)*3), (proj,)*3)
+    np.testing.assert_almost_equal(rcase['convection'](mu, scale=False), ref)
+    np.testing.assert_almost_equal(ncase['convection'](mu, scale=False), ref)
+
+
+def test_reduced_domain(mu, monkeypatch):
+    case = flatcase
+    nelems = len(case.domain)
+    full = case['laplacian'](mu).toarray()
+
+    try:
+        case.reduce_domain(np.arange(nelems), 2 * np.ones(nelems))
+        np.testing.assert_almost_equal(case['laplacian'](mu).toarray(), 2 * full)
+
+        case.reduce_domain([0, 2], [1.5, 0.5])
+        for name in ['p-l2', 'v-h1s', 'divergence']:
+            itg = case.integrals[name]
+            monkeypatch.setattr(type(itg), 'tabulate', True)
+            test = itg.evaluate(case, mu, (None, None))
+            monkeypatch.setattr(type(itg), 'tabulate', False)
+            ref = itg.evaluate(case, mu, (None, None))
+            np.testing.assert_almost_equal(test.toarray(), ref.toarray())
+
+        geom, pbasis = case.refgeom, case.basis('p')
+        lazy = ntl.LazyNutilsIntegral(pbasis, case.reduced_domain, geom, 'gauss9')
+        test, = affine.integrate(lazy)
+        sample = case.domain.sample('gauss', 9)
+        values = sample.eval(pbasis * fn.J(geom))
+        ref = sum(
+            w * sample.points[e].weights.dot(values[sample.index[e]])
+            for e, w in zip([0, 2], [1.5, 0.5])
+        )
+        np.testing.assert_almost_equal(test, ref)
+    finally:
+        case.reduce_domain(None)
@@ -1,12 +1,14 @@
 import numpy as np
+import scipy as sp
 from nutils import mesh, function as fn, log, _
 import pytest
 import tempfile
 import h5py
 import os
 
-from aroma import cases, util, affine
+from aroma import cases, util, affine, solvers
 from aroma.case import Case
+from aroma.ensemble import Ensemble
 from aroma.reduction import ExplicitReducer
 
 
@@ -177,6 +179,33 @@ def test_pickle(case, mu):
     np.testing.assert_almost_equal(old_mx.toarray(), new_mx.toarray())
 
 
+def test_lazy_read(case, mu):
+    filename = os.path.join(tempfile.mkdtemp(), 'test.case')
+
+    @util.filecache(filename)
+    def get_case():
+        return case
+
+    get_case()
+    ncase = get_case()
+    assert set(ncase.integrals._groups) == set(case.integrals)
+    new_mx = ncase['divergence'](mu)
+    assert 'divergence' not in ncase.integrals._groups
+    assert 'laplacian' in ncase.integrals._groups
+
+    # Integrals not yet read survive the file being replaced or removed
+    with open(f'{filename}.new', 'wb') as f:
+        f.write(b'garbage')
+    os.replace(f'{filename}.new', filename)
+    os.remove(filename)
+
+    np.testing.assert_almost_equal(case['divergence'](mu).toarray(), new_mx.toarray())
+    np.testing.assert_almost_equal(
+        case['laplacian'](mu).toarray(), ncase['laplacian'](mu).toarray()
+    )
+    assert 'convection' in ncase.integrals._groups
+
+
 def test_project(case, mu):
     dmx = case['divergence'](mu).toarray()
     lmx = case['laplacian'](mu).toarray()
@@ -209,3 +238,317 @@ def test_project(case, mu):
         cmx[_,:,_,:,_,:] * proj[:,:,_,_,_,_] * proj[_,_,:,:,_,_] * proj[_,_,_,_,:,:]
     ).sum((1, 3, 5))
     np.testing.assert_almost_equal(cmx, pcase['convection'](mu))
+
+
+@pytest.mark.parametrize('options', [
+    {'lag': 4}, {'lag': 0, 'broyden': True},
+    {'lag': 4, 'solver': 'gmres', 'atol': 1e-12, 'precon': 'splu'},
+])
+def test_lagged_timestep(case, mu, options):
+    mu = dict(mu, time=0.0)
+    reference = solvers.navierstokes_time(case, mu, dt=0.1, nsteps=3)
+    lagged = solvers.navierstokes_time(case, mu, dt=0.1, nsteps=3, maxit=40, **options)
+    for (__, ref), (__, lhs) in zip(reference, lagged):
+        np.testing.assert_almost_equal(ref, lhs)
+
+
+def test_adaptive_timestep(case, mu):
+    mu = dict(mu, time=0.0)
+    __, reference = list(solvers.navierstokes_time(case, mu, dt=0.02, nsteps=5, tsolver='bdf2'))[-1]
+    endmu, lhs = list(solvers.navierstokes_adaptive(case, mu, dt=0.02, tmax=0.1, tol=1e-4))[-1]
+    np.testing.assert_almost_equal(endmu['time'], 0.1)
+
+    diff = reference - lhs
+    vmass = case['v-h1s'](mu)
+    assert np.sqrt(diff @ vmass @ diff) < 1e-3
+
+
+@pytest.mark.parametrize('solver,precon', [('gmres', 'ilu'), ('minres', 'lu')])
+def test_iterative_stokes(case, mu, solver, precon):
+    reference = solvers.stokes(case, mu)
+    lhs = solvers.stokes(case, mu, solver=solver, precon=precon, tol=1e-12)
+    vinds = case.bases['v'].indices
+    np.testing.assert_almost_equal(reference[vinds], lhs[vinds])
+
+
+def test_iterative_breakdown(case, mu, monkeypatch):
+    # A breakdown is not reported as convergence
+    monkeypatch.setattr(solvers, 'gmres', lambda mx, rhs, **kwargs: (np.zeros_like(rhs), -1))
+    with pytest.raises(solvers.matrix.MatrixError):
+        solvers.stokes(case, mu, solver='gmres', precon='ilu')
+
+
+def test_block_solver(case, mu):
+    vinds, pinds = case.bases['v'].indices, case.bases['p'].indices
+    vinds = vinds[np.isnan(case.constraints[vinds])]
+    dmx = case['divergence'](mu).toarray()[np.ix_(vinds, pinds)]
+
+    # Divergence-free velocity modes, so that the pressure decouples
+    __, __, vt = np.linalg.svd(dmx.T)
+    vproj = np.zeros((4, case.ndofs))
+    vproj[:, vinds] = vt[-4:]
+    pproj = np.zeros((3, case.ndofs))
+    pproj[:, pinds] = np.random.rand(3, len(pinds))
+    sproj = np.array([solvers.supremizer(case, mu, p) for p in pproj])
+    gproj = np.zeros((3, case.ndofs))
+    gproj[:, vinds] = np.random.rand(3, len(vinds))
+
+    for vp, segregated in [(vproj, True), (gproj, False)]:
+        rcase = ExplicitReducer(case, v=vp, s=sproj, p=pproj)()
+        mx = rcase['laplacian'](mu) + rcase['divergence'](mu, sym=True)
+        mx += rcase['convection'](mu, cont=(None, np.random.rand(rcase.ndofs), None))
+        rhs = np.random.rand(rcase.ndofs)
+
+        solver = solvers.linear_solver(rcase, mu, solver='block')
+        assert solver.segregated(mx) == segregated
+        np.testing.assert_almost_equal(solver(mx, rhs, rcase.constraints), np.linalg.solve(mx, rhs))
+
+    # Off-diagonal supremizer/pressure blocks that are not transposes of each
+    # other must not take the segregated path
+    rcase = ExplicitReducer(case, v=vproj, s=sproj, p=pproj)()
+    mx = rcase['laplacian'](mu) + rcase['divergence'](mu, sym=True)
+    mx[7:,4:7] *= 2.0
+    rhs = np.random.rand(rcase.ndofs)
+    solver = solvers.linear_solver(rcase, mu, solver='block')
+    assert not solver.segregated(mx)
+    np.testing.assert_almost_equal(solver(mx, rhs, rcase.constraints), np.linalg.solve(mx, rhs))
+
+
+def test_infsup(case, mu, monkeypatch):
+    vinds, pinds = case.bases['v'].indices, case.bases['p'].indices
+    vinds = vinds[np.isnan(case.constraints[vinds])]
+    vmass = case['v-h1s'](mu).toarray()[np.ix_(vinds, vinds)]
+    pmass = case['p-l2'](mu).toarray()[np.ix_(pinds, pinds)]
+    bmx = case['divergence'](mu).toarray()[np.ix_(vinds, pinds)]
+    eigvals = sp.linalg.eigvalsh(bmx.T @ np.linalg.solve(vmass, bmx), pmass)
+
+    # The corner pressure modes at the inlet are not seen by the divergence
+    np.testing.assert_almost_equal(eigvals[:2], 0.0)
+    np.testing.assert_almost_equal(solvers.infsup(case, mu), 0.0)
+
+    pproj = np.zeros((3, case.ndofs))
+    pproj[:, pinds] = np.random.rand(3, len(pinds))
+    sproj = np.array([solvers.supremizer(case, mu, p) for p in pproj])
+    vproj = np.zeros((2, case.ndofs))
+    vproj[:, vinds] = np.random.rand(2, len(vinds))
+    rcase = ExplicitReducer(case, v=vproj, s=sproj, p=pproj)()
+
+    vmass = rcase['v-h1s'](mu)[:5,:5]
+    pmass = rcase['p-l2'](mu)[5:,5:]
+    bmx = rcase['divergence'](mu)[:5,5:]
+    eigvals = sp.linalg.eigvalsh(bmx.T @ np.linalg.solve(vmass, bmx), pmass)
+    np.testing.assert_almost_equal(solvers.infsup(rcase, mu), np.sqrt(eigvals[0]))
+
+    mus = [dict(mu, length=length) for length in (9.0, 10.0)]
+    np.testing.assert_almost_equal(
+        solvers.infsup_batch(rcase, mus), [solvers.infsup(rcase, m) for m in mus]
+    )
+
+    # A reduced pair with divergence-free velocities is singular
+    fullbmx = case['divergence'](mu).toarray()[:, pinds]
+    kernel = sp.linalg.null_space(fullbmx[vinds].T)
+    vproj = np.zeros((4, case.ndofs))
+    vproj[:2, vinds] = np.random.rand(2, len(vinds))
+    vproj[2:, vinds] = kernel[:, :2].T
+    pproj = np.zeros((4, case.ndofs))
+    pproj[:, pinds] = np.random.rand(4, len(pinds))
+    rcase = ExplicitReducer(case, v=vproj, p=pproj)()
+    np.testing.assert_almost_equal(solvers.infsup(rcase, mu), 0.0)
+
+    # The velocity does not enter the inf-sup blocks
+    _infsup, calls = solvers._infsup, []
+
+    def counting(*args, **kwargs):
+        calls.append(None)
+        return _infsup(*args, **kwargs)
+    monkeypatch.setattr(solvers, '_infsup', counting)
+    mus = [dict(mu, velocity=vel) for vel in (0.5, 0.8, 1.0)]
+    values = solvers.infsup_batch(case, mus)
+    np.testing.assert_almost_equal(values, values[0])
+    assert len(calls) == 1
+
+
+def test_assemble(case, mu, monkeypatch):
+    from aroma.affine.integrands.nutils import LazyNutilsIntegral
+    integrate = LazyNutilsIntegral.integrate
+    calls = []
+
+    def counting(*args):
+        calls.append(len(args))
+        return integrate(*args)
+    monkeypatch.setattr(LazyNutilsIntegral, 'integrate', staticmethod(counting))
+
+    lhs = np.random.rand(case.ndofs)
+    c = case['convection']
+    rh, lh = solvers.navierstokes_conv(case, mu, lhs)
+    assert len(calls) <= 1
+    np.testing.assert_almost_equal(rh, c(mu, cont=(None, lhs, lhs)))
+    np.testing.assert_almost_equal(
+        lh.toarray(), (c(mu, cont=(None, lhs, None)) + c(mu, cont=(None, None, lhs))).toarray()
+    )
+
+    lap, div = case.assemble(mu, 'laplacian', ('divergence', ('lift', None)))
+    np.testing.assert_almost_equal(lap.toarray(), case['laplacian'](mu).toarray())
+    np.testing.assert_almost_equal(div, case['divergence'](mu, cont=('lift', None)))
+
+
+def test_delayed_template(mu):
+    from aroma.affine.integrands import integrate
+    from aroma.affine.integrands.nutils import NutilsDelayedIntegrand, LazyNutilsIntegral
+    case = cases.backstep(nel_length=2, nel_up=2)
+    case.precompute(force=False)
+    itg = next(
+        i for i in case.integrals['convection'].values if isinstance(i, NutilsDelayedIntegrand)
+    )
+    domain, geom, ischeme = itg.prop('domain', 'geometry', 'ischeme')
+
+    a, b = np.random.rand(case.ndofs), np.random.rand(case.ndofs)
+    conts = [(None, a, None), (None, b, None), (None, a, b)]
+    templated = integrate(*[itg.get(cont) for cont in conts])
+    assert len(itg._templates) == 2
+    direct = integrate(*[
+        LazyNutilsIntegral(itg._integrand(cont), domain, geom, ischeme) for cont in conts
+    ])
+    for t, d in zip(templated[:2], direct[:2]):
+        np.testing.assert_almost_equal(t.toarray(), d.toarray())
+    np.testing.assert_almost_equal(templated[2], direct[2])
+
+    summed, = integrate(itg.get(conts[0]) + itg.get(conts[1]))
+    np.testing.assert_almost_equal(summed.toarray(), (direct[0] + direct[1]).toarray())
+
+
+def test_delayed_reduced_domain(mu):
+    case = cases.backstep(nel_length=2, nel_up=2)
+    case.precompute(force=False)
+    lhs = np.random.rand(case.ndofs)
+    full = case['convection'](mu, cont=(None, lhs, lhs))
+
+    # Delayed integrands are evaluated on the reduced domain
+    nelems = len(case.domain)
+    case.reduce_domain(np.arange(nelems), 2 * np.ones(nelems))
+    try:
+        np.testing.assert_almost_equal(case['convection'](mu, cont=(None, lhs, lhs)), 2 * full)
+    finally:
+        case.reduce_domain(None)
+
+
+def test_precompute_parallel(mu):
+    serial = cases.backstep(nel_length=2, nel_up=2)
+    serial.precompute(force=True)
+    parallel = cases.backstep(nel_length=2, nel_up=2)
+    parallel.precompute(force=True, nprocs=2)
+    assert parallel.integrals['convection'].optimized
+
+    lhs = np.random.rand(serial.ndofs)
+    np.testing.assert_almost_equal(
+        parallel['laplacian'](mu).toarray(),
+        serial['laplacian'](mu).toarray(),
+    )
+    np.testing.assert_almost_equal(
+        parallel['convection'](mu, cont=(None, lhs, lhs)),
+        serial['convection'](mu, cont=(None, lhs, lhs)),
+    )
+
+
+def test_sampled_ensemble():
+    from aroma import quadrature, reduction
+    case = cases.backstep(nel_length=2, nel_up=2)
+    case.precompute()
+    calls = []
+
+    def solver(case, mu):
+        calls.append(mu)
+        return solvers.stokes(case, mu)
+
+    ensemble = Ensemble(quadrature.sobol(case.ranges(), 4))
+    ensemble.compute('solutions', case, solver)
+    ensemble.extend(quadrature.sobol(case.ranges(), 4, start=4))
+    ensemble.compute('solutions', case, solver)
+    assert len(calls) == 8
+
+    reference = Ensemble(quadrature.sobol(case.ranges(), 8))
+    reference.compute('solutions', case, solvers.stokes)
+    np.testing.assert_almost_equal(ensemble.scheme, reference.scheme)
+    np.testing.assert_almost_equal(ensemble['solutions'], reference['solutions'])
+
+    reducer = reduction.EigenReducer(case, ensemble)
+    reducer.add_basis('v', parent='v', ensemble='solutions', ndofs=3, norm='h1s')
+    reducer.add_basis('p', parent='p', ensemble='solutions', ndofs=3, norm='l2')
+    rcase = reducer()
+    assert rcase.ndofs == 6
+
+
+def test_project_lift(case, mu):
+    case.integrals['divergence'].liftable = (0, 1)
+    free = np.isnan(case.constraints)
+    proj = np.eye(case.ndofs)[free]
+    rcase = ExplicitReducer(case, v=proj)()
+    for solver in (solvers.stokes, solvers.navierstokes):
+        np.testing.assert_almost_equal(proj.T @ solver(rcase, mu), solver(case, mu))
+
+
+def test_greedy(monkeypatch):
+    from aroma import quadrature, reduction
+    case = cases.backstep(nel_length=2, nel_up=2, stabilize=False)
+    case.precompute()
+    case.integrals['divergence'].liftable = (0, 1)
+
+    scheme = quadrature.sobol(case.ranges(), 8)
+    reducer = reduction.GreedyReducer(
+        case, scheme, solvers.stokes, solvers.stokes_residual, nsnapshots=3
+    )
+    reducer.add_ensemble('supremizers', solvers.supremizer, 'solutions')
+    reducer.add_basis('v', parent='v', ensemble='solutions', ndofs=5, norm='h1s')
+    reducer.add_basis('s', parent='v', ensemble='supremizers', ndofs=5, norm='h1s')
+    reducer.add_basis('p', parent='p', ensemble='solutions', ndofs=5, norm='l2')
+    rcase = reducer()
+
+    assert len(set(reducer.selected)) == 3
+    assert rcase.size == 9
+    assert len(reducer.errors) == 3
+
+    # The pressure modes at the inflow corner make the problem singular, so
+    # the dual norm of the residual is not scaled
+    estimator = reducer.estimator()
+    assert estimator.terms is not None
+    assert estimator.stability is None
+
+    # No high fidelity problems are solved online
+    def offline(*args, **kwargs):
+        raise AssertionError
+    monkeypatch.setattr(solvers, '_smallest_singular', offline)
+    monkeypatch.setattr(estimator, 'residual', offline)
+
+    # The reduced solution is exact at the selected points, and the
+    # estimator vanishes there relative to the other points
+    errors = reducer.estimate(rcase, estimator)
+    assert np.all(errors >= 0.0)
+    assert np.all(errors[reducer.selected] <= 1e-6 * errors.max())
+    monkeypatch.undo()
+    mu = case.parameter(*scheme[reducer.selected[-1],1:])
+    np.testing.assert_almost_equal(
+        rcase.projection.T @ solvers.stokes(rcase, mu), solvers.stokes(case, mu), decimal=4
+    )
+
+    # The affine evaluation agrees with assembling the full residual
+    def residual(case, mu, lhs):
+        return solvers.stokes_residual(case, mu, lhs)
+    full = reduction.ResidualEstimator(case, residual, ['v-h1s', 'p-l2'])
+    assert full.terms is None
+    np.testing.assert_allclose(
+        reducer.estimate(rcase, full), errors, rtol=1e-6, atol=1e-6 * errors.max()
+    )
+
+    # The estimate bounds the velocity error, which is unique even though the
+    # pressure is not
+    others = [i for i in range(len(scheme)) if i not in reducer.selected]
+    for i in others:
+        mu = case.parameter(*scheme[i,1:])
+        error = solvers.stokes(case, mu) - rcase.projection.T @ solvers.stokes(rcase, mu)
+        assert errors[i] >= np.sqrt(error @ case['v-h1s'](mu) @ error)
+
+
+@pytest.mark.parametrize('options', [{'precon': 'ilu'}, {'precon': 'lu', 'block': 'system'}])
+def test_minres_symmetric(case, mu, options):
+    with pytest.raises(ValueError):
+        solvers.stokes(case, mu, solver='minres', **options)
@@ -3,7 +3,8 @@ from nutils import function as fn, matrix
 import pytest
 
 from aroma import cases
-from aroma.solvers import stokes, navierstokes
+from aroma.solvers import stokes, navierstokes, infsup
+import scipy as sp
 
 
 def _check_exact(case, mu, lhs, with_p=True):
@@ -96,3 +97,45 @@ def test_exact_stokes(e_exact, a_exact, mu):
     vdiv = a_exact.basis('v').dot(alhs).div(rgeom)
     vdiv = np.sqrt(a_exact.domain.integrate(vdiv**2 * fn.J(rgeom), ischeme='gauss9'))
     np.testing.assert_almost_equal(0.0, vdiv)
+
+
+def test_infsup_enclosed(mu):
+    # With only normal velocities constrained the pressure keeps exactly
+    # one zero mode, the constant
+    case = cases.exact(nel=4, degree=3)
+    case.precompute()
+    case._cons = None
+    case.constrain('v', 'left', 'right', component=0)
+    case.constrain('v', 'top', 'bottom', component=1)
+    mu = case.parameter(*mu)
+
+    vinds, pinds = case.bases['v'].indices, case.bases['p'].indices
+    vinds = vinds[np.isnan(case.constraints[vinds])]
+    vmass = case['v-h1s'](mu).toarray()[np.ix_(vinds, vinds)]
+    pmass = case['p-l2'](mu).toarray()[np.ix_(pinds, pinds)]
+    bmx = case['divergence'](mu).toarray()[np.ix_(vinds, pinds)]
+    eigvals = sp.linalg.eigvalsh(bmx.T @ np.linalg.solve(vmass, bmx), pmass)
+    np.testing.assert_almost_equal(eigvals[0], 0.0)
+    assert eigvals[1] > 0.1
+    np.testing.assert_almost_equal(infsup(case, mu), np.sqrt(eigvals[1]))
+
+
+def test_stability_enclosed(mu):
+    # The stability constant of the Stokes operator excludes the constant
+    # pressure, and scales the error estimate
+    from aroma import reduction, solvers
+    case = cases.exact(nel=4, degree=3)
+    case.precompute()
+    case._cons = None
+    case.constrain('v', 'left', 'right', component=0)
+    case.constrain('v', 'top', 'bottom', component=1)
+    mu = case.parameter(*mu)
+
+    terms = solvers.stokes_residual.terms
+    estimator = reduction.ResidualEstimator(case, solvers.stokes_residual, ['v-h1s', 'p-l2'], [mu])
+    op = solvers._linear_part(case, mu, terms)[estimator.free][:,estimator.free].toarray()
+    norm = estimator._norm.toarray()
+    eigvals = sp.linalg.eigvalsh(op.T @ np.linalg.solve(norm, op), norm)
+    np.testing.assert_almost_equal(eigvals[0], 0.0)
+    assert eigvals[1] > 1e-3
+    np.testing.assert_almost_equal(estimator.stability, np.sqrt(eigvals[1]))
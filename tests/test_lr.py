@@ -0,0 +1,69 @@
+import math
+import numpy as np
+import pytest
+
+lr = pytest.importorskip('lrspline')
+
+from aroma import quadrature, cases  # noqa: E402
+import aroma.affine.integrands.lr as lri  # noqa: E402
+
+
+@pytest.fixture
+def mesh():
+    mesh = lr.LRSplineSurface(6, 5, 3, 4)
+    for i in [2, 7, 8]:
+        mesh.elements[i].refine()
+    mesh.generate_ids()
+    return mesh
+
+
+def reference(mesh, npts=5):
+    wts, upts, vpts = quadrature.full([[0.0, 1.0], [0.0, 1.0]], npts).T
+    mass = np.zeros((len(mesh), len(mesh)))
+    lapl = np.zeros((len(mesh), len(mesh)))
+    for elt in mesh.elements:
+        bfuns = list(elt.support())
+        ids = [bf.id for bf in bfuns]
+        (umin, umax), (vmin, vmax) = elt.span()
+        for wt, upt, vpt in zip(wts, upts, vpts):
+            upt, vpt = umin + upt * (umax - umin), vmin + vpt * (vmax - vmin)
+            wt *= (umax - umin) * (vmax - vmin)
+            vals = np.array([bf(upt, vpt) for bf in bfuns])
+            mass[np.ix_(ids, ids)] += np.outer(vals, vals) * wt
+            for deriv in ((1,0), (0,1)):
+                ders = np.array([bf.derivative(upt, vpt, d=deriv) for bf in bfuns])
+                lapl[np.ix_(ids, ids)] += np.outer(ders, ders) * wt
+    return mass, lapl
+
+
+@pytest.mark.parametrize('nprocs', [1, 3])
+def test_matrices(mesh, nprocs):
+    mass, lapl = reference(mesh)
+    test_mass = lri.integrate2(mesh, lri.loc_mass, nprocs=nprocs)
+    test_lapl = lri.integrate2(mesh, lri.loc_laplacian, nprocs=nprocs)
+    np.testing.assert_almost_equal(test_mass.toarray(), mass)
+    np.testing.assert_almost_equal(test_lapl.toarray(), lapl)
+
+
+@pytest.mark.parametrize('nprocs', [1, 3])
+def test_source(mesh, nprocs):
+    mass, __ = reference(mesh)
+    ones = lri.integrate1(mesh, lri.loc_source, nprocs=nprocs, source=lambda x, y: np.ones_like(x))
+    np.testing.assert_almost_equal(ones, mass.sum(1))
+    np.testing.assert_almost_equal(ones.sum(), 1.0)
+
+    # Functions of scalars only are evaluated point by point
+    scalar = lri.integrate1(mesh, lri.loc_source, nprocs=nprocs, source=lambda x, y: math.exp(x))
+    vector = lri.integrate1(mesh, lri.loc_source, nprocs=nprocs, source=lambda x, y: np.exp(x))
+    np.testing.assert_almost_equal(scalar, vector)
+
+
+def test_memoized(mesh):
+    case = cases.lrpoisson(mesh)
+    mu = case.parameter()
+
+    lapl = case['laplacian'](mu)
+    lapl.data[:] = 0.0
+    np.testing.assert_almost_equal(case['laplacian'](mu).toarray(), reference(mesh)[1])
+    np.testing.assert_almost_equal(case['u-h1s'](mu).toarray(), reference(mesh)[1])
+    assert len(lri._matrices[mesh][1]) == 1
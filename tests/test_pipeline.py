@@ -0,0 +1,80 @@
+import numpy as np
+from click.testing import CliRunner
+import pytest
+import tempfile
+import os
+
+from aroma import util
+from aroma.ensemble import Ensemble
+from aroma.pipeline import Pipeline
+
+
+@pytest.fixture
+def pipeline():
+    root = tempfile.mkdtemp()
+    pipeline = Pipeline()
+    pipeline.calls = []
+
+    def make(*values):
+        retval = Ensemble(np.ones((1, 2)))
+        retval['data'] = np.array([values], dtype=float)
+        return retval
+
+    @pipeline.stage(os.path.join(root, 'case-{size}.ens'))
+    def case(size: int = 2):
+        pipeline.calls.append(('case', size))
+        return make(size)
+
+    @pipeline.stage(os.path.join(root, 'ensemble-{size}-{num}.ens'))
+    def ensemble(case, num: int = 3):
+        pipeline.calls.append(('ensemble', num))
+        return make(*case['data'][0], num)
+
+    @pipeline.stage(os.path.join(root, 'reduced-{size}-{num}-{nred}.ens'))
+    def reduced(case, ensemble, nred: int):
+        pipeline.calls.append(('reduced', nred))
+        return make(*ensemble['data'][0], nred)
+
+    return pipeline
+
+
+def test_parameters(pipeline):
+    assert list(pipeline.stages['reduced'].parameters) == ['size', 'num', 'nred']
+    assert pipeline.stages['reduced'].requires == ['case', 'ensemble']
+
+    levels = pipeline.jobs('reduced', nred=[1, 2], num=4)
+    assert [len(jobs) for jobs in levels] == [1, 1, 2]
+    assert levels[2] == [
+        ('reduced', {'size': 2, 'num': 4, 'nred': 1}),
+        ('reduced', {'size': 2, 'num': 4, 'nred': 2}),
+    ]
+
+
+def test_run(pipeline):
+    pipeline.run('reduced', nred=[1, 2])
+    assert sorted(pipeline.calls) == [('case', 2), ('ensemble', 3), ('reduced', 1), ('reduced', 2)]
+
+    np.testing.assert_almost_equal(pipeline.get('reduced', nred=2)['data'], [[2, 3, 2]])
+    pipeline.get('reduced', nred=1, num=3)
+    assert len(pipeline.calls) == 4
+
+    pipeline.run('reduced', nred=[1, 2], num=[3, 4], nprocs=2)
+    assert len(pipeline.calls) == 4
+    np.testing.assert_almost_equal(pipeline.get('reduced', nred=1, num=4)['data'], [[2, 4, 1]])
+
+
+def test_cli(pipeline):
+    args = ['reduced', '--nred', '1', '--nred', '2', '--nprocs', '1']
+    result = CliRunner().invoke(pipeline.cli(), args)
+    assert result.exit_code == 0, result.output
+    assert ('reduced', 2) in pipeline.calls
+    util.wait_for_write(pipeline.stages['reduced'].filename(nred=2))
+    assert os.path.exists(pipeline.stages['reduced'].filename(nred=2))
+
+
+def test_filename_parameters(pipeline):
+    # Sweeping over y would have every job write to the same file
+    with pytest.raises(ValueError):
+        @pipeline.stage('a-{x}.ens')
+        def stage(case, x: int = 1, y: int = 1):
+            pass
@@ -0,0 +1,75 @@
+import numpy as np
+import warnings
+import pytest
+
+from aroma import quadrature
+
+
+@pytest.mark.parametrize('ndims', [1, 2, 3])
+def test_sparse(ndims):
+    intervals = [(1.0 + i, 3.0 + 2*i) for i in range(ndims)]
+    scheme = quadrature.sparse(intervals, 15)
+    wts, pts = scheme[:,0], scheme[:,1:]
+    assert pts.shape[1] == ndims
+    assert len(np.unique(pts, axis=0)) == len(pts)
+    for (a, b), x in zip(intervals, pts.T):
+        assert np.all((a <= x) & (x <= b))
+
+    volume = np.prod([b - a for a, b in intervals])
+    np.testing.assert_almost_equal(wts.sum(), volume)
+
+    exact = np.prod([(b**3 - a**3) / 3 for a, b in intervals])
+    np.testing.assert_almost_equal(wts.dot(np.prod(pts**2, axis=1)), exact)
+
+
+def test_sparse_highdim():
+    scheme = quadrature.sparse([(0.0, 1.0)] * 6, 63)
+    assert scheme.shape == (10625, 7)
+    np.testing.assert_almost_equal(scheme[:,0].sum(), 1.0)
+
+
+@pytest.mark.parametrize('rule', ['full', 'uniform'])
+def test_tensor(rule):
+    intervals = [(1.0, 2.0), (0.0, 5.0), (-1.0, 3.0)]
+    scheme = getattr(quadrature, rule)(intervals, (2, 3, 4))
+    assert scheme.shape == (24, 4)
+    np.testing.assert_almost_equal(scheme[:,0].sum(), 20.0)
+    np.testing.assert_array_equal(scheme[:4,1:3], [[scheme[0,1], scheme[0,2]]] * 4)
+    assert len(np.unique(scheme[:,1:], axis=0)) == 24
+
+    chunks = list(getattr(quadrature, rule)(intervals, (2, 3, 4), chunksize=5))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 5, 5, 4]
+    np.testing.assert_array_equal(np.vstack(chunks), scheme)
+
+
+@pytest.mark.parametrize('scramble', [True, False])
+@pytest.mark.parametrize('rule', ['sobol', 'halton', 'lhs'])
+def test_sampling(rule, scramble):
+    intervals = [(0.0, 2.0), (1.0, 4.0), (-1.0, 0.0)]
+    scheme = getattr(quadrature, rule)(intervals, 16, scramble=scramble)
+    assert scheme.shape == (16, 4)
+    np.testing.assert_almost_equal(scheme[:,0], 6.0 / 16)
+    for (a, b), x in zip(intervals, scheme[:,1:].T):
+        assert np.all((a <= x) & (x <= b))
+
+    # Appending points leaves the earlier ones unchanged
+    head = getattr(quadrature, rule)(intervals, 5, scramble=scramble)
+    tail = getattr(quadrature, rule)(intervals, 11, start=5, scramble=scramble)
+    np.testing.assert_array_equal(np.vstack([head, tail])[:,1:], scheme[:,1:])
+
+
+def test_sobol_balance():
+    # Point counts that are not powers of two do not warn
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        scheme = quadrature.sobol([(0.0, 1.0)] * 2, 5)
+    assert scheme.shape == (5, 3)
+
+
+@pytest.mark.parametrize('scramble', [True, False])
+def test_lhs_strata(scramble):
+    scheme = quadrature.lhs([(0.0, 1.0)] * 3, 32, scramble=scramble, seed=1)
+    for npts in [1, 2, 4, 8, 16, 32]:
+        strata = np.floor(scheme[:npts,1:] * npts).astype(int)
+        for col in strata.T:
+            np.testing.assert_array_equal(np.sort(col), np.arange(npts))
@@ -0,0 +1,41 @@
+import numpy as np
+import scipy.sparse
+import pytest
+
+from aroma import solvers
+
+
+@pytest.fixture
+def system():
+    rng = np.random.RandomState(0)
+    mx = scipy.sparse.random(20, 20, density=0.2, random_state=rng) + 4 * scipy.sparse.eye(20)
+    cons = np.full((20,), np.nan)
+    cons[:3] = [1.0, 2.0, 3.0]
+    return mx.tocsr(), cons, rng.rand(20)
+
+
+def test_factorization(system):
+    mx, cons, rhs = system
+    reference = solvers.solve(mx, rhs, cons)
+    direct = solvers.Factorization(mx, cons)
+    np.testing.assert_almost_equal(direct(rhs), reference)
+
+    # Other solvers are dispatched through solve
+    iterative = solvers.Factorization(mx, cons, solver='gmres', atol=1e-12, precon='spilu')
+    np.testing.assert_almost_equal(iterative(rhs), reference)
+
+
+def test_lagged_jacobian_key(system):
+    mx, cons, rhs = system
+    jacobian = solvers.LaggedJacobian(lag=4)
+    jacobian.new_step((0.1, 1.0, -1.0))
+    assert jacobian.needs_factorization
+    jacobian.factorize(mx, cons)
+    np.testing.assert_almost_equal(jacobian.solve(rhs), solvers.solve(mx, rhs, cons))
+
+    jacobian.new_step((0.1, 1.0, -1.0))
+    assert not jacobian.needs_factorization
+
+    # A change in the time step invalidates the factorization
+    jacobian.new_step((0.05, 1.0, -1.0))
+    assert jacobian.needs_factorization
@@ -0,0 +1,216 @@
+import numpy as np
+import pytest
+import tempfile
+import h5py
+import pyfive
+import os
+
+from aroma import cases, util
+from aroma.case import Case
+from aroma.ensemble import Ensemble
+
+
+@pytest.fixture(params=[True, False])
+def case(request):
+    case = cases.backstep(nel_length=2, nel_up=2)
+    case.precompute(force=request.param)
+    return case
+
+
+@pytest.fixture
+def mu():
+    return {
+        'viscosity': 1.0,
+        'length': 10.0,
+        'height': 1.5,
+        'velocity': 1.0,
+    }
+
+
+def test_filecache_keys(case, mu):
+    root = tempfile.mkdtemp()
+    calls = []
+
+    @util.filecache(os.path.join(root, 'test-{n}.case'))
+    def get_case(n: int, scale=1.0):
+        calls.append('case')
+        return case
+
+    @util.filecache(os.path.join(root, 'test-{n}.ens'))
+    def get_ensemble(n: int):
+        calls.append('ensemble')
+        get_case(n)
+        retval = Ensemble(np.ones((1, 2)))
+        retval['solutions'] = np.ones((1, 3))
+        return retval
+
+    get_ensemble(1)
+    get_ensemble(1)
+    assert calls == ['ensemble', 'case']
+
+    # An argument missing from the filename still invalidates the entry
+    get_case(1, scale=2.0)
+    assert calls == ['ensemble', 'case', 'case']
+    util.wait_for_write(os.path.join(root, 'test-1.case'))
+    get_ensemble(1)
+    assert calls == ['ensemble', 'case', 'case', 'ensemble', 'case']
+
+    util.wait_for_write(os.path.join(root, 'test-1.case'))
+    util.wait_for_write(os.path.join(root, 'test-1.ens'))
+    manifest = util.read_manifest(os.path.join(root, 'test-1.ens'))
+    entry = manifest[os.path.join(root, 'test-1.ens')]
+    assert entry['deps'] == [os.path.join(root, 'test-1.case')]
+    assert all(entry['size'] > 0 for entry in manifest.values())
+
+    # Lazily read cases survive eviction of their file
+    ncase = get_case(1)
+    assert calls == ['ensemble', 'case', 'case', 'ensemble', 'case']
+    util.evict_cache(root, maxsize=0)
+    assert not os.path.exists(os.path.join(root, 'test-1.case'))
+    assert not util.read_manifest(os.path.join(root, 'test-1.ens'))
+    np.testing.assert_almost_equal(
+        case['laplacian'](mu).toarray(),
+        ncase['laplacian'](mu).toarray(),
+    )
+
+
+class _Options:
+
+    def __init__(self, value):
+        self.value = value
+
+
+def test_encode_arguments():
+    first = util.encode_arguments({'n': np.int64(1), 'opts': _Options(1), 'x': (1.0, 'a')})
+    second = util.encode_arguments({'n': 1, 'opts': _Options(1), 'x': [1.0, 'a']})
+    assert first == second
+    assert first != util.encode_arguments({'n': 1, 'opts': _Options(2), 'x': [1.0, 'a']})
+
+
+def test_source_hash(monkeypatch):
+    def get_case(n):
+        return cases.backstep(nel_up=n)
+
+    # Changes to code that is only referred to indirectly, here a base
+    # class of the case, invalidate the hash
+    before = util.source_hash(get_case)
+    getsource = util.getsource
+
+    def changed(obj):
+        source = getsource(obj)
+        return source + '# changed' if obj is Case else source
+    monkeypatch.setattr(util, 'getsource', changed)
+    util.source_hash.cache_clear()
+    try:
+        assert util.source_hash(get_case) != before
+    finally:
+        util.source_hash.cache_clear()
+
+
+def test_shared_arena(mu):
+    import pickle
+    case = cases.backstep(nel_length=2, nel_up=2)
+    case.precompute(force=True)
+    lhs = np.random.rand(case.ndofs)
+    before = case['convection'](mu, cont=(None, lhs, lhs))
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test.case')
+    util.write_file(case, filename, threshold=1)
+    ncase = Case.read(pyfive.File(filename), lazy=True)
+    ncase.ensure_shareable()
+
+    itg = next(iter(ncase.integrals['convection'].values))
+    assert isinstance(itg.data, util.SharedArray)
+    data = pickle.dumps(itg)
+    assert len(data) < itg.data.nbytes
+    np.testing.assert_almost_equal(pickle.loads(data).data, itg.data)
+
+    np.testing.assert_almost_equal(ncase['convection'](mu, cont=(None, lhs, lhs)), before)
+    os.remove(filename)
+
+    # Arrays mapped from the case file are moved to the arena too
+    util.write_file(case, filename)
+    ncase = Case.read(util.open_file(filename), lazy=True)
+    ncase.ensure_shareable()
+    itg = next(iter(ncase.integrals['convection'].values))
+    assert isinstance(itg.data, util.SharedArray)
+    os.remove(filename)
+
+
+def test_arena_segments():
+    import gc
+    import pickle
+    arena = util.Arena(tempfile.mkdtemp())
+    arr = arena.empty((10,), float)
+    arr[:] = 1.0
+    segment = arr._segment
+    assert not os.listdir(arena.directory)
+
+    # Attached arrays stay valid after the segment is released
+    data = pickle.dumps(arr)
+    attached = pickle.loads(data)
+    np.testing.assert_almost_equal(attached, 1.0)
+    del arr
+    gc.collect()
+    assert not os.path.exists(segment)
+    np.testing.assert_almost_equal(attached, 1.0)
+
+    # A new segment may reuse the file descriptor of the released one,
+    # but is not mistaken for it
+    other = arena.empty((10,), float)
+    other[:] = 2.0
+    with pytest.raises(OSError):
+        pickle.loads(data)
+    np.testing.assert_almost_equal(pickle.loads(pickle.dumps(other)), 2.0)
+
+
+def test_compressed_write(case, mu):
+    filename = os.path.join(tempfile.mkdtemp(), 'test.case')
+    util.write_file(case, filename, background=True, threshold=1)
+    util.wait_for_write(filename)
+    with h5py.File(filename, 'r') as f:
+        assert f['integrals/laplacian/terms/0/data/data'].compression == 'gzip'
+    ncase = Case.read(util.open_file(filename), lazy=True)
+    os.remove(filename)
+
+    np.testing.assert_almost_equal(
+        case['laplacian'](mu).toarray(),
+        ncase['laplacian'](mu).toarray(),
+    )
+    lhs = np.random.rand(case.ndofs)
+    np.testing.assert_almost_equal(
+        case['convection'](mu, cont=(None, lhs, lhs)),
+        ncase['convection'](mu, cont=(None, lhs, lhs)),
+    )
+
+
+class _ArrayWriter:
+
+    def __init__(self, data, close=False):
+        self.data = data
+        self.close = close
+
+    def write(self, group):
+        util.write_array(group, 'data', self.data)
+        if self.close:
+            group.file.close()
+
+
+def test_background_write():
+    filename = os.path.join(tempfile.mkdtemp(), 'test.hdf5')
+
+    # Pending arrays are written in the background
+    data = np.arange(10.0)
+    util.write_file(_ArrayWriter(data), filename, background=True, threshold=1)
+    util.wait_for_write(filename)
+    with h5py.File(filename, 'r') as f:
+        np.testing.assert_almost_equal(f['data'][:], np.arange(10.0))
+    os.remove(filename)
+
+    # Exceptions in the background are raised when waiting for the file,
+    # and no temporary file is left behind
+    util.write_file(_ArrayWriter(data, close=True), filename, background=True, threshold=1)
+    with pytest.raises(Exception):
+        util.wait_for_write(filename)
+    assert not os.path.exists(filename)
+    assert not os.path.exists(f'{filename}.tmp')